@@ -0,0 +1,147 @@
+"""
+In-memory S3 bucket shared by the test scripts.
+
+Models what the gallery relies on: ETags that change with every write,
+IfMatch/IfNoneMatch conditional puts (used by update_json_object, the
+ingestion lease and the download job checkpoints), object metadata,
+listings and multipart uploads.
+"""
+
+import io
+from datetime import datetime, timezone
+from unittest.mock import Mock
+from botocore.exceptions import ClientError
+
+def client_error(code, operation_name='Operation'):
+    return ClientError({'Error': {'Code': code}}, operation_name)
+
+class FakeS3:
+    """Minimal in-memory S3 with ETags and conditional writes"""
+
+    class exceptions:
+        class NoSuchKey(ClientError):
+            def __init__(self):
+                super().__init__({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+
+        class NoSuchUpload(ClientError):
+            def __init__(self):
+                super().__init__({'Error': {'Code': 'NoSuchUpload'}}, 'CompleteMultipartUpload')
+
+    def __init__(self):
+        self.objects = {}
+        self.versions = {}
+        self.metadata = {}
+        self.modified = {}
+        self.uploads = {}
+        self.before_put = None
+
+    def add_object(self, Key, Body=b'', Metadata=None, LastModified=None):
+        """Store an object as if it had been uploaded at LastModified"""
+        self.store(Key, Body, Metadata)
+        if LastModified is not None:
+            self.modified[Key] = LastModified
+
+    def body(self, Key):
+        body = self.objects[Key]
+        return body.encode('utf-8') if isinstance(body, str) else body
+
+    def etag(self, Key):
+        return f'"v{self.versions.get(Key, 0)}"'
+
+    def check_conditions(self, Key, IfMatch=None, IfNoneMatch=None):
+        if IfNoneMatch == '*' and Key in self.objects:
+            raise client_error('PreconditionFailed')
+        if IfMatch is not None and (Key not in self.objects or IfMatch != self.etag(Key)):
+            raise client_error('PreconditionFailed')
+
+    def store(self, Key, Body, Metadata=None):
+        self.objects[Key] = Body.encode('utf-8') if isinstance(Body, str) else Body
+        self.versions[Key] = self.versions.get(Key, 0) + 1
+        self.metadata[Key] = dict(Metadata or {})
+        self.modified[Key] = datetime.now(timezone.utc)
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None, Metadata=None, **kwargs):
+        if self.before_put:
+            hook, self.before_put = self.before_put, None
+            hook()
+        self.check_conditions(Key, IfMatch, IfNoneMatch)
+        self.store(Key, Body.read() if hasattr(Body, 'read') else Body, Metadata)
+        return {'ETag': self.etag(Key)}
+
+    def get_object(self, Bucket, Key, **kwargs):
+        if Key not in self.objects:
+            raise self.exceptions.NoSuchKey()
+        return {
+            'Body': io.BytesIO(self.body(Key)),
+            'ETag': self.etag(Key),
+            'ContentLength': len(self.body(Key)),
+            'Metadata': dict(self.metadata.get(Key, {}))
+        }
+
+    def head_object(self, Bucket, Key, **kwargs):
+        if Key not in self.objects:
+            raise client_error('404', 'HeadObject')
+        return {
+            'ETag': self.etag(Key),
+            'ContentLength': len(self.body(Key)),
+            'LastModified': self.modified[Key],
+            'Metadata': dict(self.metadata.get(Key, {}))
+        }
+
+    def copy_object(self, Bucket, Key, CopySource, Metadata=None, MetadataDirective='COPY', **kwargs):
+        source = CopySource['Key']
+        if source not in self.objects:
+            raise self.exceptions.NoSuchKey()
+        self.store(Key, self.body(source), Metadata if MetadataDirective == 'REPLACE' else self.metadata.get(source))
+        return {'CopyObjectResult': {'ETag': self.etag(Key)}}
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        for store in (self.objects, self.metadata, self.modified):
+            store.pop(Key, None)
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete['Objects']:
+            self.delete_object(Bucket, obj['Key'])
+        return {'Deleted': [{'Key': obj['Key']} for obj in Delete['Objects']]}
+
+    def list_objects_v2(self, Bucket, Prefix='', MaxKeys=1000, ContinuationToken=None, **kwargs):
+        # The continuation token is simply the last key of the previous page
+        keys = [key for key in sorted(self.objects) if key.startswith(Prefix) and key > (ContinuationToken or '')]
+        contents = [
+            {'Key': key, 'Size': len(self.body(key)), 'LastModified': self.modified[key], 'ETag': self.etag(key)}
+            for key in keys[:MaxKeys]
+        ]
+        response = {'Contents': contents, 'KeyCount': len(contents), 'IsTruncated': len(keys) > MaxKeys}
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = contents[-1]['Key']
+        return response
+
+    def get_paginator(self, operation_name):
+        paginator = Mock()
+        paginator.paginate.side_effect = lambda Bucket, Prefix='', **kwargs: [self.list_objects_v2(Bucket, Prefix, MaxKeys=len(self.objects) or 1)]
+        return paginator
+
+    def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600, **kwargs):
+        return f"https://example.com/{Params['Key']}"
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = f'upload-{len(self.uploads) + 1}'
+        self.uploads[upload_id] = {'Key': Key, 'Parts': {}, 'Metadata': kwargs.get('Metadata')}
+        return {'UploadId': upload_id, 'Key': Key}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        if UploadId not in self.uploads:
+            raise self.exceptions.NoSuchUpload()
+        self.uploads[UploadId]['Parts'][PartNumber] = Body.read() if hasattr(Body, 'read') else Body
+        return {'ETag': f'"part-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, IfMatch=None, IfNoneMatch=None, **kwargs):
+        if UploadId not in self.uploads:
+            raise self.exceptions.NoSuchUpload()
+        self.check_conditions(Key, IfMatch, IfNoneMatch)
+        upload = self.uploads.pop(UploadId)
+        self.store(Key, b''.join(upload['Parts'][part['PartNumber']] for part in MultipartUpload['Parts']), upload['Metadata'])
+        return {'ETag': self.etag(Key)}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        self.uploads.pop(UploadId, None)
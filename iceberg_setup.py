@@ -5,57 +5,188 @@ Iceberg table setup and management for the Picture Gallery application
 
 import boto3
 from pyiceberg.catalog import load_catalog
+from pyiceberg.exceptions import CommitFailedException
+from pyiceberg.expressions import (
+    AlwaysTrue,
+    And,
+    EqualTo,
+    GreaterThanOrEqual,
+    In,
+    LessThanOrEqual,
+    NotIn,
+    StartsWith
+)
+from pyiceberg.partitioning import PartitionSpec, PartitionField
+from pyiceberg.table import TableProperties
+from pyiceberg.table.sorting import SortOrder, SortField, SortDirection
+from pyiceberg.transforms import DayTransform, MonthTransform, IdentityTransform
 from pyiceberg.schema import Schema
 from pyiceberg.types import (
     NestedField,
     StringType,
     DateType,
-    TimestampType
+    TimestampType,
+    IntegerType,
+    LongType
 )
 import os
-from datetime import datetime
+import json
+import itertools
+import time
+import argparse
+import warnings
+from datetime import datetime, date, timezone, timedelta
 
 # Configuration
 ICEBERG_BUCKET = os.environ.get('ICEBERG_BUCKET', 'your-iceberg-bucket')
 ICEBERG_TABLE_PATH = os.environ.get('ICEBERG_TABLE_PATH', 'pictures_table')
 AWS_REGION = os.environ.get('AWS_REGION', 'us-east-1')
+# Catalog: 'glue' in production, or 'sql' (e.g. SQLite with a local warehouse) for tests and benchmarks
+ICEBERG_CATALOG_TYPE = os.environ.get('ICEBERG_CATALOG_TYPE', 'glue')
+ICEBERG_CATALOG_URI = os.environ.get('ICEBERG_CATALOG_URI', '')
+ICEBERG_WAREHOUSE = os.environ.get('ICEBERG_WAREHOUSE', f's3://{ICEBERG_BUCKET}/')
+PICTURES_TABLE_IDENTIFIER = f"default.{ICEBERG_TABLE_PATH}"
+# Seconds a warm process reuses loaded table metadata before checking for newer commits
+ICEBERG_METADATA_REFRESH_SECONDS = float(os.environ.get('ICEBERG_METADATA_REFRESH_SECONDS', '60'))
+ICEBERG_COMMIT_MAX_ATTEMPTS = 4  # Commits retried against refreshed metadata after a conflict
+# Maintenance: small-file compaction, snapshot expiry and orphan-file removal
+ICEBERG_TARGET_FILE_SIZE_BYTES = int(os.environ.get('ICEBERG_TARGET_FILE_SIZE_BYTES', str(128 * 1024 ** 2)))
+ICEBERG_SMALL_FILE_BYTES = int(os.environ.get('ICEBERG_SMALL_FILE_BYTES', str(32 * 1024 ** 2)))
+ICEBERG_COMPACTION_MIN_FILES = 5  # Small files a partition must have before they are rewritten
+ICEBERG_SNAPSHOT_RETENTION_HOURS = float(os.environ.get('ICEBERG_SNAPSHOT_RETENTION_HOURS', '168'))
+ICEBERG_SNAPSHOTS_TO_RETAIN = 5  # Most recent snapshots kept regardless of age
+ICEBERG_ORPHAN_MIN_AGE_HOURS = 72  # Younger unreferenced files may belong to commits in progress
+# Snapshot summary property naming the ingestion batch a commit wrote, so retries are skipped
+INGEST_BATCH_PROPERTY = 'gallery.ingest-batch-id'
+# Table property listing the most recent ingestion batch ids, which outlive snapshot expiry
+INGEST_BATCHES_TABLE_PROPERTY = 'gallery.ingest-batch-ids'
+INGEST_BATCH_HISTORY = 200
+
+# Schema for the pictures table
+PICTURES_SCHEMA = Schema(
+    NestedField(1, "picture_id", StringType(), required=True),
+    NestedField(2, "picture_name", StringType(), required=True),
+    NestedField(3, "picture_date", DateType(), required=True),
+    NestedField(4, "picture_jpg", StringType(), required=True),
+    NestedField(5, "upload_timestamp", TimestampType(), required=True),
+    NestedField(6, "file_size", LongType(), required=False),
+    NestedField(7, "image_width", IntegerType(), required=False),
+    NestedField(8, "image_height", IntegerType(), required=False),
+    NestedField(9, "rating", IntegerType(), required=False),
+    NestedField(10, "metadata", StringType(), required=False)  # Picture's S3 user metadata as JSON
+)
+
+# Partitioning of picture_date ('day' or 'month') and the sort order of rows within files
+ICEBERG_PARTITION_GRANULARITY = os.environ.get('ICEBERG_PARTITION_GRANULARITY', 'day')
+PARTITION_TRANSFORMS = {'day': DayTransform(), 'month': MonthTransform()}
+PICTURES_SORT_ORDER = SortOrder(SortField(source_id=2, transform=IdentityTransform()))
+
+# Process-level handles, reused across warm Lambda invocations
+catalog_handle = None
+table_handle = None
+table_refreshed_at = 0.0
 
 def create_iceberg_catalog():
     """
     Create and configure the Iceberg catalog
     """
-    catalog_config = {
-        'type': 'glue',
-        'warehouse': f's3://{ICEBERG_BUCKET}/',
-        'region': AWS_REGION
-    }
+    if ICEBERG_CATALOG_TYPE == 'sql':
+        catalog_config = {
+            'type': 'sql',
+            'uri': ICEBERG_CATALOG_URI,
+            'warehouse': ICEBERG_WAREHOUSE
+        }
+    elif ICEBERG_CATALOG_TYPE == 'glue':
+        catalog_config = {
+            'type': 'glue',
+            'warehouse': ICEBERG_WAREHOUSE,
+            'region': AWS_REGION
+        }
+    else:
+        raise ValueError(f"Unsupported ICEBERG_CATALOG_TYPE: {ICEBERG_CATALOG_TYPE}")
+    
+    return load_catalog(ICEBERG_CATALOG_TYPE, **catalog_config)
+
+def get_partition_field_name(granularity=None):
+    """
+    Get the name of the picture_date partition field for a granularity
+    """
+    return f"picture_date_{granularity or ICEBERG_PARTITION_GRANULARITY}"
+
+def get_pictures_partition_spec():
+    """
+    Get the partition spec for new pictures tables
+    """
+    if ICEBERG_PARTITION_GRANULARITY not in PARTITION_TRANSFORMS:
+        raise ValueError(f"ICEBERG_PARTITION_GRANULARITY must be one of: {', '.join(PARTITION_TRANSFORMS)}")
+    
+    return PartitionSpec(PartitionField(
+        source_id=3,
+        field_id=1000,
+        transform=PARTITION_TRANSFORMS[ICEBERG_PARTITION_GRANULARITY],
+        name=get_partition_field_name()
+    ))
+
+def get_catalog():
+    """
+    Get the process-wide Iceberg catalog, creating it on first use
+    """
+    global catalog_handle
     
-    return load_catalog('glue', **catalog_config)
+    if catalog_handle is None:
+        catalog_handle = create_iceberg_catalog()
+    return catalog_handle
+
+def get_pictures_table(refresh=False):
+    """
+    Get the pictures table handle, loading it once per process.
+    
+    Its metadata is refreshed from the catalog only when forced or once
+    ICEBERG_METADATA_REFRESH_SECONDS have passed; commits made through the
+    handle keep it current in between.
+    """
+    global table_handle, table_refreshed_at
+    
+    now = time.monotonic()
+    if table_handle is None:
+        table_handle = get_catalog().load_table(PICTURES_TABLE_IDENTIFIER)
+        table_refreshed_at = now
+    elif refresh or now - table_refreshed_at >= ICEBERG_METADATA_REFRESH_SECONDS:
+        table_handle.refresh()
+        table_refreshed_at = now
+    return table_handle
+
+def commit_to_pictures_table(operation):
+    """
+    Run operation(table) against the cached table, retrying on fresh metadata
+    when another writer committed first
+    """
+    table = get_pictures_table()
+    for attempt in range(ICEBERG_COMMIT_MAX_ATTEMPTS):
+        try:
+            return operation(table)
+        except CommitFailedException as e:
+            if attempt == ICEBERG_COMMIT_MAX_ATTEMPTS - 1:
+                raise
+            print(f"⚠️  Commit conflict, retrying with refreshed metadata: {str(e)}")
+            table = get_pictures_table(refresh=True)
 
 def create_pictures_table():
     """
     Create the pictures table in Iceberg format
     """
     try:
-        catalog = create_iceberg_catalog()
-        
-        # Define the schema for the pictures table
-        schema = Schema(
-            NestedField(1, "picture_id", StringType(), required=True),
-            NestedField(2, "picture_name", StringType(), required=True),
-            NestedField(3, "picture_date", DateType(), required=True),
-            NestedField(4, "picture_jpg", StringType(), required=True),
-            NestedField(5, "upload_timestamp", TimestampType(), required=True),
-            NestedField(6, "file_size", StringType(), required=False),
-            NestedField(7, "image_width", StringType(), required=False),
-            NestedField(8, "image_height", StringType(), required=False)
-        )
+        catalog = get_catalog()
         
         # Create the table
         table = catalog.create_table(
-            identifier=f"default.{ICEBERG_TABLE_PATH}",
-            schema=schema,
-            location=f"s3://{ICEBERG_BUCKET}/{ICEBERG_TABLE_PATH}/"
+            identifier=PICTURES_TABLE_IDENTIFIER,
+            schema=PICTURES_SCHEMA,
+            partition_spec=get_pictures_partition_spec(),
+            sort_order=PICTURES_SORT_ORDER,
+            properties={TableProperties.WRITE_TARGET_FILE_SIZE_BYTES: str(ICEBERG_TARGET_FILE_SIZE_BYTES)},
+            # SQL catalogs place the table under their warehouse
+            location=f"s3://{ICEBERG_BUCKET}/{ICEBERG_TABLE_PATH}/" if ICEBERG_CATALOG_TYPE == 'glue' else None
         )
         
         print(f"✅ Successfully created Iceberg table: {ICEBERG_TABLE_PATH}")
@@ -65,56 +196,218 @@ def create_pictures_table():
         print(f"❌ Error creating Iceberg table: {str(e)}")
         raise
 
+def to_column_value(field_type, value):
+    """
+    Convert a JSON-friendly record value to the Python type of an Iceberg column
+    """
+    if value is None:
+        return None
+    if isinstance(field_type, DateType) and isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    if isinstance(field_type, TimestampType) and isinstance(value, str):
+        value = datetime.fromisoformat(value)
+        # The column has no time zone; aware values are stored as UTC
+        return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo else value
+    if isinstance(field_type, StringType):
+        return str(value)
+    if isinstance(field_type, (IntegerType, LongType)):
+        try:
+            return int(value)
+        except ValueError:
+            # Unparseable header values (e.g. an empty width) are left unknown
+            return None
+    return value
+
+def get_picture_arrow_table(records, schema):
+    """
+    Build one Arrow table of picture records matching the table schema
+    """
+    import pyarrow as pa
+    
+    columns = {
+        field.name: [to_column_value(field.field_type, record.get(field.name)) for record in records]
+        for field in schema.fields
+    }
+    return pa.Table.from_pydict(columns, schema=schema.as_arrow())
+
+def sort_rows(table, rows):
+    """
+    Order Arrow rows by the table's sort order, so each data file covers a narrow
+    range of names in its min/max statistics
+    """
+    sort_keys = [
+        (table.schema().find_column_name(field.source_id), 'ascending' if field.direction == SortDirection.ASC else 'descending')
+        for field in table.sort_order().fields
+        if isinstance(field.transform, IdentityTransform)
+    ]
+    return rows.sort_by(sort_keys) if sort_keys else rows
+
+def get_committed_batch_ids(table):
+    """
+    Get the ids of the most recent ingestion batches committed to the table
+    """
+    return json.loads(table.properties.get(INGEST_BATCHES_TABLE_PROPERTY, '[]'))
+
+def is_batch_committed(table, batch_id):
+    """
+    Check whether the table already holds an ingestion batch.
+    
+    The table property survives snapshot expiry; snapshot summaries also cover
+    batches committed before the property was kept.
+    """
+    return batch_id in get_committed_batch_ids(table) or any(
+        snapshot.summary[INGEST_BATCH_PROPERTY] == batch_id for snapshot in table.snapshots()
+    )
+
+def write_picture_records(records, batch_id=None, replace_ids=()):
+    """
+    Write picture records to the Iceberg table in a single commit.
+    
+    Rows whose picture_id is in replace_ids are removed first, so updated
+    records replace the old rows; records marked 'deleted' only remove. A
+    batch_id is recorded in the snapshot summary and, in the same commit, in
+    the table's list of recent batches; writing a batch that is already
+    committed does nothing, so a retried flush cannot duplicate rows.
+    Returns the number of rows written.
+    """
+    rows = [record for record in records if not record.get('deleted')]
+    properties = {INGEST_BATCH_PROPERTY: batch_id} if batch_id else {}
+    
+    def write(table):
+        if batch_id and is_batch_committed(table, batch_id):
+            print(f"ℹ️  Batch {batch_id} is already committed")
+            return 0
+        with table.transaction() as transaction:
+            if replace_ids:
+                with warnings.catch_warnings():
+                    # Replacing a picture that was never written matches nothing
+                    warnings.simplefilter('ignore')
+                    transaction.delete(In('picture_id', list(replace_ids)), snapshot_properties=properties)
+            if rows:
+                transaction.append(sort_rows(table, get_picture_arrow_table(rows, table.schema())), snapshot_properties=properties)
+            if batch_id:
+                batch_ids = (get_committed_batch_ids(table) + [batch_id])[-INGEST_BATCH_HISTORY:]
+                transaction.set_properties({INGEST_BATCHES_TABLE_PROPERTY: json.dumps(batch_ids)})
+        return len(rows)
+    
+    written = commit_to_pictures_table(write)
+    print(f"✅ Wrote {written} picture record(s)")
+    return written
+
 def insert_picture_record(picture_id, picture_name, picture_date, picture_jpg, 
                          file_size=None, image_width=None, image_height=None):
     """
-    Insert a picture record into the Iceberg table
+    Insert a single picture record into the Iceberg table.
+    
+    Every call commits its own snapshot; uploads go through the batched
+    ingestion spool in unified_lambda instead.
     """
     try:
-        catalog = create_iceberg_catalog()
-        table = catalog.load_table(f"default.{ICEBERG_TABLE_PATH}")
-        
         record = {
             'picture_id': picture_id,
             'picture_name': picture_name,
             'picture_date': picture_date,
             'picture_jpg': picture_jpg,
-            'upload_timestamp': datetime.now(),
+            'upload_timestamp': datetime.now(timezone.utc).isoformat(),
             'file_size': file_size,
             'image_width': image_width,
             'image_height': image_height
         }
         
-        table.append([record])
+        write_picture_records([record])
         print(f"✅ Successfully inserted record for: {picture_name}")
         
     except Exception as e:
         print(f"❌ Error inserting picture record: {str(e)}")
         raise
 
-def query_pictures(date_filter=None, name_filter=None, limit=100):
+def build_picture_filter(date_filter=None, date_from=None, date_to=None, name_prefix=None, row_filter=None,
+                         min_rating=None, picture_ids=None, min_file_size=None, min_width=None, min_height=None):
+    """
+    Build a typed Iceberg filter expression from the picture query parameters.
+    
+    Dates may be date objects or ISO strings; date_from and date_to are inclusive.
+    Every predicate can be pushed down to partition pruning and file statistics.
+    """
+    predicates = []
+    if picture_ids is not None:
+        predicates.append(In('picture_id', list(picture_ids)))
+    if date_filter:
+        predicates.append(EqualTo('picture_date', str(date_filter)))
+    if date_from:
+        predicates.append(GreaterThanOrEqual('picture_date', str(date_from)))
+    if date_to:
+        predicates.append(LessThanOrEqual('picture_date', str(date_to)))
+    if name_prefix:
+        predicates.append(StartsWith('picture_name', name_prefix))
+    if min_rating:
+        predicates.append(GreaterThanOrEqual('rating', int(min_rating)))
+    if min_file_size:
+        predicates.append(GreaterThanOrEqual('file_size', int(min_file_size)))
+    if min_width:
+        predicates.append(GreaterThanOrEqual('image_width', int(min_width)))
+    if min_height:
+        predicates.append(GreaterThanOrEqual('image_height', int(min_height)))
+    if row_filter is not None:
+        predicates.append(row_filter)
+    
+    if not predicates:
+        return AlwaysTrue()
+    return predicates[0] if len(predicates) == 1 else And(*predicates)
+
+def query_picture_batches(row_filter=AlwaysTrue(), selected_fields=('*',), limit=None, name_contains=None):
+    """
+    Stream matching pictures as Arrow record batches.
+    
+    Data files are read one at a time and reading stops as soon as limit rows
+    have been produced. name_contains is a substring match, which file statistics
+    cannot answer, so it is applied to each batch after reading.
+    """
+    import pyarrow.compute as pc
+    from pyiceberg.io.pyarrow import ArrowScan
+    
+    table = get_pictures_table()
+    selected_fields = tuple(selected_fields)
+    scan_fields = selected_fields
+    if name_contains and '*' not in selected_fields and 'picture_name' not in selected_fields:
+        scan_fields += ('picture_name',)
+    
+    scan = table.scan(row_filter=row_filter, selected_fields=scan_fields)
+    projection = scan.projection()
+    remaining = limit
+    for task in scan.plan_files():
+        file_scan = ArrowScan(
+            table_metadata=table.metadata,
+            io=table.io,
+            projected_schema=projection,
+            row_filter=scan.row_filter,
+            # Substring filtering happens afterwards, so a file cannot stop early for it
+            limit=None if name_contains else remaining
+        )
+        for batch in file_scan.to_record_batches([task]):
+            if name_contains:
+                batch = batch.filter(pc.match_substring(batch.column('picture_name'), name_contains))
+                if scan_fields != selected_fields:
+                    batch = batch.select(list(selected_fields))
+            if remaining is not None:
+                batch = batch.slice(0, remaining)
+                remaining -= batch.num_rows
+            if batch.num_rows:
+                yield batch
+            if remaining == 0:
+                return
+
+def query_pictures(date_filter=None, name_filter=None, limit=100, date_from=None, date_to=None,
+                   name_prefix=None, selected_fields=('*',)):
     """
     Query pictures from the Iceberg table
     """
     try:
-        catalog = create_iceberg_catalog()
-        table = catalog.load_table(f"default.{ICEBERG_TABLE_PATH}")
-        
-        # Build the query
-        scan = table.scan()
-        
-        if date_filter:
-            scan = scan.filter(f"picture_date = '{date_filter}'")
+        row_filter = build_picture_filter(date_filter, date_from, date_to, name_prefix)
         
-        if name_filter:
-            scan = scan.filter(f"picture_name LIKE '%{name_filter}%'")
-        
-        # Execute the scan and return results
         results = []
-        for record in scan.to_arrow().to_pylist():
-            results.append(record)
-            if len(results) >= limit:
-                break
+        for batch in query_picture_batches(row_filter, selected_fields, limit, name_contains=name_filter):
+            results.extend(batch.to_pylist())
         
         return results
         
@@ -122,6 +415,409 @@ def query_pictures(date_filter=None, name_filter=None, limit=100):
         print(f"❌ Error querying pictures: {str(e)}")
         raise
 
+def filter_picture_records(records, row_filter=AlwaysTrue(), name_contains=None):
+    """
+    Get the picture records matching a filter as Arrow rows of the table schema,
+    evaluated in memory as a table scan would
+    """
+    import pyarrow.compute as pc
+    from pyiceberg.expressions.visitors import bind
+    from pyiceberg.io.pyarrow import expression_to_pyarrow
+    
+    schema = get_pictures_table().schema()
+    rows = get_picture_arrow_table(records, schema)
+    rows = rows.filter(expression_to_pyarrow(bind(schema, row_filter, case_sensitive=True)))
+    if name_contains:
+        rows = rows.filter(pc.match_substring(rows.column('picture_name'), name_contains))
+    return rows
+
+def query_picture_page(sort_keys, offset=0, limit=None, row_filter=AlwaysTrue(), name_contains=None, overlay=None):
+    """
+    Get one sorted page of matching pictures and the number of matches.
+    
+    Only picture_id and the sort columns are read to order the matches; full
+    rows are then read for the page alone. sort_keys are pyarrow (column, order)
+    pairs, with picture_id breaking ties so pages never overlap.
+    
+    overlay maps picture ids to records not yet written to the table, or to None
+    for pictures since deleted; those replace or hide the table's rows.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    
+    overlay = overlay or {}
+    pending = filter_picture_records([record for record in overlay.values() if record], row_filter, name_contains)
+    if overlay:
+        row_filter = And(row_filter, NotIn('picture_id', list(overlay)))
+    
+    sort_keys = list(sort_keys) + [('picture_id', 'ascending')]
+    key_fields = tuple(dict.fromkeys(column for column, _ in sort_keys))
+    batches = list(query_picture_batches(row_filter, key_fields, name_contains=name_contains))
+    pending_keys = pending.select(list(key_fields))
+    if batches:
+        pending_keys = pending_keys.select(batches[0].schema.names).cast(batches[0].schema)
+    batches += pending_keys.to_batches()
+    if not batches:
+        return [], 0
+    
+    matches = pa.Table.from_batches(batches).sort_by(sort_keys)
+    if pc.count_distinct(matches.column('picture_id')).as_py() < matches.num_rows:
+        # A picture with more than one row is listed once, where it sorts first
+        first = matches.append_column('row', pa.array(range(matches.num_rows))).group_by(
+            'picture_id', use_threads=False
+        ).aggregate([('row', 'min')])
+        matches = matches.take(sorted(first.column('row_min').to_pylist()))
+    page_ids = matches.column('picture_id').slice(offset, limit).to_pylist()
+    if not page_ids:
+        return [], matches.num_rows
+    
+    # A full listing reads every match anyway, without a long In() filter
+    page_filter = row_filter if len(page_ids) == matches.num_rows else build_picture_filter(
+        row_filter=row_filter, picture_ids=page_ids
+    )
+    rows = {row['picture_id']: row for row in pending.to_pylist()}
+    if any(picture_id not in rows for picture_id in page_ids):
+        for batch in query_picture_batches(page_filter, name_contains=name_contains):
+            rows.update((row['picture_id'], row) for row in batch.to_pylist())
+    return [rows[picture_id] for picture_id in page_ids if picture_id in rows], matches.num_rows
+
+def get_small_file_groups(table):
+    """
+    Group the data files to rewrite by partition: small files in partitions with
+    enough of them to be worth rewriting, and every file written under an older
+    partition spec
+    """
+    current_spec_id = table.spec().spec_id
+    groups = {}
+    for task in table.scan().plan_files():
+        # Files with delete files attached are left for a full rewrite
+        if task.delete_files:
+            continue
+        if task.file.spec_id != current_spec_id:
+            # Old partitions do not map onto new ones, so the whole spec is rewritten together
+            groups.setdefault((task.file.spec_id, None), []).append(task)
+        elif task.file.file_size_in_bytes < ICEBERG_SMALL_FILE_BYTES:
+            groups.setdefault((task.file.spec_id, task.file.partition), []).append(task)
+    return [
+        tasks for (spec_id, _), tasks in groups.items()
+        if spec_id != current_spec_id or len(tasks) >= ICEBERG_COMPACTION_MIN_FILES
+    ]
+
+# pyiceberg 0.10 compatibility: the only calls into pyiceberg's private API.
+# TestPyicebergCompatibility pins what they rely on, so an upgrade that changes
+# it fails there before it can break maintenance.
+
+def write_data_files(table_metadata, io, overwrite, rows, counter):
+    """
+    Write rows as Parquet data files added by an overwrite, returning how many were
+    written. Output files are numbered from counter; share one across a commit, as
+    rows of different groups can land in the same partition directory.
+    """
+    from pyiceberg.io.pyarrow import _dataframe_to_data_files
+    
+    written = 0
+    for data_file in _dataframe_to_data_files(
+        table_metadata=table_metadata, df=rows, io=io, write_uuid=overwrite.commit_uuid, counter=counter
+    ):
+        overwrite.append_data_file(data_file)
+        written += 1
+    return written
+
+def set_default_sort_order(transaction, table, sort_order):
+    """Add a sort order and make it the default within a transaction; pyiceberg 0.10 has no builder for it"""
+    from pyiceberg.table.update import AddSortOrderUpdate, SetDefaultSortOrderUpdate, AssertDefaultSortOrderId
+    
+    sort_order = SortOrder(
+        *sort_order.fields,
+        order_id=max(order.order_id for order in table.sort_orders().values()) + 1
+    )
+    transaction._apply(
+        (AddSortOrderUpdate(sort_order=sort_order), SetDefaultSortOrderUpdate(sort_order_id=-1)),
+        (AssertDefaultSortOrderId(default_sort_order_id=table.sort_order().order_id),)
+    )
+
+def expire_snapshot_ids(table, snapshot_ids):
+    """Expire the given snapshots in one commit"""
+    expiry = table.maintenance.expire_snapshots()
+    # pyiceberg 0.10 keeps the ids to expire in a set shared by every instance
+    expiry._snapshot_ids_to_expire = set()
+    expiry.by_ids(snapshot_ids).commit()
+
+def compact_data_files(dry_run=False):
+    """
+    Rewrite each partition's small data files into target-sized Parquet files,
+    replacing them in a single snapshot
+    """
+    from pyiceberg.io.pyarrow import ArrowScan
+    
+    def rewrite(table):
+        groups = get_small_file_groups(table)
+        metrics = {
+            'partitions': len(groups),
+            'files_rewritten': sum(len(tasks) for tasks in groups),
+            'bytes_rewritten': sum(task.file.file_size_in_bytes for tasks in groups for task in tasks),
+            'files_written': 0
+        }
+        if dry_run or not groups:
+            return metrics
+        
+        file_counter = itertools.count()
+        with table.transaction() as transaction:
+            with transaction.update_snapshot().overwrite() as overwrite:
+                for tasks in groups:
+                    # Rows are rewritten under the current schema and partition spec
+                    rows = ArrowScan(
+                        table_metadata=table.metadata,
+                        io=table.io,
+                        projected_schema=table.schema(),
+                        row_filter=AlwaysTrue()
+                    ).to_table(tasks)
+                    rows = sort_rows(table, rows)
+                    for task in tasks:
+                        overwrite.delete_data_file(task.file)
+                    metrics['files_written'] += write_data_files(table.metadata, table.io, overwrite, rows, file_counter)
+        return metrics
+    
+    return commit_to_pictures_table(rewrite)
+
+def get_retyped_columns(schema):
+    """
+    Get the PICTURES_SCHEMA fields whose column in schema has another type,
+    such as the sizes and dimensions tables used to store as strings
+    """
+    existing = {field.name: field.field_type for field in schema.fields}
+    return [
+        field for field in PICTURES_SCHEMA.fields
+        if field.name in existing and existing[field.name] != field.field_type
+    ]
+
+def to_numeric_column(column, arrow_type):
+    """
+    Cast a string column to an integer Arrow type; values that are not plain
+    non-negative integers become null rather than failing the rewrite
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    
+    column = pc.utf8_trim_whitespace(column)
+    digits = pc.match_substring_regex(column, r'^[0-9]+$')
+    return pc.cast(pc.if_else(digits, column, pa.scalar(None, pa.string())), arrow_type)
+
+def migrate_schema(dry_run=False):
+    """
+    Bring an existing table's columns in line with PICTURES_SCHEMA.
+    
+    Missing columns are added. Iceberg cannot promote a string column to a
+    number, so a retyped column is dropped and re-added with its new type,
+    and every data file is rewritten with the values converted, all in one
+    commit: readers see either the old table or the fully converted one.
+    """
+    import pyarrow as pa
+    from pyiceberg.io.pyarrow import ArrowScan
+    
+    def evolve(table):
+        schema = table.schema()
+        retyped = get_retyped_columns(schema)
+        existing = {field.name for field in schema.fields}
+        missing = [field.name for field in PICTURES_SCHEMA.fields if field.name not in existing]
+        result = {'columns_added': missing, 'columns_retyped': [field.name for field in retyped], 'files_rewritten': 0}
+        if dry_run or not (missing or retyped):
+            return result
+        
+        tasks = list(table.scan().plan_files()) if retyped else []
+        with table.transaction() as transaction:
+            if retyped:
+                with transaction.update_schema() as update:
+                    for field in retyped:
+                        update.delete_column(field.name)
+            with transaction.update_schema() as update:
+                update.union_by_name(PICTURES_SCHEMA)
+            if not tasks:
+                return result
+            
+            new_schema = transaction.table_metadata.schema().as_arrow()
+            file_counter = itertools.count()
+            with transaction.update_snapshot().overwrite() as overwrite:
+                for task in tasks:
+                    rows = ArrowScan(
+                        table_metadata=table.metadata,
+                        io=table.io,
+                        projected_schema=schema,
+                        row_filter=AlwaysTrue()
+                    ).to_table([task])
+                    columns = []
+                    for field in new_schema:
+                        if field.name not in rows.column_names:
+                            columns.append(pa.nulls(rows.num_rows, field.type))
+                        elif rows.schema.field(field.name).type != field.type:
+                            columns.append(to_numeric_column(rows.column(field.name), field.type))
+                        else:
+                            columns.append(rows.column(field.name))
+                    rows = pa.Table.from_arrays(columns, schema=new_schema)
+                    overwrite.delete_data_file(task.file)
+                    write_data_files(transaction.table_metadata, table.io, overwrite, rows, file_counter)
+                    result['files_rewritten'] += 1
+        return result
+    
+    return commit_to_pictures_table(evolve)
+
+def migrate_partitioning(dry_run=False):
+    """
+    Evolve an existing table to the configured partition spec and sort order,
+    then rewrite its data files into the new layout.
+    
+    Readers keep working throughout: the spec change is metadata only, and the
+    rewrite replaces the old files in a single snapshot. Files written under the
+    old spec are also picked up by later compactions if the rewrite is skipped.
+    """
+    if ICEBERG_PARTITION_GRANULARITY not in PARTITION_TRANSFORMS:
+        raise ValueError(f"ICEBERG_PARTITION_GRANULARITY must be one of: {', '.join(PARTITION_TRANSFORMS)}")
+    
+    def evolve(table):
+        field_name = get_partition_field_name()
+        partition_fields = {field.name for field in table.spec().fields}
+        sort_fields = [(field.source_id, field.transform, field.direction) for field in table.sort_order().fields]
+        changes = {
+            'partitioning': field_name not in partition_fields,
+            'sort_order': sort_fields != [(field.source_id, field.transform, field.direction) for field in PICTURES_SORT_ORDER.fields]
+        }
+        if dry_run or not any(changes.values()):
+            return changes
+        
+        with table.transaction() as transaction:
+            if changes['partitioning']:
+                with transaction.update_spec() as update:
+                    # Replace a picture_date partition at the other granularity
+                    for granularity in PARTITION_TRANSFORMS:
+                        if get_partition_field_name(granularity) in partition_fields:
+                            update.remove_field(get_partition_field_name(granularity))
+                    update.add_field('picture_date', PARTITION_TRANSFORMS[ICEBERG_PARTITION_GRANULARITY], field_name)
+            if changes['sort_order']:
+                set_default_sort_order(transaction, table, PICTURES_SORT_ORDER)
+        return changes
+    
+    print(f"🗂️  Migrating {PICTURES_TABLE_IDENTIFIER} to {ICEBERG_PARTITION_GRANULARITY} partitions sorted by picture_name...")
+    metrics = {'dry_run': dry_run, 'changes': commit_to_pictures_table(evolve)}
+    if not dry_run:
+        metrics['rewrite'] = compact_data_files()
+    print(json.dumps(metrics, indent=2))
+    return metrics
+
+def expire_snapshots(dry_run=False):
+    """
+    Expire snapshots older than ICEBERG_SNAPSHOT_RETENTION_HOURS, always keeping
+    the most recent ICEBERG_SNAPSHOTS_TO_RETAIN and every branch or tag head
+    """
+    def expire(table):
+        cutoff_ms = (time.time() - ICEBERG_SNAPSHOT_RETENTION_HOURS * 3600) * 1000
+        snapshots = sorted(table.snapshots(), key=lambda snapshot: snapshot.timestamp_ms)
+        protected = {ref.snapshot_id for ref in table.refs().values()}
+        expired = [
+            snapshot.snapshot_id
+            for snapshot in snapshots[:max(len(snapshots) - ICEBERG_SNAPSHOTS_TO_RETAIN, 0)]
+            if snapshot.timestamp_ms < cutoff_ms and snapshot.snapshot_id not in protected
+        ]
+        if expired and not dry_run:
+            expire_snapshot_ids(table, expired)
+        return {'snapshots': len(snapshots), 'snapshots_expired': len(expired)}
+    
+    return commit_to_pictures_table(expire)
+
+def get_referenced_files(table):
+    """
+    Get the paths of every metadata, manifest and data file the table's
+    remaining snapshots still use
+    """
+    metadata = table.metadata
+    referenced = {table.metadata_location}
+    referenced.update(entry.metadata_file for entry in metadata.metadata_log)
+    referenced.update(statistics.statistics_path for statistics in metadata.statistics)
+    referenced.update(statistics.statistics_path for statistics in metadata.partition_statistics)
+    
+    for snapshot in table.snapshots():
+        referenced.add(snapshot.manifest_list)
+        for manifest in snapshot.manifests(table.io):
+            # Snapshots share most manifests; read each one once
+            if manifest.manifest_path in referenced:
+                continue
+            referenced.add(manifest.manifest_path)
+            referenced.update(entry.data_file.file_path for entry in manifest.fetch_manifest_entry(table.io))
+    return referenced
+
+def list_table_files(location):
+    """
+    List (path, last modified) for the data and metadata files under a table location
+    """
+    location = location.rstrip('/')
+    if location.startswith('s3://'):
+        bucket, _, prefix = location[len('s3://'):].partition('/')
+        s3_client = boto3.client('s3', region_name=AWS_REGION)
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for directory in ('data/', 'metadata/'):
+            for page in paginator.paginate(Bucket=bucket, Prefix=f"{prefix}/{directory}"):
+                for obj in page.get('Contents', []):
+                    yield f"s3://{bucket}/{obj['Key']}", obj['LastModified']
+    elif location.startswith('file://') or location.startswith('/'):
+        root = location[len('file://'):] if location.startswith('file://') else location
+        scheme = 'file://' if location.startswith('file://') else ''
+        for directory in ('data', 'metadata'):
+            for dirpath, _, filenames in os.walk(os.path.join(root, directory)):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)
+                    yield f"{scheme}{path}", datetime.fromtimestamp(os.path.getmtime(path), timezone.utc)
+    else:
+        raise ValueError(f"Cannot list files for table location {location}")
+
+def remove_orphan_files(dry_run=False):
+    """
+    Delete files under the table location that no snapshot references, such as
+    data replaced by compaction once its snapshots expire, or files left by
+    failed commits
+    """
+    table = get_pictures_table(refresh=True)
+    referenced = get_referenced_files(table)
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=ICEBERG_ORPHAN_MIN_AGE_HOURS)
+    
+    orphans = [
+        path for path, modified in list_table_files(table.location())
+        if path not in referenced and modified < cutoff
+    ]
+    if not dry_run:
+        for path in orphans:
+            table.io.delete(path)
+    return {'orphan_files': len(orphans), 'orphan_files_removed': 0 if dry_run else len(orphans)}
+
+def get_scan_metrics():
+    """
+    Measure scan planning for the whole table: planning time and data file count
+    """
+    table = get_pictures_table(refresh=True)
+    started = time.perf_counter()
+    tasks = list(table.scan().plan_files())
+    return {
+        'planning_ms': round((time.perf_counter() - started) * 1000, 1),
+        'data_files': len(tasks),
+        'snapshots': len(table.snapshots())
+    }
+
+def maintain_pictures_table(dry_run=False):
+    """
+    Compact small files, expire old snapshots and remove orphan files, reporting
+    what was (or, with dry_run, would be) done
+    """
+    print(f"🧹 Maintaining Iceberg table {PICTURES_TABLE_IDENTIFIER}{' (dry run)' if dry_run else ''}...")
+    
+    metrics = {'dry_run': dry_run, 'before': get_scan_metrics()}
+    # Expiry runs after compaction so the replaced files become orphans in the same run
+    metrics['compaction'] = compact_data_files(dry_run)
+    metrics['expiry'] = expire_snapshots(dry_run)
+    metrics['orphans'] = remove_orphan_files(dry_run)
+    metrics['after'] = get_scan_metrics()
+    
+    print(json.dumps(metrics, indent=2))
+    print("✅ Iceberg maintenance completed successfully!")
+    return metrics
+
 def setup_glue_database():
     """
     Set up AWS Glue database for Iceberg catalog
@@ -151,8 +847,11 @@ def main():
     """
     print("🚀 Setting up Iceberg table for Picture Gallery...")
     
-    # Setup Glue database
-    setup_glue_database()
+    # Setup Glue database, or the namespace of a SQL catalog
+    if ICEBERG_CATALOG_TYPE == 'glue':
+        setup_glue_database()
+    else:
+        get_catalog().create_namespace_if_not_exists('default')
     
     # Create the pictures table
     create_pictures_table()
@@ -160,6 +859,17 @@ def main():
     print("✅ Iceberg setup completed successfully!")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Set up or maintain the Picture Gallery Iceberg table")
+    parser.add_argument('command', nargs='?', choices=['setup', 'maintain', 'migrate'], default='setup')
+    parser.add_argument('--dry-run', action='store_true', help="Report maintenance or migration work without changing the table")
+    args = parser.parse_args()
+    
+    if args.command == 'maintain':
+        maintain_pictures_table(dry_run=args.dry_run)
+    elif args.command == 'migrate':
+        print(json.dumps(migrate_schema(dry_run=args.dry_run)))
+        migrate_partitioning(dry_run=args.dry_run)
+    else:
+        main()
 
 
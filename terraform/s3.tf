@@ -77,6 +77,56 @@ resource "aws_s3_bucket_lifecycle_configuration" "pictures" {
       noncurrent_days = 30
     }
   }
+
+  # Originals tagged archivable at upload have a display copy for full-size
+  # views and thumbnails for the grid, so only downloads read them in full.
+  # Metadata edits copy them in place with their storage class kept.
+  rule {
+    id     = "archive_originals"
+    status = "Enabled"
+
+    filter {
+      and {
+        prefix = "pictures/"
+        tags = {
+          archivable = "true"
+        }
+      }
+    }
+
+    transition {
+      days          = 30
+      storage_class = "STANDARD_IA"
+    }
+  }
+
+  # Finalizing a direct upload, rating and commenting copy the picture onto
+  # itself, and versioning keeps every replaced body; drop them after a week
+  rule {
+    id     = "expire_replaced_pictures"
+    status = "Enabled"
+
+    filter {
+      prefix = "pictures/"
+    }
+
+    noncurrent_version_expiration {
+      noncurrent_days = 7
+    }
+  }
+
+  rule {
+    id     = "abandoned_multipart_uploads"
+    status = "Enabled"
+
+    filter {
+      prefix = "pictures/"
+    }
+
+    abort_incomplete_multipart_upload {
+      days_after_initiation = 7
+    }
+  }
 }
 
 
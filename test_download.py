@@ -9,8 +9,24 @@ from unittest.mock import Mock, patch, MagicMock
 import json
 import base64
 import zipfile
+import tarfile
 import io
-from unified_lambda import download_pictures
+import random
+from datetime import datetime, timezone
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from fake_s3 import FakeS3
+from unified_lambda import (
+    download_pictures,
+    get_archive_cache_key,
+    get_download_job,
+    run_download_job,
+    start_download_job
+)
 
 class TestDownloadFunctionality(unittest.TestCase):
     
@@ -75,6 +91,65 @@ class TestDownloadFunctionality(unittest.TestCase):
             self.assertEqual(zip_file.read('sunset.jpg'), b'fake_jpg_data')
             self.assertEqual(zip_file.read('mountain.png'), b'fake_png_data')
     
+    def test_download_pictures_tar_formats(self):
+        """Test that tar and zstd-compressed tar archives are streamed to storage part by part"""
+        fake_s3 = FakeS3()
+        pictures = {}
+        for i in range(4):
+            pictures[f'picture_{i}.jpg'] = random.Random(i).randbytes(3000)
+            fake_s3.add_object(f'pictures/{i}.jpg', pictures[f'picture_{i}.jpg'], {'original-name': f'picture_{i}.jpg'})
+
+        formats = ['tar']
+        if zstandard:
+            formats.append('tar.zst')
+
+        for archive_format in formats:
+            with self.subTest(archive_format=archive_format), \
+                    patch('unified_lambda.s3_client', fake_s3), \
+                    patch('unified_lambda.ARCHIVE_PART_SIZE', 5000):
+                fake_s3.create_multipart_upload = Mock(wraps=fake_s3.create_multipart_upload)
+                event = {
+                    'body': json.dumps({
+                        'pictures': list(pictures),
+                        'format': archive_format
+                    })
+                }
+
+                response = download_pictures(event)
+
+                self.assertEqual(response['statusCode'], 200)
+                body = json.loads(response['body'])
+                self.assertEqual(body['count'], 4)
+                archive_key = body['url'][len('https://example.com/'):]
+                self.assertTrue(archive_key.endswith(f'.{archive_format}'))
+                fake_s3.create_multipart_upload.assert_called_once()
+
+                archive_data = fake_s3.objects[archive_key]
+                if archive_format == 'tar.zst':
+                    archive_data = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(archive_data), read_across_frames=True).read()
+
+                with tarfile.open(fileobj=io.BytesIO(archive_data)) as tar_file:
+                    self.assertEqual(tar_file.getnames(), list(pictures))
+                    for picture_name, data in pictures.items():
+                        self.assertEqual(tar_file.extractfile(picture_name).read(), data)
+
+                # The streamed archive is served from the cache next time
+                self.assertTrue(json.loads(download_pictures(event)['body'])['cached'])
+
+    def test_download_unsupported_format(self):
+        """Test error when an unknown archive format is requested"""
+        event = {
+            'body': json.dumps({
+                'pictures': ['sunset.jpg'],
+                'format': 'rar'
+            })
+        }
+
+        response = download_pictures(event)
+
+        self.assertEqual(response['statusCode'], 400)
+        self.assertIn('Unsupported archive format', json.loads(response['body'])['error'])
+
     def test_download_no_pictures_specified(self):
         """Test error when no pictures are specified"""
         event = {
@@ -110,6 +185,180 @@ class TestDownloadFunctionality(unittest.TestCase):
         error_data = json.loads(response['body'])
         self.assertIn('None of the requested pictures were found', error_data['error'])
 
+    @patch('unified_lambda.s3_client')
+    def test_download_pictures_cache_hit(self, mock_s3):
+        """Test that a repeat selection is served from the archive cache"""
+
+        mock_s3.list_objects_v2.return_value = {
+            'Contents': [
+                {'Key': 'pictures/20240101_123456_abc123.jpg', 'ETag': '"etag-1"'}
+            ]
+        }
+
+        def mock_head_object(Bucket, Key):
+            if Key.startswith('archives/'):
+                # Archive cache entries are named after their selection hash
+                selection_hash = Key[len('archives/'):-len('.zip')]
+                return {
+                    'Metadata': {'selection-hash': selection_hash},
+                    'LastModified': datetime.now(timezone.utc)
+                }
+            return {'Metadata': {'original-name': 'sunset.jpg'}}
+
+        mock_s3.head_object.side_effect = mock_head_object
+        mock_s3.generate_presigned_url.return_value = 'https://example.com/archive.zip'
+
+        event = {
+            'body': json.dumps({
+                'pictures': ['sunset.jpg']
+            })
+        }
+
+        response = download_pictures(event)
+
+        self.assertEqual(response['statusCode'], 200)
+        body = json.loads(response['body'])
+        self.assertTrue(body['cached'])
+        self.assertEqual(body['url'], 'https://example.com/archive.zip')
+        mock_s3.get_object.assert_not_called()
+        mock_s3.put_object.assert_not_called()
+
+    @patch('unified_lambda.s3_client')
+    def test_download_pictures_caches_archive(self, mock_s3):
+        """Test that a freshly built archive is stored under its selection hash"""
+
+        mock_s3.list_objects_v2.return_value = {
+            'Contents': [
+                {'Key': 'pictures/20240101_123456_abc123.jpg', 'ETag': '"etag-1"'}
+            ]
+        }
+        mock_s3.head_object.return_value = {'Metadata': {'original-name': 'sunset.jpg'}}
+        mock_body = Mock()
+        mock_body.read.return_value = b'fake_jpg_data'
+        mock_s3.get_object.return_value = {'Body': mock_body}
+
+        event = {
+            'body': json.dumps({
+                'pictures': ['sunset.jpg']
+            })
+        }
+
+        response = download_pictures(event)
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertTrue(response['isBase64Encoded'])
+
+        put_kwargs = mock_s3.put_object.call_args[1]
+        expected_hash = get_archive_cache_key(
+            [('sunset.jpg', 'pictures/20240101_123456_abc123.jpg', '"etag-1"')]
+        )
+        self.assertEqual(put_kwargs['Key'], f'archives/{expected_hash}.zip')
+        self.assertEqual(put_kwargs['Metadata']['selection-hash'], expected_hash)
+        self.assertEqual(put_kwargs['Body'], base64.b64decode(response['body']))
+
+    def test_archive_cache_key_changes_with_etag(self):
+        """Test that changing a member's ETag invalidates the cache key"""
+        members = [('sunset.jpg', 'pictures/a.jpg', '"etag-1"'), ('sea.jpg', 'pictures/b.jpg', '"etag-2"')]
+        changed = [('sunset.jpg', 'pictures/a.jpg', '"etag-3"'), ('sea.jpg', 'pictures/b.jpg', '"etag-2"')]
+
+        self.assertEqual(get_archive_cache_key(members), get_archive_cache_key(list(reversed(members))))
+        self.assertNotEqual(get_archive_cache_key(members), get_archive_cache_key(changed))
+
+class TestDownloadJobs(unittest.TestCase):
+
+    def run_job(self, fake_s3, members, archive_format):
+        """Run a download job to completion, handing off between workers regularly"""
+
+        # Every third time check reports the invocation is about to time out
+        context = Mock()
+        context.get_remaining_time_in_millis.side_effect = lambda: 1000 if context.get_remaining_time_in_millis.call_count % 3 == 0 else 900000
+
+        handoffs = []
+        with patch('unified_lambda.s3_client', fake_s3), \
+             patch('unified_lambda.ARCHIVE_PART_SIZE', 5000), \
+             patch('unified_lambda.invoke_download_worker', handoffs.append):
+            response = start_download_job(members, 'selection', archive_format)
+            self.assertEqual(response['statusCode'], 202)
+            job_id = json.loads(response['body'])['jobId']
+
+            for _ in range(20):
+                if run_download_job(job_id, context)['status'] == 'complete':
+                    break
+
+            status = json.loads(get_download_job(job_id)['body'])
+
+        self.assertGreater(len(handoffs), 1)
+        return status
+
+    def test_download_job_resumes_from_checkpoints(self):
+        """Test that a job handing off between workers still produces a valid ZIP"""
+        fake_s3 = FakeS3()
+        members = []
+        for i in range(8):
+            # Incompressible data so that parts fill up and checkpoints happen
+            fake_s3.objects[f'pictures/{i}.jpg'] = random.Random(i).randbytes(3000)
+            members.append((f'picture_{i}.jpg', f'pictures/{i}.jpg', f'"etag-{i}"'))
+
+        status = self.run_job(fake_s3, members, 'zip')
+
+        self.assertEqual(status['status'], 'complete')
+        self.assertEqual(status['picturesDone'], 8)
+        self.assertEqual(status['url'], 'https://example.com/archives/selection.zip')
+
+        with zipfile.ZipFile(io.BytesIO(fake_s3.objects['archives/selection.zip'])) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            for picture_name, s3_key, _ in members:
+                self.assertEqual(zip_file.read(picture_name), fake_s3.objects[s3_key])
+
+    @unittest.skipUnless(zstandard, 'zstandard is not installed')
+    def test_tar_zst_download_job_resumes_from_checkpoints(self):
+        """Test that a resumed tar.zst job decompresses to one complete tar stream"""
+        fake_s3 = FakeS3()
+        members = []
+        for i in range(8):
+            fake_s3.objects[f'pictures/{i}.jpg'] = random.Random(i).randbytes(3000)
+            members.append((f'picture_{i}.jpg', f'pictures/{i}.jpg', f'"etag-{i}"'))
+
+        status = self.run_job(fake_s3, members, 'tar.zst')
+
+        self.assertEqual(status['status'], 'complete')
+        archive_data = fake_s3.objects['archives/selection.tar.zst']
+        tar_data = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(archive_data), read_across_frames=True).read()
+
+        with tarfile.open(fileobj=io.BytesIO(tar_data)) as tar_file:
+            self.assertEqual(tar_file.getnames(), [picture_name for picture_name, _, _ in members])
+            for picture_name, s3_key, _ in members:
+                self.assertEqual(tar_file.extractfile(picture_name).read(), fake_s3.objects[s3_key])
+
+    def test_failed_completion_retries_without_duplicate_trailer(self):
+        """Test that a job whose completion fails once still produces a valid ZIP"""
+        fake_s3 = FakeS3()
+        members = []
+        for i in range(4):
+            fake_s3.objects[f'pictures/{i}.jpg'] = random.Random(i).randbytes(3000)
+            members.append((f'picture_{i}.jpg', f'pictures/{i}.jpg', f'"etag-{i}"'))
+        complete = fake_s3.complete_multipart_upload
+
+        def complete_after_one_failure(**kwargs):
+            if fake_s3.complete_multipart_upload.call_count == 1:
+                raise Exception('service unavailable')
+            return complete(**kwargs)
+
+        fake_s3.complete_multipart_upload = Mock(side_effect=complete_after_one_failure)
+
+        with patch('unified_lambda.s3_client', fake_s3), \
+             patch('unified_lambda.ARCHIVE_PART_SIZE', 5000), \
+             patch('unified_lambda.invoke_download_worker'):
+            job_id = json.loads(start_download_job(members, 'selection', 'zip')['body'])['jobId']
+            self.assertEqual(run_download_job(job_id, Mock(spec=[]))['status'], 'running')
+            self.assertEqual(run_download_job(job_id, Mock(spec=[]))['status'], 'complete')
+
+        parts = fake_s3.complete_multipart_upload.call_args.kwargs['MultipartUpload']['Parts']
+        self.assertEqual([part['PartNumber'] for part in parts], list(range(1, len(parts) + 1)))
+        with zipfile.ZipFile(io.BytesIO(fake_s3.objects['archives/selection.zip'])) as zip_file:
+            self.assertIsNone(zip_file.testzip())
+            self.assertEqual(zip_file.namelist(), [picture_name for picture_name, _, _ in members])
+
 def run_tests():
     """Run the download functionality tests"""
     print("🧪 Testing bulk download functionality...")
@@ -0,0 +1,762 @@
+#!/usr/bin/env python3
+
+"""
+Test script for the Iceberg pictures table helpers
+"""
+
+import unittest
+import itertools
+from unittest.mock import MagicMock, patch
+import json
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone
+import pyiceberg
+from pyiceberg.catalog.sql import SqlCatalog
+from pyiceberg.exceptions import CommitFailedException
+from pyiceberg.expressions import And, EqualTo, StartsWith
+from pyiceberg.io.pyarrow import ArrowScan
+from pyiceberg.schema import Schema
+from pyiceberg.table.sorting import SortDirection, SortField, SortOrder
+from pyiceberg.transforms import DayTransform, IdentityTransform
+from pyiceberg.types import IntegerType, LongType, NestedField, StringType
+from fake_s3 import FakeS3
+import iceberg_setup
+import unified_lambda
+
+def picture_record(picture_id, **fields):
+    return {
+        'picture_id': picture_id,
+        'picture_name': f'{picture_id}.jpg',
+        'picture_date': '2024-03-05',
+        'picture_jpg': f'pictures/{picture_id}.jpg',
+        'upload_timestamp': '2024-03-05T10:00:00+00:00',
+        'file_size': 1000,
+        **fields
+    }
+
+class LocalTableTestCase(unittest.TestCase):
+    """Runs against a SQLite catalog with a local filesystem warehouse"""
+
+    def setUp(self):
+        self.warehouse = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.warehouse)
+        self.catalog = SqlCatalog('test', uri=f'sqlite:///{self.warehouse}/catalog.db', warehouse=f'file://{self.warehouse}')
+        self.catalog.create_namespace('default')
+        self.create_table()
+        for name, value in {'catalog_handle': self.catalog, 'table_handle': None, 'table_refreshed_at': 0.0}.items():
+            patcher = patch.object(iceberg_setup, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def create_table(self):
+        self.catalog.create_table(
+            iceberg_setup.PICTURES_TABLE_IDENTIFIER,
+            schema=iceberg_setup.PICTURES_SCHEMA,
+            partition_spec=iceberg_setup.get_pictures_partition_spec(),
+            sort_order=iceberg_setup.PICTURES_SORT_ORDER
+        )
+
+    def data_files(self):
+        table = self.catalog.load_table(iceberg_setup.PICTURES_TABLE_IDENTIFIER)
+        return [task.file for task in table.scan().plan_files()]
+
+    def rows(self):
+        table = self.catalog.load_table(iceberg_setup.PICTURES_TABLE_IDENTIFIER)
+        return table.scan().to_arrow().sort_by('picture_id').to_pylist()
+
+    def snapshot_count(self):
+        return len(self.catalog.load_table(iceberg_setup.PICTURES_TABLE_IDENTIFIER).snapshots())
+
+class TestTableHandles(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = MagicMock()
+        self.table = self.catalog.load_table.return_value
+        self.table.schema.return_value = iceberg_setup.PICTURES_SCHEMA
+        self.table.sort_order.return_value = iceberg_setup.PICTURES_SORT_ORDER
+        self.table.snapshots.return_value = []
+        self.table.scan.return_value.plan_files.return_value = []
+        for name, value in {'catalog_handle': None, 'table_handle': None, 'table_refreshed_at': 0.0}.items():
+            patcher = patch.object(iceberg_setup, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_handles_are_reused_across_calls(self):
+        """Test that warm calls reuse the catalog and table without reloading metadata"""
+        with patch('iceberg_setup.create_iceberg_catalog', return_value=self.catalog) as create_catalog:
+            iceberg_setup.insert_picture_record('id-1', 'a.jpg', '2024-03-01', 'pictures/a.jpg')
+            iceberg_setup.query_pictures()
+            iceberg_setup.query_pictures()
+
+        create_catalog.assert_called_once()
+        self.catalog.load_table.assert_called_once_with(iceberg_setup.PICTURES_TABLE_IDENTIFIER)
+        self.table.refresh.assert_not_called()
+
+    def test_metadata_refreshed_after_interval(self):
+        """Test that table metadata is re-read once the refresh interval has passed"""
+        with patch('iceberg_setup.create_iceberg_catalog', return_value=self.catalog), \
+                patch('iceberg_setup.time.monotonic', side_effect=[1000.0, 1010.0, 1000.0 + iceberg_setup.ICEBERG_METADATA_REFRESH_SECONDS]):
+            iceberg_setup.get_pictures_table()
+            iceberg_setup.get_pictures_table()
+            self.table.refresh.assert_not_called()
+            iceberg_setup.get_pictures_table()
+
+        self.table.refresh.assert_called_once()
+
+    def test_commit_conflict_refreshes_and_retries(self):
+        """Test that a commit losing a race is retried on refreshed metadata"""
+        transaction = self.table.transaction.return_value.__enter__.return_value
+        self.table.transaction.return_value.__exit__.side_effect = [CommitFailedException('stale metadata'), None]
+
+        with patch('iceberg_setup.create_iceberg_catalog', return_value=self.catalog):
+            iceberg_setup.insert_picture_record('id-1', 'a.jpg', '2024-03-01', 'pictures/a.jpg')
+
+        self.assertEqual(transaction.append.call_count, 2)
+        self.table.refresh.assert_called_once()
+
+class TestBatchedIngestion(LocalTableTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.fake_s3 = FakeS3()
+        patcher = patch('unified_lambda.s3_client', self.fake_s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def spool(self, *picture_ids, **fields):
+        for picture_id in picture_ids:
+            self.fake_s3.put_object(
+                Bucket='bucket',
+                Key=f'{unified_lambda.INGEST_PENDING_PREFIX}{picture_id}/0.json',
+                Body=json.dumps(picture_record(picture_id, **fields)).encode('utf-8')
+            )
+
+    def spooled(self, picture_id):
+        prefix = f'{unified_lambda.INGEST_PENDING_PREFIX}{picture_id}/'
+        return [json.loads(self.fake_s3.objects[key]) for key in sorted(self.fake_s3.objects) if key.startswith(prefix)]
+
+    def test_batch_appended_once(self):
+        """Test that re-appending a committed batch adds no rows or snapshots"""
+        records = [picture_record('a'), picture_record('b')]
+
+        iceberg_setup.write_picture_records(records, 'batch-1')
+        iceberg_setup.write_picture_records(records, 'batch-1')
+
+        rows = self.rows()
+        self.assertEqual([row['picture_id'] for row in rows], ['a', 'b'])
+        self.assertEqual(rows[0]['file_size'], 1000)
+        self.assertEqual(rows[0]['upload_timestamp'], datetime(2024, 3, 5, 10))
+        self.assertEqual(self.snapshot_count(), 1)
+
+    def test_flush_waits_for_size_or_age(self):
+        """Test that a small, fresh spool is left for a later flush"""
+        self.spool('a', 'b')
+
+        result = unified_lambda.flush_ingest()
+
+        self.assertEqual(result['flushed'], 0)
+        self.assertEqual(self.rows(), [])
+
+        with patch('unified_lambda.INGEST_BATCH_SIZE', 2):
+            result = unified_lambda.flush_ingest()
+
+        self.assertEqual(result, {'flushed': 2, 'batches': 1})
+
+    def test_flush_commits_spool_as_one_snapshot(self):
+        """Test that all spooled records land in a single append and leave the spool empty"""
+        self.spool('a', 'b', 'c')
+        stale = datetime.now(timezone.utc) - timedelta(seconds=unified_lambda.INGEST_MAX_AGE_SECONDS + 1)
+        self.fake_s3.modified['ingest/pending/a/0.json'] = stale
+
+        result = unified_lambda.flush_ingest()
+
+        self.assertEqual(result['flushed'], 3)
+        self.assertEqual([row['picture_id'] for row in self.rows()], ['a', 'b', 'c'])
+        self.assertEqual(self.snapshot_count(), 1)
+        self.assertEqual(set(self.fake_s3.objects), {unified_lambda.INGEST_LEASE_KEY})
+        self.assertEqual(json.loads(self.fake_s3.objects[unified_lambda.INGEST_LEASE_KEY]), {})
+
+    def test_interrupted_flush_is_not_duplicated(self):
+        """Test that a batch committed before a crash is cleared without appending again"""
+        self.spool('a', 'b')
+        iceberg_setup.write_picture_records([picture_record('a'), picture_record('b')], 'batch-1')
+        self.fake_s3.put_object(
+            Bucket='bucket',
+            Key=unified_lambda.INGEST_BATCH_KEY,
+            Body=json.dumps({'id': 'batch-1', 'keys': ['ingest/pending/a/0.json', 'ingest/pending/b/0.json']}).encode('utf-8')
+        )
+        self.spool('c')
+
+        result = unified_lambda.flush_ingest(force=True)
+
+        self.assertEqual(result, {'flushed': 1, 'batches': 2})
+        self.assertEqual([row['picture_id'] for row in self.rows()], ['a', 'b', 'c'])
+
+    def test_flush_skipped_while_leased(self):
+        """Test that only one flush runs at a time"""
+        self.spool('a')
+        self.fake_s3.put_object(
+            Bucket='bucket',
+            Key=unified_lambda.INGEST_LEASE_KEY,
+            Body=json.dumps({'owner': 'other', 'expires': datetime.now().timestamp() + 60}).encode('utf-8')
+        )
+
+        result = unified_lambda.flush_ingest(force=True)
+
+        self.assertEqual(result, {'flushed': 0, 'busy': True})
+        self.assertIn('ingest/pending/a/0.json', self.fake_s3.objects)
+
+    def test_uploads_spool_records_and_trigger_flush(self):
+        """Test that stored pictures are spooled and enough of them start a flush"""
+        uploaded_at = datetime(2024, 3, 5, 10, tzinfo=timezone.utc)
+        metadata = {'captured-at': '2023-12-24T18:30:00', 'width': '4000', 'height': '3000'}
+
+        with patch('unified_lambda.ICEBERG_INGEST_ENABLED', True), \
+                patch('unified_lambda.INGEST_BATCH_SIZE', 2), \
+                patch('unified_lambda.ingest_spooled', 0), \
+                patch('unified_lambda.invoke_ingest_worker') as invoke:
+            unified_lambda.spool_picture_record('pictures/20240305_100000_abc.jpg', 'beach.jpg', metadata, 1234, uploaded_at)
+            invoke.assert_not_called()
+            unified_lambda.spool_picture_record('pictures/20240305_100001_def.jpg', 'dunes.jpg', {}, 99, uploaded_at)
+            invoke.assert_called_once()
+
+        [record] = self.spooled('20240305_100000_abc')
+        self.assertEqual(record['picture_date'], '2023-12-24')
+        self.assertEqual((record['file_size'], record['image_width']), (1234, '4000'))
+
+    def test_updates_replace_rows_and_tombstones_remove_them(self):
+        """Test that a flush keeps each picture's latest change, replacing or removing its row"""
+        self.spool('a', 'b', 'c')
+        unified_lambda.flush_ingest(force=True)
+        for picture_id, record in [
+            ('a', {**picture_record('a', rating=3), 'change': 'update'}),
+            ('a', {**picture_record('a', rating=5), 'change': 'update'}),
+            ('b', {'picture_id': 'b', 'deleted': True, 'change': 'delete'})
+        ]:
+            with patch('unified_lambda.ICEBERG_INGEST_ENABLED', True):
+                unified_lambda.spool_ingest_record(record)
+        self.assertEqual(len(self.spooled('a')), 2)
+
+        result = unified_lambda.flush_ingest(force=True)
+
+        self.assertEqual(result['flushed'], 1)
+        self.assertEqual([(row['picture_id'], row['rating']) for row in self.rows()], [('a', 5), ('c', None)])
+        self.assertEqual(self.spooled('a'), [])
+
+    def test_insert_of_a_written_picture_replaces_its_row(self):
+        """Test that an insert flushed after its picture was already written leaves one row"""
+        iceberg_setup.write_picture_records([picture_record('a')], 'backfill')
+        self.spool('a', rating=5, change='insert')
+
+        unified_lambda.flush_ingest(force=True)
+
+        self.assertEqual([(row['picture_id'], row['rating']) for row in self.rows()], [('a', 5)])
+
+    def test_backfill_writes_every_stored_picture_once(self):
+        """Test that a backfill spools and flushes all pictures, and repeating it adds no duplicates"""
+        for name, rating in [('20240305_100000_abc', '4'), ('20240306_090000_def', '')]:
+            self.fake_s3.put_object(
+                Bucket='bucket', Key=f'pictures/{name}.jpg', Body=b'jpeg',
+                Metadata={'original-name': f'{name}.jpg', 'upload_date': '2024-03-05T10:00:00', 'rating': rating}
+            )
+
+        with patch('unified_lambda.ICEBERG_INGEST_ENABLED', True), patch('unified_lambda.ingest_spooled', 0):
+            self.assertEqual(unified_lambda.backfill_ingest(), {'spooled': 2, 'flushed': 2, 'batches': 1})
+            unified_lambda.backfill_ingest()
+
+        rows = self.rows()
+        self.assertEqual([(row['picture_id'], row['rating'], row['file_size']) for row in rows],
+                         [('20240305_100000_abc', 4, 4), ('20240306_090000_def', 0, 4)])
+        self.assertEqual(rows[0]['upload_timestamp'], datetime(2024, 3, 5, 10))
+        self.assertEqual(json.loads(rows[0]['metadata'])['original-name'], '20240305_100000_abc.jpg')
+
+    def test_backfill_hands_off_between_pages(self):
+        """Test that a backfill running low on time continues from its listing position in a new invocation"""
+        for name in ('a', 'b', 'c'):
+            self.fake_s3.add_object(f'pictures/{name}.jpg', b'jpeg', {'original-name': f'{name}.jpg'})
+        context = MagicMock()
+        context.get_remaining_time_in_millis.return_value = 1000
+        continued = []
+
+        def invoke_backfill_worker(continuation_token):
+            continued.append(continuation_token)
+            return unified_lambda.backfill_ingest(None, continuation_token)
+
+        with patch('unified_lambda.ICEBERG_INGEST_ENABLED', True), patch('unified_lambda.ingest_spooled', 0), \
+                patch('unified_lambda.INGEST_BACKFILL_PAGE_SIZE', 2), \
+                patch('unified_lambda.invoke_backfill_worker', side_effect=invoke_backfill_worker):
+            result = unified_lambda.lambda_handler({'backfill_ingest': True}, context)
+
+        self.assertEqual(result, {'spooled': 2, 'continued': True})
+        self.assertEqual(continued, ['pictures/b.jpg'])
+        self.assertEqual([row['picture_id'] for row in self.rows()], ['a', 'b', 'c'])
+
+    def test_flush_renews_its_lease_for_each_batch(self):
+        """Test that a flush of several batches outlasting INGEST_LEASE_SECONDS keeps out a second flush"""
+        self.spool('a', 'b', 'c')
+        clock = [1000.0]
+        competing = []
+        write_picture_records = iceberg_setup.write_picture_records
+
+        def slow_commit(*args, **kwargs):
+            clock[0] += unified_lambda.INGEST_LEASE_SECONDS - 100
+            competing.append(unified_lambda.flush_ingest(force=True).get('busy'))
+            return write_picture_records(*args, **kwargs)
+
+        with patch('unified_lambda.INGEST_MAX_BATCH_RECORDS', 1), \
+                patch('unified_lambda.time.time', side_effect=lambda: clock[0]), \
+                patch('iceberg_setup.write_picture_records', side_effect=slow_commit):
+            result = unified_lambda.flush_ingest(force=True)
+
+        self.assertEqual(result['batches'], 3)
+        self.assertEqual(competing, [True, True, True])
+
+    def test_aged_spool_starts_a_flush(self):
+        """Test that spooling starts a flush once the oldest pending record is old enough"""
+        self.spool('a')
+        stale = datetime.now(timezone.utc) - timedelta(seconds=unified_lambda.INGEST_MAX_AGE_SECONDS + 1)
+
+        with patch('unified_lambda.ICEBERG_INGEST_ENABLED', True), \
+                patch('unified_lambda.ingest_spooled', 0), \
+                patch('unified_lambda.ingest_checked_at', float('-inf')), \
+                patch('unified_lambda.invoke_ingest_worker') as invoke:
+            unified_lambda.spool_ingest_record(picture_record('b'))
+            invoke.assert_not_called()
+
+            self.fake_s3.modified['ingest/pending/a/0.json'] = stale
+            unified_lambda.spool_ingest_record(picture_record('c'))
+            invoke.assert_not_called()  # Checked too recently
+
+            with patch('unified_lambda.ingest_checked_at', float('-inf')):
+                unified_lambda.spool_ingest_record(picture_record('d'))
+            invoke.assert_called_once()
+
+class TestMaintenance(LocalTableTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for batch in range(6):
+            iceberg_setup.write_picture_records([picture_record(f'{batch}-{i}') for i in range(3)], f'batch-{batch}')
+
+    def table_files(self):
+        table = self.catalog.load_table(iceberg_setup.PICTURES_TABLE_IDENTIFIER)
+        return sorted(path for path, _ in iceberg_setup.list_table_files(table.location()))
+
+    def test_dry_run_changes_nothing(self):
+        """Test that a dry run reports the work without committing or deleting"""
+        files = self.table_files()
+
+        with patch('iceberg_setup.ICEBERG_SNAPSHOT_RETENTION_HOURS', 0):
+            metrics = iceberg_setup.maintain_pictures_table(dry_run=True)
+
+        self.assertEqual(metrics['compaction']['files_rewritten'], 6)
+        self.assertEqual(metrics['compaction']['files_written'], 0)
+        self.assertEqual(metrics['expiry']['snapshots_expired'], 1)
+        self.assertEqual(metrics['after']['data_files'], 6)
+        self.assertEqual(self.snapshot_count(), 6)
+        self.assertEqual(self.table_files(), files)
+
+    def test_compacts_expires_and_removes_orphans(self):
+        """Test that small files are merged, old snapshots dropped and their files deleted"""
+        with patch('iceberg_setup.ICEBERG_SNAPSHOT_RETENTION_HOURS', 0), \
+                patch('iceberg_setup.ICEBERG_SNAPSHOTS_TO_RETAIN', 1), \
+                patch('iceberg_setup.ICEBERG_ORPHAN_MIN_AGE_HOURS', 0):
+            metrics = iceberg_setup.maintain_pictures_table()
+
+        self.assertEqual(metrics['before']['data_files'], 6)
+        self.assertEqual(metrics['after']['data_files'], 1)
+        self.assertEqual(metrics['expiry']['snapshots_expired'], 6)
+        self.assertEqual(self.snapshot_count(), 1)
+        self.assertEqual(len(self.rows()), 18)
+        self.assertGreater(metrics['orphans']['orphan_files_removed'], 0)
+
+        table = self.catalog.load_table(iceberg_setup.PICTURES_TABLE_IDENTIFIER)
+        self.assertEqual(set(self.table_files()) - iceberg_setup.get_referenced_files(table), set())
+
+    def test_committed_batches_outlive_snapshot_expiry(self):
+        """Test that a batch retried after its snapshot expired is still skipped"""
+        with patch('iceberg_setup.ICEBERG_SNAPSHOT_RETENTION_HOURS', 0), \
+                patch('iceberg_setup.ICEBERG_SNAPSHOTS_TO_RETAIN', 1):
+            iceberg_setup.maintain_pictures_table()
+
+        iceberg_setup.write_picture_records([picture_record('0-0')], 'batch-0')
+
+        self.assertEqual(len(self.rows()), 18)
+        self.assertEqual(self.snapshot_count(), 1)
+
+    def test_recent_unreferenced_files_are_kept(self):
+        """Test that files young enough to belong to an in-flight commit survive"""
+        with patch('iceberg_setup.ICEBERG_SNAPSHOT_RETENTION_HOURS', 0), \
+                patch('iceberg_setup.ICEBERG_SNAPSHOTS_TO_RETAIN', 1):
+            metrics = iceberg_setup.maintain_pictures_table()
+
+        self.assertEqual(metrics['orphans']['orphan_files'], 0)
+        self.assertEqual(len(self.rows()), 18)
+
+class TestPartitioning(LocalTableTestCase):
+
+    def test_appends_are_partitioned_and_sorted(self):
+        """Test that each day gets its own files with names in sort order"""
+        iceberg_setup.write_picture_records([
+            picture_record('c', picture_name='zebra.jpg', picture_date='2024-03-05'),
+            picture_record('a', picture_name='apple.jpg', picture_date='2024-03-05'),
+            picture_record('b', picture_name='mango.jpg', picture_date='2024-03-06')
+        ])
+
+        files = self.data_files()
+        self.assertEqual(len(files), 2)
+        table = self.catalog.load_table(iceberg_setup.PICTURES_TABLE_IDENTIFIER)
+        day_rows = table.scan(row_filter="picture_date = '2024-03-05'").to_arrow()
+        self.assertEqual(day_rows['picture_name'].to_pylist(), ['apple.jpg', 'zebra.jpg'])
+
+    def test_date_filter_prunes_partitions(self):
+        """Test that a date-filtered scan plans only the matching partition's files"""
+        for day in range(1, 6):
+            iceberg_setup.write_picture_records([picture_record(f'p{day}', picture_date=f'2024-03-0{day}')])
+
+        table = self.catalog.load_table(iceberg_setup.PICTURES_TABLE_IDENTIFIER)
+        tasks = list(table.scan(row_filter="picture_date = '2024-03-03'").plan_files())
+
+        self.assertEqual(len(tasks), 1)
+
+class TestQueries(LocalTableTestCase):
+
+    def setUp(self):
+        super().setUp()
+        names = ['beach.jpg', 'birthday.jpg', "o'brien.jpg", 'mountain.jpg', 'sunset_beach.jpg']
+        for day, name in enumerate(names, start=1):
+            iceberg_setup.write_picture_records([
+                picture_record(f'{day}-{i}', picture_name=name, picture_date=f'2024-03-0{day}') for i in range(3)
+            ])
+
+    def test_filters_are_typed_expressions(self):
+        """Test that query parameters become pushable predicates rather than strings"""
+        row_filter = iceberg_setup.build_picture_filter(date_filter='2024-03-01', name_prefix="o'b")
+
+        self.assertEqual(row_filter, And(EqualTo('picture_date', '2024-03-01'), StartsWith('picture_name', "o'b")))
+        self.assertEqual([row['picture_name'] for row in iceberg_setup.query_pictures(name_prefix="o'b")], ["o'brien.jpg"] * 3)
+
+    def test_date_range_and_projection(self):
+        """Test an inclusive date range returning only the selected columns"""
+        rows = iceberg_setup.query_pictures(
+            date_from='2024-03-02', date_to='2024-03-03', selected_fields=('picture_id', 'picture_date')
+        )
+
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(set(rows[0]), {'picture_id', 'picture_date'})
+        self.assertEqual({str(row['picture_date']) for row in rows}, {'2024-03-02', '2024-03-03'})
+
+    def test_limit_stops_reading_files(self):
+        """Test that a limited query reads only as many data files as it needs"""
+        with patch.object(ArrowScan, 'to_record_batches', autospec=True, side_effect=ArrowScan.to_record_batches) as read:
+            rows = iceberg_setup.query_pictures(limit=2)
+
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(read.call_count, 1)
+
+    def test_numeric_ranges_prune_files(self):
+        """Test that size and dimension ranges skip files by their column statistics"""
+        iceberg_setup.write_picture_records([picture_record(
+            'panorama', picture_date='2024-03-01', file_size=8 * 1024 ** 2, image_width=12000, image_height='3000'
+        )])
+        table = self.catalog.load_table(iceberg_setup.PICTURES_TABLE_IDENTIFIER)
+
+        for params in [{'min_file_size': 5 * 1024 ** 2}, {'min_width': 8000}]:
+            with self.subTest(params=params):
+                row_filter = iceberg_setup.build_picture_filter(**params)
+                self.assertEqual(len(list(table.scan(row_filter=row_filter).plan_files())), 1)
+                batches = iceberg_setup.query_picture_batches(row_filter, selected_fields=('picture_id', 'image_height'))
+                self.assertEqual([row for batch in batches for row in batch.to_pylist()], [{'picture_id': 'panorama', 'image_height': 3000}])
+
+    def test_substring_filter_with_projection(self):
+        """Test that a substring match works even when the name is not selected"""
+        batches = list(iceberg_setup.query_picture_batches(selected_fields=('picture_id',), limit=4, name_contains='beach'))
+
+        self.assertEqual(sum(batch.num_rows for batch in batches), 4)
+        self.assertEqual(batches[0].schema.names, ['picture_id'])
+
+class TestPartitionMigration(LocalTableTestCase):
+
+    def create_table(self):
+        # A table as created before partitioning was introduced
+        self.catalog.create_table(iceberg_setup.PICTURES_TABLE_IDENTIFIER, schema=iceberg_setup.PICTURES_SCHEMA)
+
+    def test_dry_run_reports_changes_only(self):
+        """Test that a dry run leaves the spec and sort order alone"""
+        metrics = iceberg_setup.migrate_partitioning(dry_run=True)
+
+        self.assertEqual(metrics['changes'], {'partitioning': True, 'sort_order': True})
+        table = self.catalog.load_table(iceberg_setup.PICTURES_TABLE_IDENTIFIER)
+        self.assertTrue(table.spec().is_unpartitioned())
+
+    def test_migrates_existing_rows_to_partitions(self):
+        """Test that an unpartitioned table is evolved and its rows rewritten by day"""
+        iceberg_setup.write_picture_records([
+            picture_record('a', picture_name='b.jpg', picture_date='2024-03-05'),
+            picture_record('b', picture_name='a.jpg', picture_date='2024-03-05'),
+            picture_record('c', picture_date='2024-03-06')
+        ])
+
+        metrics = iceberg_setup.migrate_partitioning()
+
+        self.assertEqual(metrics['rewrite']['files_rewritten'], 1)
+        table = self.catalog.load_table(iceberg_setup.PICTURES_TABLE_IDENTIFIER)
+        self.assertEqual([field.name for field in table.spec().fields], ['picture_date_day'])
+        self.assertEqual(table.sort_order().fields[0].source_id, 2)
+        files = self.data_files()
+        self.assertEqual(len(files), 2)
+        self.assertTrue(all(data_file.spec_id == table.spec().spec_id for data_file in files))
+        self.assertEqual(len(self.rows()), 3)
+
+        self.assertEqual(iceberg_setup.migrate_partitioning()['changes'], {'partitioning': False, 'sort_order': False})
+
+    def test_switches_granularity(self):
+        """Test that a day-partitioned table can be moved to month partitions"""
+        iceberg_setup.migrate_partitioning()
+        iceberg_setup.write_picture_records([picture_record('a', picture_date='2024-03-05'), picture_record('b', picture_date='2024-03-06')])
+
+        with patch('iceberg_setup.ICEBERG_PARTITION_GRANULARITY', 'month'):
+            iceberg_setup.migrate_partitioning()
+
+        table = self.catalog.load_table(iceberg_setup.PICTURES_TABLE_IDENTIFIER)
+        self.assertIn('picture_date_month', [field.name for field in table.spec().fields])
+        self.assertEqual(len(self.data_files()), 1)
+
+    def test_compaction_keeps_old_and_new_spec_rows_of_a_partition(self):
+        """Test that rewriting old-spec rows and small files of the same day keeps every row"""
+        iceberg_setup.write_picture_records([picture_record('old', picture_date='2024-03-05')])
+        table = self.catalog.load_table(iceberg_setup.PICTURES_TABLE_IDENTIFIER)
+        with table.update_spec() as update:
+            update.add_field('picture_date', DayTransform(), iceberg_setup.get_partition_field_name())
+        iceberg_setup.get_pictures_table(refresh=True)
+        for batch in range(iceberg_setup.ICEBERG_COMPACTION_MIN_FILES):
+            iceberg_setup.write_picture_records([picture_record(f'new-{batch}', picture_date='2024-03-05')])
+
+        metrics = iceberg_setup.compact_data_files()
+
+        self.assertEqual(metrics['partitions'], 2)
+        self.assertEqual(metrics['files_written'], 2)
+        self.assertEqual(len({data_file.file_path for data_file in self.data_files()}), 2)
+        self.assertEqual([row['picture_id'] for row in self.rows()], ['new-0', 'new-1', 'new-2', 'new-3', 'new-4', 'old'])
+
+class TestSchemaMigration(LocalTableTestCase):
+
+    def create_table(self):
+        # A table from before the rating and metadata columns, with sizes and dimensions as strings
+        self.catalog.create_table(
+            iceberg_setup.PICTURES_TABLE_IDENTIFIER,
+            schema=Schema(*iceberg_setup.PICTURES_SCHEMA.fields[:5], *[
+                NestedField(field.field_id, field.name, StringType(), required=False)
+                for field in iceberg_setup.PICTURES_SCHEMA.fields[5:8]
+            ]),
+            partition_spec=iceberg_setup.get_pictures_partition_spec()
+        )
+
+    def test_dry_run_reports_changes_only(self):
+        """Test that a dry run reports the column changes without making them"""
+        iceberg_setup.write_picture_records([picture_record('a')])
+
+        result = iceberg_setup.migrate_schema(dry_run=True)
+
+        self.assertEqual(result, {
+            'columns_added': ['rating', 'metadata'],
+            'columns_retyped': ['file_size', 'image_width', 'image_height'],
+            'files_rewritten': 0
+        })
+        self.assertEqual(self.rows()[0]['file_size'], '1000')
+
+    def test_adds_columns_and_converts_strings(self):
+        """Test that string sizes become numbers in every row and the migration is idempotent"""
+        iceberg_setup.write_picture_records([picture_record('a', image_width='4000', image_height='3000')])
+        iceberg_setup.write_picture_records([picture_record('b', file_size=' 2048 ', image_width='', image_height='n/a')])
+
+        result = iceberg_setup.migrate_schema()
+
+        self.assertEqual(result['files_rewritten'], 2)
+        table = self.catalog.load_table(iceberg_setup.PICTURES_TABLE_IDENTIFIER)
+        self.assertEqual(
+            [(field.name, field.field_type) for field in table.schema().fields if field.name in ('file_size', 'image_width')],
+            [('file_size', LongType()), ('image_width', IntegerType())]
+        )
+        self.assertEqual(
+            [(row['file_size'], row['image_width'], row['image_height'], row['rating']) for row in self.rows()],
+            [(1000, 4000, 3000, None), (2048, None, None, None)]
+        )
+        self.assertEqual(self.snapshot_count(), 3)
+
+        self.assertEqual(iceberg_setup.migrate_schema(), {'columns_added': [], 'columns_retyped': [], 'files_rewritten': 0})
+        iceberg_setup.write_picture_records([picture_record('c', rating=2, image_width='8000')])
+        self.assertEqual(self.rows()[2]['image_width'], 8000)
+
+class TestPyicebergCompatibility(LocalTableTestCase):
+    """Pins the private pyiceberg behaviour the compatibility helpers in iceberg_setup rely on"""
+
+    def table(self):
+        return self.catalog.load_table(iceberg_setup.PICTURES_TABLE_IDENTIFIER)
+
+    def test_helpers_are_checked_against_pinned_version(self):
+        """Test that pyiceberg is the version the helpers were written for; re-check them on upgrade"""
+        self.assertTrue(pyiceberg.__version__.startswith('0.10.'), pyiceberg.__version__)
+
+    def test_shared_counter_names_files_apart(self):
+        """Test that files written by separate calls in one commit never share a name"""
+        table = self.table()
+        rows = iceberg_setup.get_picture_arrow_table([picture_record('a')], table.schema())
+        counter = itertools.count()
+
+        with table.transaction() as transaction:
+            with transaction.update_snapshot().overwrite() as overwrite:
+                written = [iceberg_setup.write_data_files(table.metadata, table.io, overwrite, rows, counter) for _ in range(2)]
+
+        self.assertEqual(written, [1, 1])
+        self.assertEqual(len({data_file.file_path for data_file in self.data_files()}), 2)
+
+    def test_set_default_sort_order(self):
+        """Test that a new sort order becomes the default in the transaction's commit"""
+        table = self.table()
+        sort_order = SortOrder(SortField(source_id=2, transform=IdentityTransform(), direction=SortDirection.DESC))
+
+        with table.transaction() as transaction:
+            iceberg_setup.set_default_sort_order(transaction, table, sort_order)
+
+        fields = self.table().sort_order().fields
+        self.assertEqual([(field.source_id, field.direction) for field in fields], [(2, SortDirection.DESC)])
+
+    def test_expiries_do_not_share_snapshot_ids(self):
+        """Test that each expiry removes only its own snapshots"""
+        for picture_id in ('a', 'b', 'c'):
+            iceberg_setup.write_picture_records([picture_record(picture_id)])
+        snapshot_ids = [snapshot.snapshot_id for snapshot in self.table().snapshots()]
+
+        iceberg_setup.expire_snapshot_ids(self.table(), snapshot_ids[:1])
+        iceberg_setup.expire_snapshot_ids(self.table(), snapshot_ids[1:2])
+
+        self.assertEqual([snapshot.snapshot_id for snapshot in self.table().snapshots()], snapshot_ids[2:])
+
+class TestIcebergListing(LocalTableTestCase):
+
+    def setUp(self):
+        super().setUp()
+        for name, value in {'s3_client': FakeS3(), 'PICTURES_LISTING_BACKEND': 'iceberg'}.items():
+            patcher = patch.object(unified_lambda, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        iceberg_setup.write_picture_records([
+            picture_record('a', picture_name='Beach.jpg', picture_date='2024-03-01', rating=4,
+                           upload_timestamp='2024-03-05T10:00:00+00:00',
+                           metadata=json.dumps({'original-name': 'Beach.jpg', 'width': '4000', 'height': '3000'})),
+            picture_record('b', picture_name='dunes.jpg', picture_date='2024-03-07', rating=2,
+                           upload_timestamp='2024-03-07T10:00:00+00:00'),
+            picture_record('c', picture_name='beach-2.jpg', picture_date='2024-02-20', rating=4,
+                           upload_timestamp='2024-03-06T10:00:00+00:00',
+                           metadata=json.dumps({'original-name': 'beach-2.jpg', 'comments': '[{"text": "nice"}]'}))
+        ])
+
+    def list_pictures(self, **params):
+        response = unified_lambda.get_pictures({'queryStringParameters': params})
+        return response['statusCode'], json.loads(response['body'])
+
+    def test_lists_all_pictures_newest_first(self):
+        """Test that without a limit every picture is listed like the S3 listing"""
+        status, body = self.list_pictures()
+
+        self.assertEqual(status, 200)
+        self.assertEqual([picture['name'] for picture in body['pictures']], ['dunes.jpg', 'beach-2.jpg', 'Beach.jpg'])
+        self.assertEqual((body['count'], body['total'], body['nextOffset']), (3, 3, None))
+        beach = body['pictures'][2]
+        self.assertEqual((beach['date'], beach['rating'], beach['width']), ('2024-03-05T10:00:00+00:00', 4, 4000))
+        self.assertEqual(beach['url'], 'https://example.com/pictures/a.jpg')
+        self.assertEqual(body['pictures'][1]['comments'], [{'text': 'nice'}])
+
+    def test_sorts_and_pages(self):
+        """Test that pages follow the requested order without overlapping"""
+        _, first = self.list_pictures(sort='rating', limit='2')
+        _, second = self.list_pictures(sort='rating', limit='2', offset=str(first['nextOffset']))
+
+        self.assertEqual([picture['name'] for picture in first['pictures']], ['beach-2.jpg', 'Beach.jpg'])
+        self.assertEqual([picture['name'] for picture in second['pictures']], ['dunes.jpg'])
+        self.assertEqual((first['total'], first['nextOffset'], second['nextOffset']), (3, 2, None))
+
+        _, captured = self.list_pictures(sort='captured')
+        self.assertEqual([picture['name'] for picture in captured['pictures']], ['dunes.jpg', 'Beach.jpg', 'beach-2.jpg'])
+
+    def test_filters(self):
+        """Test the date range, minimum rating and name filters"""
+        _, body = self.list_pictures(**{'from': '2024-03-01', 'to': '2024-03-06', 'minRating': '3'})
+        self.assertEqual([picture['name'] for picture in body['pictures']], ['Beach.jpg'])
+
+        _, body = self.list_pictures(name='each', sort='name')
+        self.assertEqual([picture['name'] for picture in body['pictures']], ['Beach.jpg', 'beach-2.jpg'])
+
+    def test_duplicate_rows_listed_once(self):
+        """Test that a picture with two rows is listed and counted once"""
+        iceberg_setup.write_picture_records([picture_record('b', picture_name='dunes.jpg', picture_date='2024-03-07')])
+
+        _, body = self.list_pictures(sort='name')
+
+        self.assertEqual([picture['name'] for picture in body['pictures']], ['Beach.jpg', 'beach-2.jpg', 'dunes.jpg'])
+        self.assertEqual(body['total'], 3)
+
+    def test_listing_starts_aged_flush(self):
+        """Test that reading the listing starts a flush of an aged spool"""
+        stale = datetime.now(timezone.utc) - timedelta(seconds=unified_lambda.INGEST_MAX_AGE_SECONDS + 1)
+        unified_lambda.s3_client.add_object('ingest/pending/d/0.json', json.dumps(picture_record('d')), LastModified=stale)
+
+        with patch('unified_lambda.ICEBERG_INGEST_ENABLED', True), \
+                patch('unified_lambda.ingest_checked_at', float('-inf')), \
+                patch('unified_lambda.invoke_ingest_worker') as invoke:
+            status, body = self.list_pictures()
+
+        self.assertEqual((status, body['total']), (200, 4))
+        invoke.assert_called_once()
+
+    def test_deleted_picture_is_not_listed_before_the_flush(self):
+        """Test that a deletion still in the spool hides the picture's row"""
+        fake_s3 = unified_lambda.s3_client
+        fake_s3.add_object('pictures/a.jpg', b'jpeg', {'original-name': 'Beach.jpg'})
+
+        with patch('unified_lambda.ICEBERG_INGEST_ENABLED', True), patch('unified_lambda.invoke_ingest_worker') as invoke:
+            response = unified_lambda.lambda_handler({
+                'requestContext': {'http': {'method': 'DELETE'}},
+                'rawPath': '/api/pictures',
+                'body': json.dumps({'pictures': ['Beach.jpg']})
+            }, {})
+            status, body = self.list_pictures()
+
+        self.assertEqual(response['statusCode'], 200)
+        invoke.assert_not_called()
+        self.assertEqual([picture['name'] for picture in body['pictures']], ['dunes.jpg', 'beach-2.jpg'])
+        self.assertEqual(body['total'], 2)
+        self.assertEqual(len(self.rows()), 3)
+
+    def test_spooled_changes_are_filtered_and_sorted_with_the_table(self):
+        """Test that spooled inserts and updates replace rows and obey the listing's filters and order"""
+        fake_s3 = unified_lambda.s3_client
+        for picture_id, fields in [
+            ('b', {'picture_name': 'dunes.jpg', 'picture_date': '2024-03-07', 'rating': 5}),
+            ('d', {'picture_name': 'beach-3.jpg', 'picture_date': '2024-03-08', 'rating': 5}),
+            ('e', {'picture_name': 'forest.jpg', 'picture_date': '2024-03-08', 'rating': 5})
+        ]:
+            fake_s3.add_object(f'ingest/pending/{picture_id}/1.json', json.dumps(picture_record(picture_id, **fields)))
+        # Only the latest change of a picture counts
+        fake_s3.add_object('ingest/pending/e/2.json', json.dumps(picture_record('e', picture_name='forest.jpg', rating=1)))
+
+        with patch('unified_lambda.ICEBERG_INGEST_ENABLED', True), patch('unified_lambda.invoke_ingest_worker'):
+            _, rated = self.list_pictures(sort='rating', limit='2')
+            _, beaches = self.list_pictures(name='beach', minRating='4', sort='name')
+
+        # Ties on rating and upload time fall back to the picture id
+        self.assertEqual([picture['name'] for picture in rated['pictures']], ['dunes.jpg', 'beach-3.jpg'])
+        self.assertEqual((rated['total'], rated['nextOffset']), (5, 2))
+        self.assertEqual([picture['name'] for picture in beaches['pictures']], ['beach-2.jpg', 'beach-3.jpg'])
+        self.assertEqual(beaches['pictures'][1]['rating'], 5)
+
+    def test_invalid_parameters(self):
+        """Test that bad parameters are rejected with 400"""
+        for params in [{'sort': 'size'}, {'limit': '0'}, {'offset': '-1'}, {'from': 'March'}]:
+            with self.subTest(params=params):
+                self.assertEqual(self.list_pictures(**params)[0], 400)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
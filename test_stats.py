@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+
+"""
+Test script for gallery statistics functionality
+"""
+
+import unittest
+from unittest.mock import Mock, patch
+import json
+from datetime import datetime, timezone
+from fake_s3 import FakeS3
+from unified_lambda import lambda_handler, update_json_object, record_activity, record_stats_change, fold_activity, STATS_KEY, STATS_SNAPSHOT_KEY
+
+def picture(key, size, metadata, day=1):
+    # Ratings and comments copied the object since, so only upload_date still holds the upload day
+    return {
+        'Key': key, 'Body': bytes(size), 'Metadata': {'upload_date': datetime(2024, 3, day).isoformat(), **metadata},
+        'LastModified': datetime(2024, 6, 1, tzinfo=timezone.utc)
+    }
+
+def gallery(*pictures):
+    fake_s3 = FakeS3()
+    for item in pictures:
+        fake_s3.add_object(**item)
+    return fake_s3
+
+def stored_stats(fake_s3):
+    return json.loads(fake_s3.objects[STATS_KEY])
+
+class TestGalleryStats(unittest.TestCase):
+
+    def setUp(self):
+        # Snapshots are cached by ETag, and every FakeS3 starts its versions at one
+        for name in ('stats_snapshot_etag', 'stats_refresh_started_at'):
+            patcher = patch(f'unified_lambda.{name}', None)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def stats_event(self, **params):
+        return {
+            'requestContext': {'http': {'method': 'GET'}},
+            'rawPath': '/api/stats',
+            'queryStringParameters': params or None
+        }
+
+    def test_first_request_reconciles(self):
+        """Test that missing counters are built by recounting the bucket once"""
+        fake_s3 = gallery(
+            picture('pictures/a.jpg', 100, {'rating': '4', 'comments': json.dumps([{'text': 'nice'}])}, day=2),
+            picture('pictures/b.png', 50, {'rating': '2'}, day=5),
+            picture('pictures/c.jpg', 25, {}),
+            picture('pictures/notes.txt', 999, {})
+        )
+
+        with patch('unified_lambda.s3_client', fake_s3):
+            response = lambda_handler(self.stats_event(), {})
+
+        self.assertEqual(response['statusCode'], 200)
+        body = json.loads(response['body'])
+        self.assertEqual(body['totalPictures'], 3)
+        self.assertEqual(body['totalStorage'], 175)
+        self.assertEqual(body['ratedPictures'], 2)
+        self.assertEqual(body['averageRating'], 3)
+        self.assertEqual(body['totalComments'], 1)
+        self.assertEqual(body['lastUpload'], '2024-03-05T00:00:00+00:00')
+        self.assertIn('reconciled', stored_stats(fake_s3))
+
+    def test_stats_read_is_constant_time(self):
+        """Test that maintained counters are served without listing the bucket"""
+        fake_s3 = FakeS3()
+        fake_s3.add_object(STATS_KEY, json.dumps({
+            'totalPictures': 7, 'totalStorage': 700, 'ratingSum': 9, 'ratedPictures': 3,
+            'totalComments': 2, 'lastUpload': '2024-01-01T00:00:00+00:00'
+        }))
+        fake_s3.get_paginator = Mock(side_effect=AssertionError('listed the bucket'))
+
+        with patch('unified_lambda.s3_client', fake_s3):
+            response = lambda_handler(self.stats_event(), {})
+
+        body = json.loads(response['body'])
+        self.assertEqual(body['totalPictures'], 7)
+        self.assertEqual(body['averageRating'], 3)
+
+    def test_update_retries_after_conflicting_write(self):
+        """Test that a concurrent update is re-read rather than overwritten"""
+        fake_s3 = FakeS3()
+        fake_s3.add_object('stats/counter.json', b'{"count": 1}')
+
+        def concurrent_update():
+            fake_s3.put_object(Bucket='bucket', Key='stats/counter.json', Body=b'{"count": 10}')
+        fake_s3.before_put = concurrent_update
+
+        def increment(value):
+            value['count'] += 1
+            return value
+
+        with patch('unified_lambda.s3_client', fake_s3), patch('unified_lambda.time.sleep'):
+            result = update_json_object('stats/counter.json', increment)
+
+        self.assertEqual(result, {'count': 11})
+        self.assertEqual(json.loads(fake_s3.objects['stats/counter.json']), {'count': 11})
+
+    def test_update_skips_missing_object_without_default(self):
+        """Test that counters are not started from zero before the first reconciliation"""
+        fake_s3 = FakeS3()
+
+        with patch('unified_lambda.s3_client', fake_s3):
+            self.assertIsNone(update_json_object(STATS_KEY, lambda value: value))
+
+        self.assertNotIn(STATS_KEY, fake_s3.objects)
+
+    def test_rate_and_comment_update_counters(self):
+        """Test that rating and commenting adjust the counters they affect"""
+        fake_s3 = gallery(picture('pictures/a.jpg', 100, {'original-name': 'a.jpg', 'rating': '0'}))
+        fake_s3.add_object(STATS_KEY, json.dumps({
+            'totalPictures': 1, 'totalStorage': 100, 'ratingSum': 0, 'ratedPictures': 0,
+            'totalComments': 0, 'lastUpload': '2024-03-01T00:00:00+00:00'
+        }))
+
+        with patch('unified_lambda.s3_client', fake_s3):
+            lambda_handler({
+                'requestContext': {'http': {'method': 'POST'}},
+                'rawPath': '/api/pictures/rate',
+                'body': json.dumps({'picture': 'a.jpg', 'rating': 4})
+            }, {})
+            lambda_handler({
+                'requestContext': {'http': {'method': 'POST'}},
+                'rawPath': '/api/pictures/comment',
+                'body': json.dumps({'picture': 'a.jpg', 'author': 'Sam', 'text': 'Great shot'})
+            }, {})
+
+        stats = stored_stats(fake_s3)
+        self.assertEqual((stats['ratingSum'], stats['ratedPictures']), (4, 1))
+        self.assertEqual(stats['totalComments'], 1)
+
+    def test_repeated_upload_completion_is_counted_once(self):
+        """Test that re-posting a finalized key neither recounts nor reprocesses the picture"""
+        fake_s3 = gallery(picture('pictures/a.jpg', 100, {'original-name': 'a.jpg'}))
+        fake_s3.add_object(STATS_KEY, json.dumps({
+            'totalPictures': 0, 'totalStorage': 0, 'ratingSum': 0, 'ratedPictures': 0,
+            'totalComments': 0, 'lastUpload': None
+        }))
+        complete = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures/upload-complete',
+            'body': json.dumps({'key': 'pictures/a.jpg'})
+        }
+
+        with patch('unified_lambda.s3_client', fake_s3), \
+                patch('unified_lambda.process_image', return_value={}) as process_image:
+            for _ in range(3):
+                self.assertEqual(lambda_handler(complete, {})['statusCode'], 200)
+
+        stats = stored_stats(fake_s3)
+        self.assertEqual((stats['totalPictures'], stats['totalStorage']), (1, 100))
+        self.assertEqual(fake_s3.metadata['pictures/a.jpg']['finalized'], 'true')
+        self.assertEqual(process_image.call_count, 1)
+
+    def test_reconcile_event(self):
+        """Test that the reconciliation event replaces drifted counters"""
+        fake_s3 = gallery(picture('pictures/a.jpg', 100, {}))
+        fake_s3.add_object(STATS_KEY, json.dumps({
+            'totalPictures': 40, 'totalStorage': 1, 'ratingSum': 0, 'ratedPictures': 0,
+            'totalComments': 0, 'lastUpload': None
+        }))
+
+        with patch('unified_lambda.s3_client', fake_s3):
+            lambda_handler({'reconcile_stats': True}, {})
+
+        self.assertEqual(stored_stats(fake_s3)['totalPictures'], 1)
+        self.assertEqual(stored_stats(fake_s3)['totalStorage'], 100)
+
+    def test_reconcile_keeps_changes_made_during_the_scan(self):
+        """Test that counter updates recorded while the bucket is recounted are not overwritten"""
+        fake_s3 = gallery(picture('pictures/a.jpg', 100, {'rating': '4'}), picture('pictures/b.jpg', 50, {}))
+        fake_s3.add_object(STATS_KEY, json.dumps({
+            'totalPictures': 40, 'totalStorage': 1, 'ratingSum': 4, 'ratedPictures': 1,
+            'totalComments': 0, 'lastUpload': None
+        }))
+        # The snapshot is written after the scan, just before the counters are replaced
+        fake_s3.before_put = lambda: record_stats_change(rating_sum=5, rated_pictures=1, comments=1)
+
+        with patch('unified_lambda.s3_client', fake_s3):
+            lambda_handler({'reconcile_stats': True}, {})
+
+        stats = stored_stats(fake_s3)
+        self.assertEqual((stats['totalPictures'], stats['totalStorage']), (2, 150))
+        self.assertEqual((stats['ratingSum'], stats['ratedPictures'], stats['totalComments']), (9, 2, 1))
+
+    def test_detailed_stats(self):
+        """Test distributions, percentiles and top lists from the reconciled snapshot"""
+        fake_s3 = gallery(
+            picture('pictures/a.jpg', 100, {'original-name': 'a.jpg', 'rating': '5', 'comments': json.dumps([{}, {}])}, day=4),
+            picture('pictures/b.jpg', 300, {'original-name': 'b.jpg', 'rating': '3'}, day=5),
+            picture('pictures/c.jpg', 200, {'original-name': 'c.jpg', 'comments': json.dumps([{}])}, day=11),
+            picture('pictures/d.jpg', 400, {'original-name': 'd.jpg', 'rating': '3'}, day=11)
+        )
+
+        with patch('unified_lambda.s3_client', fake_s3):
+            response = lambda_handler(self.stats_event(detail='full', period='week'), {})
+
+        self.assertIn(STATS_SNAPSHOT_KEY, fake_s3.objects)
+        detail = json.loads(response['body'])['detail']
+        self.assertEqual(detail['pictures'], 4)
+        self.assertEqual(detail['ratingHistogram'], {'0': 1, '1': 0, '2': 0, '3': 2, '4': 0, '5': 1})
+        self.assertEqual(detail['sizePercentiles']['p50'], 250)
+        self.assertEqual(detail['sizeMean'], 250)
+        self.assertEqual(detail['commentHistogram'], {'0': 2, '1': 1, '2': 1})
+        # 2024-03-04 and 2024-03-11 are Mondays
+        self.assertEqual(detail['uploadsPerPeriod']['counts'], {'2024-03-04': 2, '2024-03-11': 2})
+        self.assertEqual([item['name'] for item in detail['top']['rated']], ['a.jpg', 'b.jpg', 'd.jpg'])
+        self.assertEqual([item['name'] for item in detail['top']['commented']], ['a.jpg', 'c.jpg'])
+        self.assertEqual(detail['top']['largest'][0], {'key': 'pictures/d.jpg', 'name': 'd.jpg', 'value': 400})
+
+    def test_detailed_stats_reuses_loaded_snapshot(self):
+        """Test that an unchanged snapshot is not downloaded again"""
+        fake_s3 = gallery(picture('pictures/a.jpg', 100, {'rating': '4'}, day=2))
+
+        with patch('unified_lambda.s3_client', fake_s3):
+            lambda_handler(self.stats_event(detail='full'), {})
+            counted = Mock(wraps=fake_s3.get_object)
+            fake_s3.get_object = counted
+            response = lambda_handler(self.stats_event(detail='full', period='month'), {})
+
+        keys = [call.kwargs['Key'] for call in counted.call_args_list]
+        self.assertNotIn(STATS_SNAPSHOT_KEY, keys)
+        detail = json.loads(response['body'])['detail']
+        self.assertEqual(detail['uploadsPerPeriod']['counts'], {'2024-03': 1})
+
+    def test_stale_snapshot_is_rebuilt(self):
+        """Test that detailed stats report their age and a stale snapshot starts a recount"""
+        fake_s3 = gallery(picture('pictures/a.jpg', 100, {'rating': '4'}, day=2))
+
+        with patch('unified_lambda.s3_client', fake_s3):
+            body = json.loads(lambda_handler(self.stats_event(detail='full'), {})['body'])
+            self.assertEqual(body['detail']['pictures'], 1)
+            self.assertLess(body['detailAgeSeconds'], 60)
+
+            fake_s3.add_object(**picture('pictures/b.jpg', 50, {}, day=3))
+            fake_s3.modified[STATS_SNAPSHOT_KEY] = datetime(2024, 3, 3, tzinfo=timezone.utc)
+            body = json.loads(lambda_handler(self.stats_event(detail='full'), {})['body'])
+
+        self.assertEqual(body['detail']['pictures'], 2)
+        self.assertLess(body['detailAgeSeconds'], 60)
+
+    def test_rejects_unknown_period(self):
+        """Test that an unsupported period is a client error"""
+        with patch('unified_lambda.s3_client', FakeS3()):
+            response = lambda_handler(self.stats_event(detail='full', period='hour'), {})
+
+        self.assertEqual(response['statusCode'], 400)
+
+class TestTimeline(unittest.TestCase):
+
+    def timeline_event(self, **params):
+        return {
+            'requestContext': {'http': {'method': 'GET'}},
+            'rawPath': '/api/stats/timeline',
+            'queryStringParameters': params
+        }
+
+    def rollup(self, fake_s3, key):
+        rollup = json.loads(fake_s3.objects[key])
+        rollup.pop('batch')
+        return rollup
+
+    def test_activity_counts_into_each_granularity(self):
+        """Test that spooled activity is counted at once and folded into its day, month and year rollups"""
+        fake_s3 = FakeS3()
+        when = datetime(2024, 3, 5, 12, tzinfo=timezone.utc)
+
+        with patch('unified_lambda.s3_client', fake_s3):
+            record_activity(uploads=1, when=when)
+            record_activity(comments=1, when=when)
+            self.assertFalse([key for key in fake_s3.objects if not key.startswith('rollups/pending/')])
+            response = lambda_handler(self.timeline_event(granularity='month', **{'from': '2024-03', 'to': '2024-03'}), {})
+            self.assertEqual(fold_activity(), {'folded': 2, 'batches': 1})
+
+        expected = {'uploads': 1, 'ratings': 0, 'comments': 1}
+        self.assertEqual(json.loads(response['body'])['timeline'], [{'period': '2024-03', **expected}])
+        self.assertEqual(self.rollup(fake_s3, 'rollups/day/2024-03.json'), {'2024-03-05': expected})
+        self.assertEqual(self.rollup(fake_s3, 'rollups/month/2024.json'), {'2024-03': expected})
+        self.assertEqual(self.rollup(fake_s3, 'rollups/year.json'), {'2024': expected})
+        self.assertFalse([key for key in fake_s3.objects if key.startswith('rollups/pending/')])
+
+    def test_interrupted_fold_is_not_counted_twice(self):
+        """Test that a fold which stopped after updating the rollups finishes its batch without re-adding it"""
+        fake_s3 = FakeS3()
+
+        with patch('unified_lambda.s3_client', fake_s3):
+            record_activity(ratings=1, when=datetime(2024, 3, 5, tzinfo=timezone.utc))
+            with patch.object(fake_s3, 'delete_objects', side_effect=RuntimeError('timed out')):
+                with self.assertRaises(RuntimeError):
+                    fold_activity()
+            record_activity(ratings=1, when=datetime(2024, 3, 6, tzinfo=timezone.utc))
+            fold_activity()
+
+        self.assertEqual(self.rollup(fake_s3, 'rollups/month/2024.json'), {'2024-03': {'uploads': 0, 'ratings': 2, 'comments': 0}})
+
+    def test_timeline_reads_only_requested_partitions(self):
+        """Test that a range is served from the rollups covering it, with empty periods filled in"""
+        fake_s3 = FakeS3()
+        fake_s3.add_object('rollups/day/2024-02.json', json.dumps({'2024-02-28': {'uploads': 2, 'ratings': 1, 'comments': 0}}))
+        fake_s3.add_object('rollups/day/2024-03.json', json.dumps({'2024-03-01': {'uploads': 1, 'ratings': 0, 'comments': 3}}))
+        fake_s3.get_object = Mock(wraps=fake_s3.get_object)
+
+        with patch('unified_lambda.s3_client', fake_s3):
+            response = lambda_handler(self.timeline_event(granularity='day', **{'from': '2024-02-28', 'to': '2024-03-02'}), {})
+
+        self.assertEqual(response['statusCode'], 200)
+        timeline = json.loads(response['body'])['timeline']
+        self.assertEqual([entry['period'] for entry in timeline], ['2024-02-28', '2024-02-29', '2024-03-01', '2024-03-02'])
+        self.assertEqual([entry['uploads'] for entry in timeline], [2, 0, 1, 0])
+        self.assertEqual(timeline[2]['comments'], 3)
+        keys = [call.kwargs['Key'] for call in fake_s3.get_object.call_args_list]
+        self.assertEqual(keys, ['rollups/day/2024-02.json', 'rollups/day/2024-03.json'])
+
+    def test_month_timeline_defaults_to_last_year(self):
+        """Test that a month timeline without bounds covers the twelve months up to to"""
+        with patch('unified_lambda.s3_client', FakeS3()):
+            response = lambda_handler(self.timeline_event(granularity='month', to='2024-03'), {})
+
+        body = json.loads(response['body'])
+        self.assertEqual((body['from'], body['to']), ('2023-04', '2024-03'))
+        self.assertEqual(len(body['timeline']), 12)
+
+    def test_rejects_invalid_ranges(self):
+        """Test that malformed, reversed and oversized ranges are client errors"""
+        cases = [
+            {'granularity': 'hour'},
+            {'from': 'March'},
+            {'from': '2024-03-02', 'to': '2024-03-01'},
+            {'granularity': 'day', 'from': '2020-01-01', 'to': '2024-01-01'}
+        ]
+        for params in cases:
+            with self.subTest(params=params), patch('unified_lambda.s3_client', FakeS3()):
+                self.assertEqual(lambda_handler(self.timeline_event(**params), {})['statusCode'], 400)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
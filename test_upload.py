@@ -0,0 +1,1010 @@
+#!/usr/bin/env python3
+
+"""
+Test script for picture upload functionality
+"""
+
+import unittest
+from unittest.mock import ANY, patch
+import json
+import base64
+import hashlib
+import io
+import random
+import unified_lambda
+from datetime import datetime, timezone
+from botocore.exceptions import ClientError
+from unified_lambda import lambda_handler, get_thumbnail_key, process_image, spool_base64, Base64Reader, BKTree, compute_dhash, hamming_distance, BLURHASH_CHARACTERS
+
+try:
+    from PIL import Image, ExifTags
+except ImportError:
+    Image = None
+
+class TestDirectUploads(unittest.TestCase):
+
+    @patch('unified_lambda.s3_client')
+    def test_create_upload_url(self, mock_s3):
+        """Test that the presigned POST signs the picture metadata and size limit"""
+        mock_s3.generate_presigned_post.return_value = {
+            'url': 'https://bucket.s3.amazonaws.com/',
+            'fields': {'key': 'pictures/new.jpg', 'policy': 'abc'}
+        }
+
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures/upload-url',
+            'body': json.dumps({'name': 'sunset.jpg', 'contentType': 'image/jpeg', 'size': 1024})
+        }
+
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 200)
+        body = json.loads(response['body'])
+        self.assertEqual(body['url'], 'https://bucket.s3.amazonaws.com/')
+        self.assertTrue(body['key'].startswith('pictures/'))
+        self.assertTrue(body['key'].endswith('.jpg'))
+
+        kwargs = mock_s3.generate_presigned_post.call_args[1]
+        self.assertEqual(kwargs['Key'], body['key'])
+        self.assertEqual(kwargs['Fields']['x-amz-meta-original-name'], 'sunset.jpg')
+        self.assertIn({'Content-Type': 'image/jpeg'}, kwargs['Conditions'])
+        self.assertTrue(any(c[0] == 'content-length-range' for c in kwargs['Conditions'] if isinstance(c, list)))
+
+    def test_create_upload_url_rejects_non_images(self):
+        """Test that only image content types can be uploaded"""
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures/upload-url',
+            'body': json.dumps({'name': 'notes.txt', 'contentType': 'text/plain'})
+        }
+
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 400)
+
+    @patch('unified_lambda.s3_client')
+    def test_complete_upload(self, mock_s3):
+        """Test finalizing a direct upload"""
+        mock_s3.generate_presigned_url.return_value = 'https://example.com/picture'
+        mock_s3.head_object.return_value = {
+            'ContentLength': 1024,
+            'Metadata': {'original-name': 'sunset.jpg', 'rating': '0'}
+        }
+
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures/upload-complete',
+            'body': json.dumps({'key': 'pictures/20240101_123456_abc123.jpg'})
+        }
+
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 200)
+        body = json.loads(response['body'])
+        self.assertEqual(body['key'], 'pictures/20240101_123456_abc123.jpg')
+        self.assertEqual(body['original_name'], 'sunset.jpg')
+        self.assertEqual(body['picture']['name'], 'sunset.jpg')
+        self.assertEqual(body['picture']['url'], 'https://example.com/picture')
+
+    @patch('unified_lambda.s3_client')
+    def test_complete_upload_missing_object(self, mock_s3):
+        """Test finalizing an upload that never reached S3"""
+        mock_s3.head_object.side_effect = Exception('Not Found')
+
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures/upload-complete',
+            'body': json.dumps({'key': 'pictures/missing.jpg'})
+        }
+
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 404)
+
+    @patch('unified_lambda.UPLOAD_CONCURRENCY', 7)
+    def test_client_upload_concurrency_is_configurable(self):
+        """Test that the upload queue concurrency is injected into the served script"""
+        response = lambda_handler({'rawPath': '/script.js'}, {})
+
+        self.assertIn('const UPLOAD_CONCURRENCY = 7;', response['body'])
+
+class TestUploadDedupe(unittest.TestCase):
+
+    def upload_event(self, name, image_bytes):
+        return {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures',
+            'body': json.dumps({
+                'name': name,
+                'data': base64.b64encode(image_bytes).decode('utf-8'),
+                'contentType': 'image/jpeg'
+            })
+        }
+
+    @patch('unified_lambda.s3_client')
+    def test_new_upload_is_indexed_by_hash(self, mock_s3):
+        """Test that a new upload is stored and added to the hash index"""
+        mock_s3.generate_presigned_url.return_value = 'https://example.com/picture'
+        mock_s3.get_object.side_effect = Exception('NoSuchKey')
+
+        response = lambda_handler(self.upload_event('sunset.jpg', b'fake_jpg_data'), {})
+
+        self.assertEqual(response['statusCode'], 200)
+        body = json.loads(response['body'])
+        self.assertFalse(body['deduplicated'])
+
+        digest = hashlib.sha256(b'fake_jpg_data').hexdigest()
+        puts = {call[1]['Key']: call[1] for call in mock_s3.put_object.call_args_list}
+        self.assertEqual(puts[body['key']]['Metadata']['sha256'], digest)
+        self.assertEqual(json.loads(puts[f'hashes/{digest}.json']['Body'])['key'], body['key'])
+
+    @patch('unified_lambda.s3_client')
+    def test_duplicate_upload_becomes_reference(self, mock_s3):
+        """Test that uploading identical content returns the stored picture"""
+        index_entry = {'key': 'pictures/20240101_123456_abc123.jpg', 'name': 'sunset.jpg', 'size': 13}
+        mock_s3.get_object.side_effect = lambda **kwargs: {
+            'Body': io.BytesIO(json.dumps(index_entry).encode('utf-8')),
+            'ETag': '"entry"'
+        }
+        mock_s3.head_object.return_value = {'Metadata': {}}
+
+        response = lambda_handler(self.upload_event('sunset copy.jpg', b'fake_jpg_data'), {})
+
+        self.assertEqual(response['statusCode'], 200)
+        body = json.loads(response['body'])
+        self.assertTrue(body['deduplicated'])
+        self.assertEqual(body['key'], 'pictures/20240101_123456_abc123.jpg')
+
+        # Only the index entry is rewritten, no second copy of the picture
+        self.assertEqual(mock_s3.put_object.call_count, 1)
+        saved_entry = json.loads(mock_s3.put_object.call_args[1]['Body'])
+        self.assertEqual(saved_entry['references'][0]['name'], 'sunset copy.jpg')
+
+    @patch('unified_lambda.s3_client')
+    def test_upload_url_skips_known_content(self, mock_s3):
+        """Test that a presigned upload is not needed when the client hash is known"""
+        digest = hashlib.sha256(b'fake_jpg_data').hexdigest()
+        index_entry = {'key': 'pictures/20240101_123456_abc123.jpg', 'name': 'sunset.jpg', 'size': 13}
+        mock_s3.get_object.side_effect = lambda **kwargs: {
+            'Body': io.BytesIO(json.dumps(index_entry).encode('utf-8')),
+            'ETag': '"entry"'
+        }
+        mock_s3.head_object.return_value = {'Metadata': {}}
+
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures/upload-url',
+            'body': json.dumps({'name': 'sunset.jpg', 'contentType': 'image/jpeg', 'sha256': digest})
+        }
+
+        response = lambda_handler(event, {})
+
+        body = json.loads(response['body'])
+        self.assertTrue(body['deduplicated'])
+        mock_s3.generate_presigned_post.assert_not_called()
+
+    @patch('unified_lambda.s3_client')
+    def test_upload_url_requires_checksum_of_declared_hash(self, mock_s3):
+        """Test that S3 is asked to verify the client's SHA-256 for a new upload"""
+        digest = hashlib.sha256(b'fake_jpg_data').hexdigest()
+        mock_s3.get_object.side_effect = ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        mock_s3.generate_presigned_post.return_value = {'url': 'https://bucket.s3.amazonaws.com/', 'fields': {}}
+
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures/upload-url',
+            'body': json.dumps({'name': 'sunset.jpg', 'contentType': 'image/jpeg', 'sha256': digest})
+        }
+
+        lambda_handler(event, {})
+
+        checksum = base64.b64encode(hashlib.sha256(b'fake_jpg_data').digest()).decode('ascii')
+        kwargs = mock_s3.generate_presigned_post.call_args[1]
+        self.assertEqual(kwargs['Fields']['x-amz-checksum-sha256'], checksum)
+        self.assertIn({'x-amz-checksum-sha256': checksum}, kwargs['Conditions'])
+        self.assertIn({'x-amz-checksum-algorithm': 'SHA256'}, kwargs['Conditions'])
+
+    def complete_event(self, key):
+        return {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures/upload-complete',
+            'body': json.dumps({'key': key})
+        }
+
+    @patch('unified_lambda.s3_client')
+    def test_unverified_hash_is_not_indexed(self, mock_s3):
+        """Test that a claimed SHA-256 without a matching S3 checksum cannot claim the digest"""
+        digest = hashlib.sha256(b'other content').hexdigest()
+        mock_s3.generate_presigned_url.return_value = 'https://example.com/picture'
+        mock_s3.head_object.return_value = {'ContentLength': 13, 'Metadata': {'original-name': 'sunset.jpg', 'sha256': digest}}
+
+        response = lambda_handler(self.complete_event('pictures/20240101_123456_abc123.jpg'), {})
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(mock_s3.head_object.call_args[1]['ChecksumMode'], 'ENABLED')
+        self.assertFalse(any(call[1]['Key'].startswith('hashes/') for call in mock_s3.put_object.call_args_list))
+
+    @patch('unified_lambda.s3_client')
+    def test_concurrent_completion_loses_digest_claim(self, mock_s3):
+        """Test that an upload whose digest was claimed concurrently becomes a reference"""
+        digest = hashlib.sha256(b'fake_jpg_data').hexdigest()
+        winner = {'key': 'pictures/20240101_000000_first.jpg', 'name': 'sunset.jpg', 'size': 13}
+        stored = {}
+
+        def get_object(Bucket, Key):
+            if Key not in stored:
+                raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+            return {'Body': io.BytesIO(stored[Key]), 'ETag': '"entry"'}
+
+        def put_object(Bucket, Key, Body, IfNoneMatch=None, **kwargs):
+            if IfNoneMatch == '*' and Key.startswith('hashes/'):
+                # The other completion indexes the digest between our lookup and our write
+                stored[Key] = json.dumps(winner).encode('utf-8')
+                raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+            stored[Key] = Body.encode('utf-8') if isinstance(Body, str) else Body
+
+        mock_s3.get_object.side_effect = get_object
+        mock_s3.put_object.side_effect = put_object
+        mock_s3.head_object.return_value = {
+            'ContentLength': 13,
+            'Metadata': {'original-name': 'sunset copy.jpg', 'sha256': digest},
+            'ChecksumSHA256': base64.b64encode(bytes.fromhex(digest)).decode('ascii')
+        }
+
+        response = lambda_handler(self.complete_event('pictures/20240101_000001_second.jpg'), {})
+
+        body = json.loads(response['body'])
+        self.assertTrue(body['deduplicated'])
+        self.assertEqual(body['key'], winner['key'])
+        mock_s3.delete_object.assert_called_once_with(Bucket=ANY, Key='pictures/20240101_000001_second.jpg')
+        self.assertEqual(json.loads(stored[f'hashes/{digest}.json'])['references'][0]['name'], 'sunset copy.jpg')
+
+def make_jpeg(width, height, color=(200, 120, 40)):
+    """Create JPEG bytes for a solid-color test image"""
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), color).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+def noisy_jpeg(width, height):
+    """Create high-quality JPEG bytes that a display copy can shrink"""
+    buffer = io.BytesIO()
+    Image.effect_noise((width, height), 60).convert('RGB').save(buffer, 'JPEG', quality=98)
+    return buffer.getvalue()
+
+@unittest.skipUnless(Image, 'Pillow is not installed')
+class TestThumbnails(unittest.TestCase):
+
+    @patch('unified_lambda.s3_client')
+    def test_upload_writes_thumbnails(self, mock_s3):
+        """Test that an upload writes one thumbnail per configured width"""
+        mock_s3.generate_presigned_url.return_value = 'https://example.com/picture'
+        mock_s3.get_object.side_effect = Exception('NoSuchKey')
+
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures',
+            'body': json.dumps({
+                'name': 'wide.jpg',
+                'data': base64.b64encode(make_jpeg(2000, 1000)).decode('utf-8'),
+                'contentType': 'image/jpeg'
+            })
+        }
+
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 200)
+        key = json.loads(response['body'])['key']
+        puts = {call[1]['Key']: call[1] for call in mock_s3.put_object.call_args_list}
+        self.assertEqual(puts[key]['Metadata']['thumbnails'], '200,640,1280')
+
+        for width in (200, 640, 1280):
+            thumbnail = puts[get_thumbnail_key(key, width)]
+            self.assertEqual(thumbnail['ContentType'], 'image/jpeg')
+            with Image.open(io.BytesIO(thumbnail['Body'])) as image:
+                self.assertEqual(image.size, (width, width // 2))
+
+    def test_small_pictures_skip_larger_thumbnails(self):
+        """Test that thumbnails are never wider than the picture"""
+        with patch('unified_lambda.s3_client') as mock_s3:
+            metadata = process_image('pictures/small.jpg', io.BytesIO(make_jpeg(500, 400)))
+
+        self.assertEqual(metadata['thumbnails'], '200')
+        keys = {call[1]['Key'] for call in mock_s3.put_object.call_args_list if call[1]['Key'].startswith('thumbnails/')}
+        self.assertEqual({key.split('/')[1] for key in keys}, {'200'})
+
+    def test_thumbnails_written_in_each_supported_format(self):
+        """Test that every width gets a variant per format the Pillow build can encode"""
+        with patch('unified_lambda.s3_client') as mock_s3, \
+                patch('unified_lambda.get_supported_variant_formats', return_value=['jpeg', 'webp']):
+            metadata = process_image('pictures/wide.jpg', io.BytesIO(make_jpeg(1000, 500)))
+
+        self.assertEqual(metadata['variant-formats'], 'jpeg,webp')
+        puts = {call[1]['Key']: call[1] for call in mock_s3.put_object.call_args_list}
+        self.assertEqual({key for key in puts if key.startswith('thumbnails/')}, {
+            'thumbnails/200/wide.jpg', 'thumbnails/200/wide.webp',
+            'thumbnails/640/wide.jpg', 'thumbnails/640/wide.webp'
+        })
+        webp = puts['thumbnails/640/wide.webp']
+        self.assertEqual(webp['ContentType'], 'image/webp')
+        with Image.open(io.BytesIO(webp['Body'])) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (640, 320)))
+
+    @patch('unified_lambda.DISPLAY_MAX_DIMENSION', 1000)
+    @patch('unified_lambda.get_supported_variant_formats', return_value=['jpeg'])
+    def test_display_original_is_capped_and_stripped(self, _):
+        """Test that full-size views get a smaller progressive copy without EXIF"""
+        exif = Image.Exif()
+        exif[ExifTags.Base.Model] = 'Pixel 8'
+        buffer = io.BytesIO()
+        Image.effect_noise((1500, 1000), 60).convert('RGB').save(buffer, 'JPEG', quality=98, exif=exif)
+        original = buffer.getvalue()
+
+        with patch('unified_lambda.s3_client') as mock_s3:
+            metadata = process_image('pictures/big.jpg', io.BytesIO(original), len(original))
+
+        self.assertEqual(metadata['display'], 'jpeg')
+        puts = {call[1]['Key']: call[1] for call in mock_s3.put_object.call_args_list}
+        display = puts['display/big.jpg']['Body']
+        self.assertLess(len(display), len(original))
+        with Image.open(io.BytesIO(display)) as image:
+            self.assertEqual(image.size, (1000, 667))
+            self.assertTrue(image.info.get('progressive'))
+            self.assertNotIn('exif', image.info)
+
+    @patch('unified_lambda.DISPLAY_MAX_DIMENSION', 1000)
+    @patch('unified_lambda.s3_client')
+    def test_only_originals_with_derived_views_are_archivable(self, mock_s3):
+        """Test that the archive tag goes only on originals whose views all come from derived images"""
+        mock_s3.generate_presigned_url.return_value = 'https://example.com/picture'
+        mock_s3.get_object.side_effect = Exception('NoSuchKey')
+
+        for name, data, archivable in [('noisy.jpg', noisy_jpeg(1500, 1000), True), ('tiny.jpg', make_jpeg(120, 80), False)]:
+            with self.subTest(name=name):
+                response = lambda_handler({
+                    'requestContext': {'http': {'method': 'POST'}},
+                    'rawPath': '/api/pictures',
+                    'body': json.dumps({'name': name, 'data': base64.b64encode(data).decode('utf-8'), 'contentType': 'image/jpeg'})
+                }, {})
+
+                key = json.loads(response['body'])['key']
+                put = {call[1]['Key']: call[1] for call in mock_s3.put_object.call_args_list}[key]
+                self.assertEqual(put.get('Tagging'), 'archivable=true' if archivable else None)
+
+    @patch('unified_lambda.s3_client')
+    def test_rating_keeps_storage_class(self, mock_s3):
+        """Test that the in-place metadata copy does not move an archived original back to standard storage"""
+        mock_s3.list_objects_v2.return_value = {'Contents': [{'Key': 'pictures/old.jpg', 'LastModified': datetime(2024, 1, 1)}]}
+        mock_s3.head_object.return_value = {
+            'Metadata': {'original-name': 'old.jpg'}, 'ContentType': 'image/jpeg', 'StorageClass': 'STANDARD_IA'
+        }
+
+        response = lambda_handler({
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures/rate',
+            'body': json.dumps({'picture': 'old.jpg', 'rating': 5})
+        }, {})
+
+        self.assertEqual(response['statusCode'], 200)
+        copy = mock_s3.copy_object.call_args[1]
+        self.assertEqual((copy['StorageClass'], copy['Metadata']['rating']), ('STANDARD_IA', '5'))
+        self.assertNotIn('TaggingDirective', copy)
+
+    def test_display_original_skipped_when_not_smaller(self):
+        """Test that small, already compact pictures are served as they are"""
+        buffer = io.BytesIO()
+        Image.effect_noise((400, 300), 60).convert('RGB').save(buffer, 'JPEG', quality=50, optimize=True, progressive=True)
+        original = buffer.getvalue()
+
+        with patch('unified_lambda.s3_client') as mock_s3:
+            metadata = process_image('pictures/small.jpg', io.BytesIO(original), len(original))
+
+        self.assertNotIn('display', metadata)
+        self.assertNotIn('display/small.jpg', [call[1]['Key'] for call in mock_s3.put_object.call_args_list])
+
+    def test_blurhash_placeholder(self):
+        """Test that a placeholder is computed at ingest, with the average color as its DC term"""
+        with patch('unified_lambda.s3_client'):
+            metadata = process_image('pictures/solid.jpg', io.BytesIO(make_jpeg(300, 200, color=(200, 120, 40))))
+
+        blurhash = metadata['blurhash']
+        self.assertEqual(len(blurhash), 28)  # 4x3 components
+        dc = sum(BLURHASH_CHARACTERS.index(character) * 83 ** (3 - i) for i, character in enumerate(blurhash[2:6]))
+        for actual, expected in zip((dc >> 16, (dc >> 8) & 255, dc & 255), (200, 120, 40)):
+            self.assertAlmostEqual(actual, expected, delta=3)
+
+    def test_grayscale_and_palette_pictures_are_processed(self):
+        """Test that single-channel pictures still get dimensions, hashes and thumbnails"""
+        for mode, image_format, color in [('L', 'JPEG', 128), ('P', 'GIF', 5), ('P', 'PNG', 5)]:
+            with self.subTest(mode=mode, format=image_format):
+                buffer = io.BytesIO()
+                Image.new(mode, (300, 200), color).save(buffer, image_format)
+
+                with patch('unified_lambda.s3_client') as mock_s3:
+                    metadata = process_image('pictures/gray.jpg', io.BytesIO(buffer.getvalue()))
+
+                self.assertEqual((metadata['width'], metadata['height']), ('300', '200'))
+                self.assertEqual(len(metadata['blurhash']), 28)
+                self.assertIn('dhash', metadata)
+                self.assertTrue(mock_s3.put_object.called)
+
+    @patch('unified_lambda.s3_client')
+    def test_listing_returns_grid_thumbnail(self, mock_s3):
+        """Test that listings point the grid at a thumbnail and keep the original URL"""
+        mock_s3.list_objects_v2.return_value = {
+            'Contents': [{'Key': 'pictures/wide.jpg', 'LastModified': datetime(2024, 1, 1)}]
+        }
+        mock_s3.head_object.return_value = {
+            'Metadata': {'original-name': 'wide.jpg', 'thumbnails': '200,640,1280', 'blurhash': 'LYFiPx9FIUof00t7%Mj[M{%MIUj['}
+        }
+        mock_s3.generate_presigned_url.side_effect = lambda method, Params, ExpiresIn: f"https://example.com/{Params['Key']}"
+
+        event = {
+            'requestContext': {'http': {'method': 'GET'}},
+            'rawPath': '/api/pictures'
+        }
+
+        response = lambda_handler(event, {})
+
+        picture = json.loads(response['body'])['pictures'][0]
+        self.assertEqual(picture['url'], 'https://example.com/pictures/wide.jpg')
+        self.assertEqual(picture['thumbnailUrl'], 'https://example.com/thumbnails/640/wide.jpg')
+        self.assertEqual(set(picture['thumbnails']), {'200', '640', '1280'})
+        self.assertEqual(picture['blurhash'], 'LYFiPx9FIUof00t7%Mj[M{%MIUj[')
+        self.assertNotIn('displayUrl', picture)
+
+    @patch('unified_lambda.s3_client')
+    def test_listing_returns_variant_srcsets(self, mock_s3):
+        """Test that listings expose every recorded format and width for srcset"""
+        mock_s3.list_objects_v2.return_value = {
+            'Contents': [{'Key': 'pictures/wide.jpg', 'LastModified': datetime(2024, 1, 1)}]
+        }
+        mock_s3.head_object.return_value = {
+            'Metadata': {'original-name': 'wide.jpg', 'thumbnails': '200,640', 'variant-formats': 'jpeg,webp,avif'}
+        }
+        mock_s3.generate_presigned_url.side_effect = lambda method, Params, ExpiresIn: f"https://example.com/{Params['Key']}"
+
+        event = {
+            'requestContext': {'http': {'method': 'GET'}},
+            'rawPath': '/api/pictures'
+        }
+
+        response = lambda_handler(event, {})
+
+        variants = json.loads(response['body'])['pictures'][0]['variants']
+        self.assertEqual(set(variants), {'jpeg', 'webp', 'avif'})
+        self.assertEqual(variants['avif'], [
+            {'width': 200, 'url': 'https://example.com/thumbnails/200/wide.avif'},
+            {'width': 640, 'url': 'https://example.com/thumbnails/640/wide.avif'}
+        ])
+
+def make_gradient(size, angle=0):
+    """Create a grayscale gradient test image, rotated by angle degrees"""
+    return Image.linear_gradient('L').rotate(angle).resize(size).convert('RGB')
+
+class TestNearDuplicates(unittest.TestCase):
+
+    @unittest.skipUnless(Image, 'Pillow is not installed')
+    def test_dhash_matches_resized_copies(self):
+        """Test that a resized re-encode hashes close to the original and a different shot does not"""
+        original = make_gradient((800, 600), angle=30)
+        buffer = io.BytesIO()
+        original.resize((200, 150)).save(buffer, 'JPEG', quality=40)
+        copy = Image.open(io.BytesIO(buffer.getvalue()))
+
+        original_hash = int(compute_dhash(original), 16)
+        self.assertLessEqual(hamming_distance(original_hash, int(compute_dhash(copy), 16)), 6)
+        self.assertGreater(hamming_distance(original_hash, int(compute_dhash(make_gradient((800, 600), angle=210)), 16)), 20)
+
+    def test_bk_tree_search_matches_linear_scan(self):
+        """Test that radius searches find exactly the hashes a linear scan does"""
+        rng = random.Random(7)
+        hashes = [rng.getrandbits(64) for _ in range(500)]
+        # Plant a few near copies so the radius is not empty
+        hashes += [value ^ (1 << rng.randrange(64)) for value in hashes[:20]]
+        tree = BKTree()
+        for i, value in enumerate(hashes):
+            tree.add(value, f'pictures/{i}.jpg')
+
+        query = hashes[3]
+        found = {key for _, _, keys in tree.search(query, 8) for key in keys}
+        expected = {f'pictures/{i}.jpg' for i, value in enumerate(hashes) if hamming_distance(query, value) <= 8}
+        self.assertEqual(found, expected)
+        self.assertGreater(len(found), 1)
+
+    @patch('unified_lambda.perceptual_index', None)
+    @patch('unified_lambda.s3_client')
+    def test_duplicates_endpoint_lists_clusters(self, mock_s3):
+        """Test that near hashes are clustered and distinct ones left out"""
+        mock_s3.get_paginator.return_value.paginate.return_value = [{'Contents': [
+            {'Key': 'perceptual-hashes/00000000000000ff/a.jpg'},
+            {'Key': 'perceptual-hashes/00000000000000fe/b.jpg'},
+            {'Key': 'perceptual-hashes/00000000000000fe/c.jpg'},
+            {'Key': 'perceptual-hashes/ffffffffffffff00/d.jpg'}
+        ]}]
+        mock_s3.generate_presigned_url.side_effect = lambda method, Params, ExpiresIn: f"https://example.com/{Params['Key']}"
+
+        event = {
+            'requestContext': {'http': {'method': 'GET'}},
+            'rawPath': '/api/pictures/duplicates',
+            'queryStringParameters': {'distance': '2'}
+        }
+
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 200)
+        clusters = json.loads(response['body'])['clusters']
+        self.assertEqual(len(clusters), 1)
+        self.assertEqual([picture['key'] for picture in clusters[0]['pictures']],
+                         ['pictures/a.jpg', 'pictures/b.jpg', 'pictures/c.jpg'])
+
+    def saved_index_s3(self, mock_s3, entries, stored_keys):
+        """Serve a saved perceptual index and the given pictures from a mocked S3"""
+        saved_index = json.dumps({'built': '2024-03-05T10:00:00+00:00', 'entries': entries}).encode('utf-8')
+
+        def head_object(Bucket, Key, **kwargs):
+            if Key == 'perceptual-index.json':
+                return {'ETag': '"index"', 'LastModified': datetime.now(timezone.utc)}
+            if Key in stored_keys:
+                return {'Metadata': {}}
+            raise ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+
+        def get_object(Bucket, Key):
+            if Key == 'perceptual-index.json':
+                return {'Body': io.BytesIO(saved_index), 'ETag': '"index"'}
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+
+        mock_s3.head_object.side_effect = head_object
+        mock_s3.get_object.side_effect = get_object
+        mock_s3.generate_presigned_url.return_value = 'https://example.com/picture'
+
+    def near_copy_event(self, image):
+        buffer = io.BytesIO()
+        image.resize((400, 300)).save(buffer, 'JPEG', quality=50)
+        return {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures',
+            'body': json.dumps({
+                'name': 'copy.jpg',
+                'data': base64.b64encode(buffer.getvalue()).decode('utf-8'),
+                'contentType': 'image/jpeg'
+            })
+        }
+
+    @unittest.skipUnless(Image, 'Pillow is not installed')
+    @patch('unified_lambda.perceptual_index', None)
+    @patch('unified_lambda.perceptual_index_etag', None)
+    @patch('unified_lambda.s3_client')
+    def test_upload_warns_about_similar_pictures(self, mock_s3):
+        """Test that uploading a near copy reports the similar picture from the saved index without listing markers"""
+        image = make_gradient((800, 600), angle=30)
+        self.saved_index_s3(mock_s3, [[compute_dhash(image), 'pictures/original.jpg']], {'pictures/original.jpg'})
+
+        response = lambda_handler(self.near_copy_event(image), {})
+
+        body = json.loads(response['body'])
+        self.assertEqual(body['similar'], ['pictures/original.jpg'])
+        puts = [call[1]['Key'] for call in mock_s3.put_object.call_args_list]
+        self.assertTrue(any(key.startswith('perceptual-hashes/') and key.endswith(body['key'][len('pictures/'):]) for key in puts))
+        mock_s3.get_paginator.assert_not_called()
+
+    @unittest.skipUnless(Image, 'Pillow is not installed')
+    @patch('unified_lambda.perceptual_index', None)
+    @patch('unified_lambda.perceptual_index_etag', None)
+    @patch('unified_lambda.s3_client')
+    def test_deleted_pictures_are_dropped_from_index(self, mock_s3):
+        """Test that an index entry whose picture is gone is removed rather than reported"""
+        image = make_gradient((800, 600), angle=30)
+        dhash = compute_dhash(image)
+        self.saved_index_s3(mock_s3, [[dhash, 'pictures/deleted.jpg']], set())
+
+        response = lambda_handler(self.near_copy_event(image), {})
+
+        self.assertEqual(json.loads(response['body'])['similar'], [])
+        mock_s3.delete_object.assert_any_call(Bucket=ANY, Key=f'perceptual-hashes/{dhash}/deleted.jpg')
+        indexed = {key for _, _, keys in unified_lambda.perceptual_index.search(int(dhash, 16), 64) for key in keys}
+        self.assertEqual(indexed, {json.loads(response['body'])['key']})
+
+class TestImageInfo(unittest.TestCase):
+
+    def make_exif_jpeg(self, width, height):
+        """Create a JPEG rotated a quarter turn by EXIF, with a capture date and camera model"""
+        exif = Image.Exif()
+        exif[ExifTags.Base.Orientation] = 6
+        exif[ExifTags.Base.Model] = 'Pixel 8'
+        exif.get_ifd(ExifTags.IFD.Exif)[ExifTags.Base.DateTimeOriginal] = '2023:07:14 18:30:05'
+        buffer = io.BytesIO()
+        Image.new('RGB', (width, height)).save(buffer, 'JPEG', exif=exif)
+        return buffer.getvalue()
+
+    @unittest.skipUnless(Image, 'Pillow is not installed')
+    def test_image_info_from_exif(self):
+        """Test that displayed dimensions, capture time and camera come from the header"""
+        with patch('unified_lambda.s3_client'):
+            metadata = process_image('pictures/portrait.jpg', io.BytesIO(self.make_exif_jpeg(800, 600)))
+
+        self.assertEqual((metadata['width'], metadata['height']), ('600', '800'))
+        self.assertEqual(metadata['orientation'], '6')
+        self.assertEqual(metadata['captured-at'], '2023-07-14T18:30:05')
+        self.assertEqual(metadata['camera-model'], 'Pixel 8')
+
+    @unittest.skipUnless(Image, 'Pillow is not installed')
+    @patch('unified_lambda.IMAGE_PROCESSING_MAX_BYTES', 10)
+    @patch('unified_lambda.s3_client')
+    def test_large_upload_reads_header_only(self, mock_s3):
+        """Test that pictures too large to process still get header details from a ranged read"""
+        mock_s3.generate_presigned_url.return_value = 'https://example.com/picture'
+        mock_s3.head_object.return_value = {'ContentLength': 5000, 'Metadata': {'original-name': 'big.jpg'}}
+        mock_s3.get_object.return_value = {'Body': io.BytesIO(self.make_exif_jpeg(800, 600)[:2000])}
+
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures/upload-complete',
+            'body': json.dumps({'key': 'pictures/big.jpg'})
+        }
+
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 200)
+        picture_reads = [call[1] for call in mock_s3.get_object.call_args_list if call[1]['Key'] == 'pictures/big.jpg']
+        self.assertEqual(len(picture_reads), 1)
+        self.assertTrue(picture_reads[0]['Range'].startswith('bytes=0-'))
+        metadata = mock_s3.copy_object.call_args[1]['Metadata']
+        self.assertEqual(metadata['width'], '600')
+        self.assertEqual(metadata['captured-at'], '2023-07-14T18:30:05')
+        self.assertEqual(json.loads(response['body'])['picture']['width'], 600)
+
+    @patch('unified_lambda.COPY_OBJECT_MAX_BYTES', 1000)
+    @patch('unified_lambda.s3_client')
+    def test_upload_too_large_to_copy_is_not_processed(self, mock_s3):
+        """Test that a picture past the CopyObject limit is recorded without rewriting its metadata"""
+        mock_s3.generate_presigned_url.return_value = 'https://example.com/picture'
+        mock_s3.head_object.return_value = {'ContentLength': 5000, 'Metadata': {'original-name': 'huge.jpg'}}
+
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures/upload-complete',
+            'body': json.dumps({'key': 'pictures/huge.jpg'})
+        }
+
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 200)
+        mock_s3.copy_object.assert_not_called()
+        self.assertNotIn('pictures/huge.jpg', [call[1]['Key'] for call in mock_s3.get_object.call_args_list])
+
+    @patch('unified_lambda.s3_client')
+    def test_listing_sorts_by_capture_date(self, mock_s3):
+        """Test that listings return header details and can sort by capture date"""
+        mock_s3.list_objects_v2.return_value = {'Contents': [
+            {'Key': 'pictures/old_upload.jpg', 'LastModified': datetime(2024, 1, 1, tzinfo=timezone.utc)},
+            {'Key': 'pictures/new_upload.jpg', 'LastModified': datetime(2024, 6, 1, tzinfo=timezone.utc)}
+        ]}
+        metadata = {
+            'pictures/old_upload.jpg': {'original-name': 'old_upload.jpg', 'width': '4000', 'height': '3000',
+                                        'captured-at': '2023-12-31T09:00:00'},
+            'pictures/new_upload.jpg': {'original-name': 'new_upload.jpg', 'captured-at': '2019-05-05T12:00:00'}
+        }
+        mock_s3.head_object.side_effect = lambda Bucket, Key: {'Metadata': metadata[Key]}
+        mock_s3.generate_presigned_url.return_value = 'https://example.com/picture'
+
+        event = {
+            'requestContext': {'http': {'method': 'GET'}},
+            'rawPath': '/api/pictures',
+            'queryStringParameters': {'sort': 'captured'}
+        }
+
+        response = lambda_handler(event, {})
+
+        pictures = json.loads(response['body'])['pictures']
+        self.assertEqual([picture['name'] for picture in pictures], ['old_upload.jpg', 'new_upload.jpg'])
+        self.assertEqual((pictures[0]['width'], pictures[0]['height']), (4000, 3000))
+        self.assertEqual(pictures[1]['capturedAt'], '2019-05-05T12:00:00')
+
+class TestMultipartUploads(unittest.TestCase):
+
+    @patch('unified_lambda.s3_client')
+    def test_initiate_multipart_upload(self, mock_s3):
+        """Test starting a multipart upload records the picture metadata"""
+        mock_s3.create_multipart_upload.return_value = {'UploadId': 'upload-1'}
+
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/uploads/multipart',
+            'body': json.dumps({'name': 'panorama.jpg', 'contentType': 'image/jpeg', 'size': 200 * 1024 ** 2})
+        }
+
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 200)
+        body = json.loads(response['body'])
+        self.assertEqual(body['uploadId'], 'upload-1')
+        self.assertGreaterEqual(body['partSize'], 5 * 1024 ** 2)
+        kwargs = mock_s3.create_multipart_upload.call_args[1]
+        self.assertEqual(kwargs['Key'], body['key'])
+        self.assertEqual(kwargs['Metadata']['original-name'], 'panorama.jpg')
+
+    @patch('unified_lambda.s3_client')
+    def test_list_uploaded_parts(self, mock_s3):
+        """Test listing the parts S3 already has for resuming"""
+        mock_s3.get_paginator.return_value.paginate.return_value = [
+            {'Parts': [{'PartNumber': 1, 'ETag': '"a"', 'Size': 8}, {'PartNumber': 2, 'ETag': '"b"', 'Size': 8}]},
+            {'Parts': [{'PartNumber': 3, 'ETag': '"c"', 'Size': 4}]}
+        ]
+
+        event = {
+            'requestContext': {'http': {'method': 'GET'}},
+            'rawPath': '/api/uploads/multipart/parts',
+            'queryStringParameters': {'key': 'pictures/panorama.jpg', 'uploadId': 'upload-1'}
+        }
+
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 200)
+        parts = json.loads(response['body'])['parts']
+        self.assertEqual([part['PartNumber'] for part in parts], [1, 2, 3])
+
+    @patch('unified_lambda.s3_client')
+    def test_complete_multipart_upload(self, mock_s3):
+        """Test completing a multipart upload sorts the parts and finalizes the picture"""
+        mock_s3.generate_presigned_url.return_value = 'https://example.com/picture'
+        mock_s3.head_object.return_value = {
+            'ContentLength': 20,
+            'Metadata': {'original-name': 'panorama.jpg'}
+        }
+
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/uploads/multipart/complete',
+            'body': json.dumps({
+                'key': 'pictures/panorama.jpg',
+                'uploadId': 'upload-1',
+                'parts': [{'PartNumber': 2, 'ETag': '"b"'}, {'PartNumber': 1, 'ETag': '"a"'}]
+            })
+        }
+
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(json.loads(response['body'])['original_name'], 'panorama.jpg')
+        kwargs = mock_s3.complete_multipart_upload.call_args[1]
+        self.assertEqual([part['PartNumber'] for part in kwargs['MultipartUpload']['Parts']], [1, 2])
+
+    @patch('unified_lambda.record_stats_change')
+    @patch('unified_lambda.s3_client')
+    def test_repeated_multipart_completion_is_counted_once(self, mock_s3, record_stats_change):
+        """Test that completing an already completed upload returns the picture without recounting it"""
+        mock_s3.generate_presigned_url.return_value = 'https://example.com/picture'
+        mock_s3.head_object.return_value = {'ContentLength': 20, 'Metadata': {'original-name': 'panorama.jpg'}}
+        mock_s3.complete_multipart_upload.side_effect = [
+            {},
+            ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'CompleteMultipartUpload'),
+            ClientError({'Error': {'Code': 'NoSuchUpload'}}, 'CompleteMultipartUpload')
+        ]
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/uploads/multipart/complete',
+            'body': json.dumps({'key': 'pictures/panorama.jpg', 'uploadId': 'upload-1', 'parts': [{'PartNumber': 1, 'ETag': '"a"'}]})
+        }
+
+        responses = [lambda_handler(event, {}) for _ in range(3)]
+
+        self.assertEqual([response['statusCode'] for response in responses], [200, 200, 200])
+        self.assertEqual(json.loads(responses[2]['body'])['key'], 'pictures/panorama.jpg')
+        record_stats_change.assert_called_once()
+        self.assertEqual(mock_s3.complete_multipart_upload.call_args[1]['IfNoneMatch'], '*')
+
+    @patch('unified_lambda.MAX_UPLOAD_BYTES', 20)
+    @patch('unified_lambda.s3_client')
+    def test_oversized_multipart_upload_is_rejected(self, mock_s3):
+        """Test that parts adding up to more than the upload limit are discarded instead of completed"""
+        mock_s3.get_paginator.return_value.paginate.return_value = [
+            {'Parts': [{'PartNumber': 1, 'ETag': '"a"', 'Size': 16}, {'PartNumber': 2, 'ETag': '"b"', 'Size': 8}]}
+        ]
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/uploads/multipart/complete',
+            'body': json.dumps({
+                'key': 'pictures/panorama.jpg',
+                'uploadId': 'upload-1',
+                'parts': [{'PartNumber': 1, 'ETag': '"a"'}, {'PartNumber': 2, 'ETag': '"b"'}]
+            })
+        }
+
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 413)
+        mock_s3.complete_multipart_upload.assert_not_called()
+        mock_s3.abort_multipart_upload.assert_called_once_with(Bucket=ANY, Key='pictures/panorama.jpg', UploadId='upload-1')
+
+    def test_multipart_requests_require_picture_key(self):
+        """Test that multipart operations are limited to picture keys"""
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/uploads/multipart/abort',
+            'body': json.dumps({'key': 'jobs/secret.json', 'uploadId': 'upload-1'})
+        }
+
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 400)
+
+def capture_puts(mock_s3):
+    """Record put_object calls by key, reading file bodies before the upload closes them"""
+    puts = {}
+    def put_object(**kwargs):
+        body = kwargs['Body']
+        puts[kwargs['Key']] = dict(kwargs, Body=body.read() if hasattr(body, 'read') else body)
+    mock_s3.put_object.side_effect = put_object
+    return puts
+
+# Leading bytes that identify an upload as an image
+JPEG_SIGNATURE = b'\xff\xd8\xff'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+class TestSpooledUploads(unittest.TestCase):
+
+    @patch('unified_lambda.BASE64_DECODE_CHUNK_SIZE', 8)
+    @patch('unified_lambda.UPLOAD_SPOOL_MAX_MEMORY', 16)
+    def test_spool_base64_in_chunks(self):
+        """Test that chunked decoding matches, hashes and spills large pictures to disk"""
+        data = b'\x89PNG\r\n\x1a\n' + bytes(range(40))
+
+        picture = spool_base64(base64.b64encode(data).decode('ascii'))
+
+        self.assertEqual(picture.size, len(data))
+        self.assertEqual(picture.sha256.hexdigest(), hashlib.sha256(data).hexdigest())
+        self.assertEqual(picture.sniff_content_type(), 'image/png')
+        self.assertTrue(picture.file._rolled)
+        self.assertEqual(picture.open().read(), data)
+        picture.close()
+
+    @patch('unified_lambda.BASE64_DECODE_CHUNK_SIZE', 8)
+    def test_spool_wrapped_base64(self):
+        """Test that MIME-wrapped base64 decodes the same as unwrapped"""
+        data = bytes(range(200))
+
+        picture = spool_base64(base64.encodebytes(data).decode('ascii').replace('\n', '\r\n '))
+
+        self.assertEqual(picture.open().read(), data)
+        self.assertEqual(picture.sha256.hexdigest(), hashlib.sha256(data).hexdigest())
+        picture.close()
+
+    def test_base64_reader_skips_line_breaks(self):
+        """Test that a streamed base64 body with line breaks reads back intact"""
+        data = bytes(range(256)) * 3
+        reader = Base64Reader(base64.encodebytes(data).decode('ascii'))
+
+        chunks = iter(lambda: reader.read(7), b'')
+
+        self.assertEqual(b''.join(chunks), data)
+
+    @patch('unified_lambda.s3_client')
+    def test_upload_stores_sniffed_content_type(self, mock_s3):
+        """Test that the stored content type comes from the bytes rather than the client"""
+        mock_s3.generate_presigned_url.return_value = 'https://example.com/picture'
+        mock_s3.get_object.side_effect = Exception('NoSuchKey')
+        puts = capture_puts(mock_s3)
+        data = b'GIF89a' + b'\x00' * 10
+
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures',
+            'body': json.dumps({
+                'name': 'anim.jpg',
+                'data': base64.b64encode(data).decode('utf-8'),
+                'contentType': 'image/jpeg'
+            })
+        }
+
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 200)
+        put = puts[json.loads(response['body'])['key']]
+        self.assertEqual(put['Body'], data)
+        self.assertEqual(put['ContentType'], 'image/gif')
+        self.assertEqual(put['ContentLength'], len(data))
+
+class TestBatchUploads(unittest.TestCase):
+
+    def make_multipart_body(self, boundary, files):
+        """Encode files as a multipart/form-data body with a plain field first"""
+        body = f'--{boundary}\r\nContent-Disposition: form-data; name="note"\r\n\r\nhello\r\n'.encode('utf-8')
+        for name, data in files:
+            body += (
+                f'--{boundary}\r\n'
+                f'Content-Disposition: form-data; name="files"; filename="{name}"\r\n'
+                f'Content-Type: image/png\r\n\r\n'
+            ).encode('utf-8') + data + b'\r\n'
+        return body + f'--{boundary}--\r\n'.encode('utf-8')
+
+    @patch('unified_lambda.BATCH_READ_SIZE', 7)
+    @patch('unified_lambda.s3_client')
+    def test_multipart_batch_upload(self, mock_s3):
+        """Test that every file in a multipart body is stored, across read boundaries"""
+        mock_s3.generate_presigned_url.return_value = 'https://example.com/picture'
+        mock_s3.get_object.side_effect = Exception('NoSuchKey')
+        puts = capture_puts(mock_s3)
+        boundary = '----WebKitFormBoundaryabc123'
+        files = [('one.png', PNG_SIGNATURE + b'first\r\n--fake picture'), ('two.png', PNG_SIGNATURE + b'second picture')]
+
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures/batch',
+            'headers': {'content-type': f'multipart/form-data; boundary={boundary}'},
+            'body': base64.b64encode(self.make_multipart_body(boundary, files)).decode('utf-8'),
+            'isBase64Encoded': True
+        }
+
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 200)
+        body = json.loads(response['body'])
+        self.assertEqual([picture['original_name'] for picture in body['uploaded']], ['one.png', 'two.png'])
+        self.assertEqual(body['failed'], [])
+        stored = {put['Metadata']['original-name']: put for put in puts.values() if 'Metadata' in put}
+        self.assertEqual(stored['one.png']['Body'], PNG_SIGNATURE + b'first\r\n--fake picture')
+        self.assertEqual(stored['two.png']['ContentType'], 'image/png')
+
+    @patch('unified_lambda.s3_client')
+    def test_raw_binary_upload(self, mock_s3):
+        """Test that a raw binary body is stored as one picture named in the query string"""
+        mock_s3.generate_presigned_url.return_value = 'https://example.com/picture'
+        mock_s3.get_object.side_effect = Exception('NoSuchKey')
+        puts = capture_puts(mock_s3)
+
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures/batch',
+            'headers': {'Content-Type': 'image/jpeg'},
+            'queryStringParameters': {'name': 'beach.jpg'},
+            'body': base64.b64encode(JPEG_SIGNATURE + b'fake_jpg_data').decode('utf-8'),
+            'isBase64Encoded': True
+        }
+
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 200)
+        self.assertEqual(json.loads(response['body'])['uploaded'][0]['original_name'], 'beach.jpg')
+        key = json.loads(response['body'])['uploaded'][0]['key']
+        self.assertEqual(puts[key]['Body'], JPEG_SIGNATURE + b'fake_jpg_data')
+
+    @patch('unified_lambda.s3_client')
+    def test_batch_rejects_non_image_bytes(self, mock_s3):
+        """Test that a file declared as an image but holding other bytes is reported, not stored"""
+        mock_s3.generate_presigned_url.return_value = 'https://example.com/picture'
+        mock_s3.get_object.side_effect = Exception('NoSuchKey')
+        puts = capture_puts(mock_s3)
+        boundary = 'xyz'
+        files = [('page.png', b'<html><script>alert(1)</script></html>'), ('two.png', PNG_SIGNATURE + b'picture')]
+
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures/batch',
+            'headers': {'content-type': f'multipart/form-data; boundary={boundary}'},
+            'body': base64.b64encode(self.make_multipart_body(boundary, files)).decode('utf-8'),
+            'isBase64Encoded': True
+        }
+
+        response = lambda_handler(event, {})
+
+        body = json.loads(response['body'])
+        self.assertEqual([picture['original_name'] for picture in body['uploaded']], ['two.png'])
+        self.assertEqual([entry['name'] for entry in body['failed']], ['page.png'])
+        self.assertEqual([put['Metadata']['original-name'] for put in puts.values() if 'Metadata' in put], ['two.png'])
+
+    def test_truncated_multipart_body(self):
+        """Test that a body without its closing delimiter is rejected"""
+        event = {
+            'requestContext': {'http': {'method': 'POST'}},
+            'rawPath': '/api/pictures/batch',
+            'headers': {'content-type': 'multipart/form-data; boundary=xyz'},
+            'body': '--xyz\r\nContent-Disposition: form-data; name="files"; filename="a.png"\r\n\r\npartial'
+        }
+
+        response = lambda_handler(event, {})
+
+        self.assertEqual(response['statusCode'], 400)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
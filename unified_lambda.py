@@ -3,8 +3,16 @@ import base64
 import os
 import boto3
 import uuid
-from datetime import datetime
+import hashlib
+import re
+import io
+import math
+import tempfile
+import time
+import random
+from datetime import datetime, timezone, date, timedelta
 from urllib.parse import parse_qs
+from botocore.exceptions import ClientError
 
 # Initialize AWS clients
 s3_client = boto3.client('s3')
@@ -13,13 +21,194 @@ s3_client = boto3.client('s3')
 PICTURES_BUCKET = os.environ.get('PICTURES_BUCKET', 'your-pictures-bucket')
 ICEBERG_WAREHOUSE_PATH = os.environ.get('ICEBERG_WAREHOUSE_PATH', 'warehouse')
 
+# Cache of finished download archives, keyed by the selection's (key, ETag) pairs
+ARCHIVE_CACHE_PREFIX = 'archives/'
+ARCHIVE_CACHE_TTL_SECONDS = int(os.environ.get('ARCHIVE_CACHE_TTL_SECONDS', '86400'))
+ARCHIVE_CACHE_MAX_BYTES = int(os.environ.get('ARCHIVE_CACHE_MAX_BYTES', str(2 * 1024 ** 3)))
+
+# Direct browser uploads through presigned POSTs
+MAX_UPLOAD_BYTES = int(os.environ.get('MAX_UPLOAD_BYTES', str(5 * 1024 ** 3)))  # S3 single PUT/POST limit
+COPY_OBJECT_MAX_BYTES = 5 * 1024 ** 3  # Largest object a single CopyObject can copy
+UPLOAD_URL_EXPIRES_SECONDS = 900
+
+# Image processing: thumbnails written under thumbnails/<width>/
+THUMBNAIL_PREFIX = 'thumbnails/'
+THUMBNAIL_WIDTHS = tuple(int(width) for width in os.environ.get('THUMBNAIL_WIDTHS', '200,640,1280').split(','))
+THUMBNAIL_QUALITY = 82
+GRID_THUMBNAIL_WIDTH = 640
+
+# Thumbnail formats; WebP and AVIF are only written when the Pillow build can encode them
+VARIANT_FORMATS = {
+    'jpeg': {
+        'extension': 'jpg',
+        'content_type': 'image/jpeg',
+        'pillow_format': 'JPEG',
+        'options': {'quality': THUMBNAIL_QUALITY, 'optimize': True, 'progressive': True}
+    },
+    'webp': {
+        'extension': 'webp',
+        'content_type': 'image/webp',
+        'pillow_format': 'WEBP',
+        'options': {'quality': 80, 'method': 4}
+    },
+    'avif': {
+        'extension': 'avif',
+        'content_type': 'image/avif',
+        'pillow_format': 'AVIF',
+        'options': {'quality': 60, 'speed': 8}
+    }
+}
+IMAGE_PROCESSING_MAX_BYTES = int(os.environ.get('IMAGE_PROCESSING_MAX_BYTES', str(100 * 1024 ** 2)))
+# Display originals: size-capped, progressive, metadata-stripped copies served for full-size views
+DISPLAY_PREFIX = 'display/'
+DISPLAY_ORIGINALS_ENABLED = os.environ.get('DISPLAY_ORIGINALS_ENABLED', 'true').lower() == 'true'
+DISPLAY_MAX_DIMENSION = int(os.environ.get('DISPLAY_MAX_DIMENSION', '2560'))
+DISPLAY_QUALITY = int(os.environ.get('DISPLAY_QUALITY', '85'))
+# Tag on originals whose full-size view and grid images are derived copies; the
+# lifecycle rule moves only these to infrequent access
+ARCHIVABLE_ORIGINAL_TAG = 'archivable=true'
+
+BLURHASH_COMPONENTS = (4, 3)  # Horizontal and vertical components of the placeholder
+BLURHASH_CHARACTERS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+IMAGE_HEADER_BYTES = 256 * 1024  # Enough for the EXIF block of larger pictures, read with a ranged GET
+
+PICTURE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')  # Keys listed, counted and ingested as pictures
+
+# Incrementally maintained gallery counters, recounted by the reconciliation job
+STATS_KEY = 'stats/gallery.json'
+STATS_SNAPSHOT_KEY = 'stats/snapshot.npz'  # Columnar per-picture snapshot for detailed stats
+STATS_SNAPSHOT_MAX_AGE_SECONDS = int(os.environ.get('STATS_SNAPSHOT_MAX_AGE_SECONDS', '3600'))  # Snapshot age that starts a reconciliation
+STATS_TOP_K = 10
+STATS_PERIODS = {'day': 'D', 'week': 'D', 'month': 'M'}  # NumPy unit each period is counted in
+JSON_UPDATE_MAX_ATTEMPTS = 8  # Conditional write attempts before giving up on a contended object
+EMPTY_STATS = {
+    'totalPictures': 0,
+    'totalStorage': 0,
+    'ratingSum': 0,
+    'ratedPictures': 0,
+    'totalComments': 0,
+    'lastUpload': None
+}
+STATS_COUNTERS = ('totalPictures', 'totalStorage', 'ratingSum', 'ratedPictures', 'totalComments')
+
+# Activity rollups: days partitioned by month, months by year, and one object of years
+ROLLUP_PREFIX = 'rollups/'
+ROLLUP_PERIOD_FORMATS = {'day': '%Y-%m-%d', 'month': '%Y-%m', 'year': '%Y'}
+TIMELINE_DEFAULT_PERIODS = {'day': 30, 'month': 12, 'year': 10}
+TIMELINE_MAX_PERIODS = {'day': 366, 'month': 120, 'year': 100}
+EMPTY_ROLLUP = {'uploads': 0, 'ratings': 0, 'comments': 0}
+# Activity is spooled as one object per event, with the counts in its key, and folded into the rollups in batches
+ACTIVITY_PENDING_PREFIX = 'rollups/pending/'
+ACTIVITY_BATCH_KEY = 'rollups/batch.json'  # Batch being folded, kept until its deltas are cleared
+ACTIVITY_LEASE_KEY = 'rollups/lease.json'  # Held by the one fold allowed to run at a time
+ACTIVITY_FOLD_SIZE = int(os.environ.get('ACTIVITY_FOLD_SIZE', '200'))  # Pending deltas that trigger a fold
+ACTIVITY_FOLD_MAX_AGE_SECONDS = int(os.environ.get('ACTIVITY_FOLD_MAX_AGE_SECONDS', '300'))  # Oldest pending delta age that triggers a fold
+ACTIVITY_MAX_BATCH_DELTAS = 5000  # Deltas folded per batch
+ACTIVITY_LEASE_SECONDS = 300
+ACTIVITY_CHECK_INTERVAL_SECONDS = 60  # How often one process looks at the spool
+
+# Listing backend: 's3' reads object metadata, 'iceberg' scans the pictures table kept by ingestion
+PICTURES_LISTING_BACKEND = os.environ.get('PICTURES_LISTING_BACKEND', 's3')
+LISTING_MAX_PAGE_SIZE = 1000
+LISTING_SORT_KEYS = {
+    'date': [('upload_timestamp', 'descending')],
+    'captured': [('picture_date', 'descending'), ('upload_timestamp', 'descending')],
+    'rating': [('rating', 'descending'), ('upload_timestamp', 'descending')],
+    'name': [('picture_name', 'ascending')]
+}
+
+# Iceberg ingestion: picture changes spool one record each, written to the table in batches
+ICEBERG_INGEST_ENABLED = os.environ.get(
+    'ICEBERG_INGEST_ENABLED', 'true' if PICTURES_LISTING_BACKEND == 'iceberg' else 'false'
+).lower() == 'true'
+INGEST_PENDING_PREFIX = 'ingest/pending/'
+INGEST_BATCH_KEY = 'ingest/batch.json'  # Batch being committed, kept until its records are cleared
+INGEST_LEASE_KEY = 'ingest/lease.json'  # Held by the one flush allowed to run at a time
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', '500'))  # Pending records that trigger a flush
+INGEST_MAX_AGE_SECONDS = int(os.environ.get('INGEST_MAX_AGE_SECONDS', '300'))  # Oldest pending record age that triggers a flush
+INGEST_MAX_BATCH_RECORDS = 10000  # Records committed in one append
+INGEST_LEASE_SECONDS = 600
+INGEST_CHECK_INTERVAL_SECONDS = 60  # How often one process looks at the spool's age
+INGEST_BACKFILL_PAGE_SIZE = 100  # Pictures listed and spooled between checks of the remaining time
+INGEST_BACKFILL_TIME_RESERVE_MS = 15000  # Hand the backfill to a new invocation when less time than this remains
+
+# Content-addressed index mapping SHA-256 digests to stored pictures
+HASH_INDEX_PREFIX = 'hashes/'
+
+# Perceptual (dHash) index of empty marker objects keyed {hash}/{picture}, for near-duplicates
+PERCEPTUAL_INDEX_PREFIX = 'perceptual-hashes/'
+PERCEPTUAL_DUPLICATE_DISTANCE = int(os.environ.get('PERCEPTUAL_DUPLICATE_DISTANCE', '6'))  # Max differing bits of 64
+PERCEPTUAL_INDEX_TTL_SECONDS = int(os.environ.get('PERCEPTUAL_INDEX_TTL_SECONDS', '300'))
+# All perceptual index markers in one object, rebuilt by a worker so uploads never list them
+PERCEPTUAL_INDEX_SNAPSHOT_KEY = 'perceptual-index.json'
+
+# Resumable multipart uploads for large originals
+MULTIPART_PART_SIZE = int(os.environ.get('MULTIPART_PART_SIZE', str(8 * 1024 ** 2)))
+
+# Batch uploads (multipart/form-data or raw binary request bodies)
+BATCH_READ_SIZE = 64 * 1024
+UPLOAD_CONCURRENCY = int(os.environ.get('UPLOAD_CONCURRENCY', '4'))  # Parallel uploads per browser
+
+# Uploaded pictures are held in memory up to this size, then spill to /tmp
+UPLOAD_SPOOL_MAX_MEMORY = int(os.environ.get('UPLOAD_SPOOL_MAX_MEMORY', str(16 * 1024 ** 2)))
+BASE64_DECODE_CHUNK_SIZE = 4 * 64 * 1024  # Whole base64 quanta, so each chunk decodes on its own
+
+# Leading bytes identifying the picture formats we accept
+IMAGE_SIGNATURES = (
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp')
+)
+
+# Archive formats offered for downloads: extension and content type
+ARCHIVE_FORMATS = {
+    'zip': ('.zip', 'application/zip'),
+    'tar': ('.tar', 'application/x-tar'),
+    'tar.zst': ('.tar.zst', 'application/zstd')
+}
+
+ZSTD_LEVEL = 3
+COMPRESSED_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp', '.avif')
+
+# Asynchronous download jobs
+JOBS_PREFIX = 'jobs/'
+ARCHIVE_PART_SIZE = 8 * 1024 ** 2  # S3 multipart parts must be at least 5 MB
+JOB_TIME_RESERVE_MS = 60000  # Hand off to a new worker when less time than this remains
+JOB_MAX_RETRIES = 3
+# Job fields describing how far the archive got, persisted only as a consistent set
+JOB_CHECKPOINT_FIELDS = ('parts', 'archiveState', 'bytesWritten', 'picturesDone', 'skipped')
+
 def lambda_handler(event, context):
     """
     Unified Lambda handler for both frontend and backend
     """
     try:
         # Log the incoming event for debugging
-        print(f"Event: {json.dumps(event)}")
+        # The body is left out, since uploads would copy whole pictures into the log
+        print(f"Event: {json.dumps({key: value for key, value in event.items() if key != 'body'})}")
+        
+        # Worker invocations for asynchronous download jobs
+        if 'download_job' in event:
+            return run_download_job(event['download_job'], context)
+        
+        # Scheduled recount of the gallery stats
+        if 'reconcile_stats' in event:
+            return reconcile_stats()
+        
+        if 'fold_activity' in event:
+            return fold_activity()
+        
+        if 'flush_ingest' in event:
+            return flush_ingest(force=event.get('force', False))
+        
+        if 'backfill_ingest' in event:
+            return backfill_ingest(context, event.get('continuationToken'))
+        
+        if 'rebuild_perceptual_index' in event:
+            rebuild_perceptual_index()
+            return {'rebuilt': True}
         
         # Get the path from the event
         path = event.get('rawPath', '/')
@@ -39,19 +228,41 @@ def lambda_handler(event, context):
         elif path == '/script.js':
             return serve_js()
         elif path == '/api/pictures' and method == 'GET':
-            return get_pictures()
+            return get_pictures(event)
         elif path == '/api/pictures' and method == 'POST':
             return upload_picture(event)
         elif path == '/api/pictures' and method == 'DELETE':
             return delete_pictures(event)
+        elif path == '/api/pictures/duplicates' and method == 'GET':
+            return get_duplicates(event)
+        elif path == '/api/pictures/batch' and method == 'POST':
+            return upload_picture_batch(event)
+        elif path == '/api/pictures/upload-url' and method == 'POST':
+            return create_upload_url(event)
+        elif path == '/api/pictures/upload-complete' and method == 'POST':
+            return complete_upload(event)
+        elif path == '/api/uploads/multipart' and method == 'POST':
+            return initiate_multipart_upload(event)
+        elif path == '/api/uploads/multipart/part-url' and method == 'POST':
+            return create_part_upload_url(event)
+        elif path == '/api/uploads/multipart/parts' and method == 'GET':
+            return list_uploaded_parts(event)
+        elif path == '/api/uploads/multipart/complete' and method == 'POST':
+            return complete_multipart_upload(event)
+        elif path == '/api/uploads/multipart/abort' and method == 'POST':
+            return abort_multipart_upload(event)
         elif path == '/api/pictures/rate' and method == 'POST':
             return rate_picture(event)
         elif path == '/api/pictures/comment' and method == 'POST':
             return add_comment(event)
         elif path == '/api/pictures/download' and method == 'POST':
             return download_pictures(event)
+        elif path.startswith('/api/jobs/') and method == 'GET':
+            return get_download_job(path[len('/api/jobs/'):])
         elif path == '/api/stats' and method == 'GET':
-            return get_stats()
+            return get_stats(event)
+        elif path == '/api/stats/timeline' and method == 'GET':
+            return get_timeline(event)
         else:
             return {
                 'statusCode': 404,
@@ -107,8 +318,13 @@ def serve_html():
                 <div class="upload-section">
                     <input type="file" id="fileInput" accept="image/*" multiple>
                     <button id="uploadBtn" onclick="uploadPictures()">Upload Pictures</button>
+                    <select id="sortOrder" class="sort-order" title="Sort order" onchange="loadPictures()">
+                        <option value="date">Newest uploads</option>
+                        <option value="captured">Date taken</option>
+                    </select>
                     <button id="downloadModeBtn" class="download-mode-button" onclick="enterDownloadMode()" style="display: none;">📥 Download</button>
                 </div>
+                <div id="uploadProgress" class="upload-progress"></div>
                 
                 <div id="deleteSection" class="delete-section" style="display: none;">
                     <button id="selectAllBtn" onclick="toggleSelectAll()">Select All</button>
@@ -119,6 +335,11 @@ def serve_html():
                 
                 <div id="downloadSection" class="download-section" style="display: none;">
                     <button id="selectAllDownloadBtn" onclick="toggleSelectAllDownload()">Select All</button>
+                    <select id="downloadFormat" class="download-format" title="Archive format">
+                        <option value="zip">ZIP</option>
+                        <option value="tar">TAR</option>
+                        <option value="tar.zst">TAR.ZST</option>
+                    </select>
                     <button id="downloadSelectedBtn" onclick="downloadSelected()" class="download-btn">📥 Download Selected</button>
                     <button onclick="cancelDownloadSelection()" class="cancel-btn">Cancel</button>
                     <span id="selectedDownloadCount" class="selected-count">0 selected</span>
@@ -294,6 +515,23 @@ def serve_css():
         transform: translateY(-2px);
     }
 
+    .download-format {
+        padding: 9px 12px;
+        border: none;
+        border-radius: 8px;
+        font-size: 14px;
+        cursor: pointer;
+    }
+
+    .sort-order {
+        padding: 10px 12px;
+        border: 2px solid #667eea;
+        border-radius: 8px;
+        background: #f8f9ff;
+        font-size: 14px;
+        cursor: pointer;
+    }
+
     .delete-btn:hover {
         background: #c53030;
         transform: translateY(-2px);
@@ -553,6 +791,34 @@ def serve_css():
         flex-wrap: wrap;
     }
 
+    .upload-progress {
+        max-width: 600px;
+        margin: 10px auto 0;
+    }
+
+    .upload-progress-item {
+        display: grid;
+        grid-template-columns: 1fr 120px;
+        gap: 4px 10px;
+        align-items: center;
+        font-size: 14px;
+        margin-bottom: 6px;
+    }
+
+    .upload-progress-item progress {
+        width: 100%;
+    }
+
+    .upload-progress-status {
+        grid-column: 1 / -1;
+        color: #718096;
+        font-size: 12px;
+    }
+
+    .upload-progress-item.failed .upload-progress-status {
+        color: #e53e3e;
+    }
+
     input[type="file"] {
         padding: 10px;
         border: 2px dashed #667eea;
@@ -612,7 +878,13 @@ def serve_css():
         box-shadow: 0 12px 40px rgba(0, 0, 0, 0.15);
     }
 
+    .picture-card picture {
+        display: block;
+    }
+
     .picture-card img {
+        background-size: cover;
+        background-position: center;
         width: 100%;
         height: 250px;
         object-fit: cover;
@@ -734,6 +1006,21 @@ def serve_css():
         color: #667eea;
     }
 
+    .timeline-chart {
+        display: flex;
+        align-items: flex-end;
+        gap: 2px;
+        height: 60px;
+        padding-top: 10px;
+    }
+
+    .timeline-bar {
+        flex: 1;
+        min-height: 2px;
+        background: #667eea;
+        border-radius: 2px 2px 0 0;
+    }
+
     @media (max-width: 768px) {
         .container {
             padding: 10px;
@@ -769,6 +1056,30 @@ def serve_js():
     // Configuration - API calls to same Lambda function
     const API_BASE_URL = window.location.origin;
     
+    // Files up to this size are sent together in one batch request, kept
+    // under the 6 MB Lambda request payload limit once encoded
+    const BATCH_MAX_BYTES = 4 * 1024 * 1024;
+    
+    // Placeholders are decoded at this size and stretched over the tile
+    const BLURHASH_SIZE = 32;
+    const BLURHASH_CHARACTERS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~';
+    
+    // Rendered width of grid images, so the browser can pick a srcset candidate
+    const GRID_IMAGE_SIZES = '(max-width: 600px) 100vw, 400px';
+    
+    // Selections at least this large are downloaded through a background job
+    const ASYNC_DOWNLOAD_THRESHOLD = 25;
+    const JOB_POLL_INTERVAL_MS = 2000;
+    
+    // Upload tasks in flight at once, and retries of a failed task with exponential backoff
+    const UPLOAD_CONCURRENCY = __UPLOAD_CONCURRENCY__;
+    const UPLOAD_MAX_ATTEMPTS = 4;
+    const UPLOAD_RETRY_BASE_MS = 1000;
+    
+    // Files at least this large use resumable multipart uploads
+    const MULTIPART_THRESHOLD = 32 * 1024 * 1024;
+    const MULTIPART_CONCURRENCY = 4;
+    
     // Load pictures when page loads
     document.addEventListener('DOMContentLoaded', function() {
         loadPictures();
@@ -783,7 +1094,8 @@ def serve_js():
             loadingMessage.style.display = 'block';
             errorMessage.style.display = 'none';
             
-            const response = await fetch(`${API_BASE_URL}/api/pictures`);
+            const sort = document.getElementById('sortOrder').value;
+            const response = await fetch(`${API_BASE_URL}/api/pictures?sort=${encodeURIComponent(sort)}`);
             
             if (!response.ok) {
                 throw new Error(`HTTP error! status: ${response.status}`);
@@ -810,52 +1122,172 @@ def serve_js():
     function displayPictures(pictures) {
         const gallery = document.getElementById('gallery');
         
-        gallery.innerHTML = pictures.map(picture => `
-            <div class="picture-card picture-item" data-picture-name="${picture.name}">
-                <input type="checkbox" class="picture-checkbox" onchange="handleCheckboxChange()">
-                <img src="${picture.url}" alt="${picture.name}" onclick="openFullSize('${picture.url}')">
-                <div class="picture-info">
-                    <div class="picture-name">${picture.name}</div>
-                    <div class="picture-date">${new Date(picture.date).toLocaleDateString()}</div>
-                    <div class="picture-rating">
-                        <div class="stars" data-picture="${picture.name}">
-                            ${[1,2,3,4,5].map(star => `
-                                <span class="star ${(picture.rating || 0) >= star ? 'filled' : ''}" 
-                                      data-rating="${star}" 
-                                      onclick="ratePicture('${picture.name}', ${star})">★</span>
-                            `).join('')}
-                        </div>
-                        <span class="rating-text">${picture.rating ? `${picture.rating}/5` : 'Not rated'}</span>
+        gallery.innerHTML = pictures.map(renderPictureCard).join('');
+        paintPlaceholders(gallery);
+    }
+    
+    function renderPictureCard(picture) {
+        return `
+        <div class="picture-card picture-item" data-picture-name="${picture.name}">
+            <input type="checkbox" class="picture-checkbox" onchange="handleCheckboxChange()">
+            <picture>
+                ${renderVariantSources(picture)}
+                <img src="${picture.thumbnailUrl || picture.url}" ${renderSrcset(picture.variants && picture.variants.jpeg)} ${picture.width ? `width="${picture.width}" height="${picture.height}"` : ''} ${picture.blurhash ? `data-blurhash="${picture.blurhash}" onload="this.style.backgroundImage = ''"` : ''} alt="${picture.name}" loading="lazy" onclick="openFullSize('${picture.displayUrl || picture.url}')">
+            </picture>
+            <div class="picture-info">
+                <div class="picture-name">${picture.name}</div>
+                <div class="picture-date">${new Date(picture.capturedAt || picture.date).toLocaleDateString()}${picture.cameraModel ? ` · ${picture.cameraModel}` : ''}</div>
+                <div class="picture-rating">
+                    <div class="stars" data-picture="${picture.name}">
+                        ${[1,2,3,4,5].map(star => `
+                            <span class="star ${(picture.rating || 0) >= star ? 'filled' : ''}" 
+                                  data-rating="${star}" 
+                                  onclick="ratePicture('${picture.name}', ${star})">★</span>
+                        `).join('')}
                     </div>
-                    <div class="comments-section">
-                        <div class="comments-header">
-                            <span class="comments-title">💬 Comments</span>
-                            <button class="toggle-comments" onclick="toggleComments('${picture.name}')">
-                                ${(picture.comments && picture.comments.length > 0) ? `Show ${picture.comments.length}` : 'Add Comment'}
-                            </button>
-                        </div>
-                        <div class="comments-container" id="comments-${picture.name.replace(/[^a-zA-Z0-9]/g, '_')}" style="display: none;">
-                            <div class="existing-comments">
-                                ${(picture.comments || []).map(comment => `
-                                    <div class="comment">
-                                        <div class="comment-header">
-                                            <span class="comment-author">${comment.author}</span>
-                                            <span class="comment-date">${new Date(comment.date).toLocaleDateString()}</span>
-                                        </div>
-                                        <div class="comment-text">${comment.text}</div>
+                    <span class="rating-text">${picture.rating ? `${picture.rating}/5` : 'Not rated'}</span>
+                </div>
+                <div class="comments-section">
+                    <div class="comments-header">
+                        <span class="comments-title">💬 Comments</span>
+                        <button class="toggle-comments" onclick="toggleComments('${picture.name}')">
+                            ${(picture.comments && picture.comments.length > 0) ? `Show ${picture.comments.length}` : 'Add Comment'}
+                        </button>
+                    </div>
+                    <div class="comments-container" id="comments-${picture.name.replace(/[^a-zA-Z0-9]/g, '_')}" style="display: none;">
+                        <div class="existing-comments">
+                            ${(picture.comments || []).map(comment => `
+                                <div class="comment">
+                                    <div class="comment-header">
+                                        <span class="comment-author">${comment.author}</span>
+                                        <span class="comment-date">${new Date(comment.date).toLocaleDateString()}</span>
                                     </div>
-                                `).join('')}
-                            </div>
-                            <div class="add-comment-form">
-                                <input type="text" class="comment-name" placeholder="Your name" maxlength="50">
-                                <textarea class="comment-input" placeholder="Write a comment..." maxlength="500"></textarea>
-                                <button class="submit-comment" onclick="submitComment('${picture.name}')">Post Comment</button>
-                            </div>
+                                    <div class="comment-text">${comment.text}</div>
+                                </div>
+                            `).join('')}
+                        </div>
+                        <div class="add-comment-form">
+                            <input type="text" class="comment-name" placeholder="Your name" maxlength="50">
+                            <textarea class="comment-input" placeholder="Write a comment..." maxlength="500"></textarea>
+                            <button class="submit-comment" onclick="submitComment('${picture.name}')">Post Comment</button>
                         </div>
                     </div>
                 </div>
             </div>
-        `).join('');
+        </div>
+        `;
+    }
+    
+    function insertPicture(picture) {
+        const gallery = document.getElementById('gallery');
+        
+        // Replace the empty-gallery message with the first picture
+        if (!gallery.querySelector('.picture-card')) {
+            gallery.innerHTML = '';
+        }
+        // Newest first, matching the listing order
+        gallery.insertAdjacentHTML('afterbegin', renderPictureCard(picture));
+        paintPlaceholders(gallery.firstElementChild);
+    }
+    
+    function paintPlaceholders(container) {
+        // Show each picture's BlurHash behind it until the image itself has loaded
+        container.querySelectorAll('img[data-blurhash]').forEach(img => {
+            if (img.complete && img.naturalWidth > 0) {
+                return;
+            }
+            try {
+                const canvas = document.createElement('canvas');
+                canvas.width = BLURHASH_SIZE;
+                canvas.height = BLURHASH_SIZE;
+                const pixels = decodeBlurHash(img.dataset.blurhash, BLURHASH_SIZE, BLURHASH_SIZE);
+                canvas.getContext('2d').putImageData(new ImageData(pixels, BLURHASH_SIZE, BLURHASH_SIZE), 0, 0);
+                img.style.backgroundImage = `url(${canvas.toDataURL()})`;
+            } catch (error) {
+                console.error('Error decoding placeholder:', error);
+            }
+        });
+    }
+    
+    function decode83(value) {
+        let result = 0;
+        for (const character of value) {
+            result = result * 83 + BLURHASH_CHARACTERS.indexOf(character);
+        }
+        return result;
+    }
+    
+    function srgbToLinear(value) {
+        const v = value / 255;
+        return v <= 0.04045 ? v / 12.92 : Math.pow((v + 0.055) / 1.055, 2.4);
+    }
+    
+    function linearToSrgb(value) {
+        const v = Math.max(0, Math.min(1, value));
+        return v <= 0.0031308
+            ? Math.round(v * 12.92 * 255 + 0.5)
+            : Math.round((1.055 * Math.pow(v, 1 / 2.4) - 0.055) * 255 + 0.5);
+    }
+    
+    function signedSquare(value) {
+        return Math.sign(value) * value * value;
+    }
+    
+    function decodeBlurHash(blurhash, width, height) {
+        const sizeFlag = decode83(blurhash[0]);
+        const componentsX = sizeFlag % 9 + 1;
+        const componentsY = Math.floor(sizeFlag / 9) + 1;
+        const maximumValue = (decode83(blurhash[1]) + 1) / 166;
+        
+        const colors = [];
+        const dc = decode83(blurhash.substring(2, 6));
+        colors.push([srgbToLinear(dc >> 16), srgbToLinear((dc >> 8) & 255), srgbToLinear(dc & 255)]);
+        for (let i = 1; i < componentsX * componentsY; i++) {
+            const ac = decode83(blurhash.substring(4 + i * 2, 6 + i * 2));
+            colors.push([
+                signedSquare((Math.floor(ac / 361) - 9) / 9) * maximumValue,
+                signedSquare((Math.floor(ac / 19) % 19 - 9) / 9) * maximumValue,
+                signedSquare((ac % 19 - 9) / 9) * maximumValue
+            ]);
+        }
+        
+        const pixels = new Uint8ClampedArray(width * height * 4);
+        for (let y = 0; y < height; y++) {
+            for (let x = 0; x < width; x++) {
+                let r = 0, g = 0, b = 0;
+                for (let j = 0; j < componentsY; j++) {
+                    for (let i = 0; i < componentsX; i++) {
+                        const basis = Math.cos(Math.PI * x * i / width) * Math.cos(Math.PI * y * j / height);
+                        const color = colors[i + j * componentsX];
+                        r += color[0] * basis;
+                        g += color[1] * basis;
+                        b += color[2] * basis;
+                    }
+                }
+                const offset = (y * width + x) * 4;
+                pixels[offset] = linearToSrgb(r);
+                pixels[offset + 1] = linearToSrgb(g);
+                pixels[offset + 2] = linearToSrgb(b);
+                pixels[offset + 3] = 255;
+            }
+        }
+        return pixels;
+    }
+    
+    function renderSrcset(variants) {
+        if (!variants || variants.length === 0) {
+            return '';
+        }
+        const srcset = variants.map(variant => `${variant.url} ${variant.width}w`).join(', ');
+        return `srcset="${srcset}" sizes="${GRID_IMAGE_SIZES}"`;
+    }
+    
+    function renderVariantSources(picture) {
+        // Most compact formats first - the browser takes the first type it supports
+        return ['avif', 'webp']
+            .filter(format => picture.variants && picture.variants[format])
+            .map(format => `<source type="image/${format}" ${renderSrcset(picture.variants[format])}>`)
+            .join('');
     }
     
     function openFullSize(url) {
@@ -886,9 +1318,60 @@ def serve_js():
         uploadButton.textContent = 'Uploading...';
         
         try {
-            for (let i = 0; i < files.length; i++) {
-                const file = files[i];
-                await uploadSinglePicture(file);
+            // Small files share batch requests; larger ones go straight to S3
+            const small = Array.from(files).filter(file => file.size <= BATCH_MAX_BYTES);
+            const large = Array.from(files).filter(file => file.size > BATCH_MAX_BYTES);
+            const tasks = [
+                ...groupUploadBatches(small).map(batch => {
+                    const pending = new Set(batch);
+                    return {
+                        files: batch,
+                        run: (onProgress, onUploaded) => uploadPictureBatch(pending, onUploaded)
+                    };
+                }),
+                ...large.map(file => ({
+                    files: [file],
+                    run: (onProgress, onUploaded) => uploadSinglePicture(file, onProgress).then(result => {
+                        onUploaded(result);
+                        return result;
+                    })
+                }))
+            ];
+            
+            const progressRows = showUploadProgress(Array.from(files));
+            const failures = [];
+            
+            await runUploadQueue(tasks, UPLOAD_CONCURRENCY, async task => {
+                const rows = task.files.map(file => progressRows.get(file));
+                const uploaded = [];
+                try {
+                    setUploadProgress(rows, 'Uploading...', 0);
+                    // Show finished pictures right away, even when others in the batch must be retried;
+                    // duplicates are already in the grid
+                    const onUploaded = item => {
+                        uploaded.push(item);
+                        if (item.picture) {
+                            insertPicture(item.picture);
+                        }
+                    };
+                    await withRetries(
+                        () => task.run(fraction => setUploadProgress(rows, 'Uploading...', fraction), onUploaded),
+                        (attempt, delay) => setUploadProgress(rows, `Retrying in ${Math.round(delay / 1000)}s (attempt ${attempt + 1} of ${UPLOAD_MAX_ATTEMPTS})...`, 0)
+                    );
+                    
+                    const similarCount = uploaded.reduce((count, item) => count + (item.similar || []).length, 0);
+                    setUploadProgress(rows, similarCount > 0
+                        ? `Done - looks like ${similarCount} picture(s) already in the gallery`
+                        : 'Done', 1);
+                } catch (error) {
+                    console.error('Upload error:', error);
+                    failures.push(...task.files.map(file => `${file.name}: ${error.message}`));
+                    setUploadProgress(rows, `Failed: ${error.message}`, 0, true);
+                }
+            });
+            
+            if (failures.length > 0) {
+                throw new Error(`${failures.length} of ${files.length} picture(s) failed to upload`);
             }
             
             // Show success message
@@ -897,14 +1380,14 @@ def serve_js():
             successDiv.textContent = `Successfully uploaded ${files.length} picture(s)!`;
             document.querySelector('.container').insertBefore(successDiv, document.querySelector('main'));
             
-            // Remove success message after 3 seconds
+            // Remove success message and progress after 3 seconds
             setTimeout(() => {
                 successDiv.remove();
+                document.getElementById('uploadProgress').innerHTML = '';
             }, 3000);
             
-            // Clear file input and reload pictures
+            // Clear file input
             fileInput.value = '';
-            loadPictures();
             
         } catch (error) {
             console.error('Upload error:', error);
@@ -915,49 +1398,281 @@ def serve_js():
         }
     }
     
-    async function uploadSinglePicture(file) {
-        return new Promise((resolve, reject) => {
-            const reader = new FileReader();
-            
-            reader.onload = async function(e) {
-                try {
-                    const base64Data = e.target.result.split(',')[1];
-                    
-                    const uploadData = {
-                        name: file.name,
-                        data: base64Data,
-                        contentType: file.type
-                    };
-                    
-                    const response = await fetch(`${API_BASE_URL}/api/pictures`, {
-                        method: 'POST',
-                        headers: {
-                            'Content-Type': 'application/json',
-                        },
-                        body: JSON.stringify(uploadData)
-                    });
-                    
-                    if (!response.ok) {
-                        const errorData = await response.json();
-                        throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
-                    }
-                    
-                    const result = await response.json();
-                    console.log('Upload successful:', result);
-                    resolve(result);
-                    
-                } catch (error) {
-                    console.error('Error uploading file:', error);
-                    reject(error);
+    async function runUploadQueue(tasks, concurrency, runTask) {
+        const pending = tasks.slice();
+        
+        async function worker() {
+            while (pending.length > 0) {
+                await runTask(pending.shift());
+            }
+        }
+        
+        const workers = Math.min(concurrency, pending.length);
+        await Promise.all(Array.from({ length: workers }, worker));
+    }
+    
+    async function withRetries(operation, onRetry) {
+        for (let attempt = 1; ; attempt++) {
+            try {
+                return await operation();
+            } catch (error) {
+                // Client errors will fail the same way again
+                const retryable = !error.status || error.status === 429 || error.status >= 500;
+                if (!retryable || attempt >= UPLOAD_MAX_ATTEMPTS) {
+                    throw error;
                 }
-            };
+                // Jitter keeps parallel uploads from retrying in lockstep
+                const delay = UPLOAD_RETRY_BASE_MS * 2 ** (attempt - 1) * (0.5 + Math.random());
+                onRetry(attempt, delay);
+                await new Promise(resolve => setTimeout(resolve, delay));
+            }
+        }
+    }
+    
+    function showUploadProgress(files) {
+        const container = document.getElementById('uploadProgress');
+        container.innerHTML = '';
+        
+        const rows = new Map();
+        files.forEach(file => {
+            const row = document.createElement('div');
+            row.className = 'upload-progress-item';
             
-            reader.onerror = function() {
-                reject(new Error('Error reading file'));
-            };
+            const name = document.createElement('span');
+            name.textContent = file.name;
+            const bar = document.createElement('progress');
+            bar.max = 1;
+            bar.value = 0;
+            const status = document.createElement('span');
+            status.className = 'upload-progress-status';
+            status.textContent = 'Queued';
             
-            reader.readAsDataURL(file);
+            row.append(name, bar, status);
+            container.appendChild(row);
+            rows.set(file, row);
+        });
+        return rows;
+    }
+    
+    function setUploadProgress(rows, statusText, fraction, failed = false) {
+        rows.forEach(row => {
+            row.querySelector('progress').value = fraction;
+            row.querySelector('.upload-progress-status').textContent = statusText;
+            row.classList.toggle('failed', failed);
+        });
+    }
+    
+    function httpError(message, status) {
+        const error = new Error(message);
+        error.status = status;
+        return error;
+    }
+    
+    function groupUploadBatches(files) {
+        const batches = [];
+        let batch = [];
+        let batchBytes = 0;
+        
+        files.forEach(file => {
+            if (batch.length > 0 && batchBytes + file.size > BATCH_MAX_BYTES) {
+                batches.push(batch);
+                batch = [];
+                batchBytes = 0;
+            }
+            batch.push(file);
+            batchBytes += file.size;
+        });
+        if (batch.length > 0) {
+            batches.push(batch);
+        }
+        return batches;
+    }
+    
+    async function uploadPictureBatch(pending, onUploaded) {
+        // pending holds the files not stored yet, so a retry sends only those
+        const files = Array.from(pending);
+        const formData = new FormData();
+        files.forEach(file => formData.append('files', file, file.name));
+        
+        const response = await fetch(`${API_BASE_URL}/api/pictures/batch`, {
+            method: 'POST',
+            body: formData
         });
+        
+        if (!response.ok) {
+            throw httpError(`HTTP error! status: ${response.status}`, response.status);
+        }
+        
+        const result = await response.json();
+        result.uploaded.forEach(onUploaded);
+        
+        // Failures are reported by file name; everything else in the request was stored
+        const failedNames = result.failed.map(failure => failure.name);
+        files.forEach(file => {
+            const index = failedNames.indexOf(file.name);
+            if (index >= 0) {
+                failedNames.splice(index, 1);
+            } else {
+                pending.delete(file);
+            }
+        });
+        if (result.failed.length > 0) {
+            throw new Error(result.failed.map(failure => `${failure.name}: ${failure.error}`).join(', '));
+        }
+        console.log('Batch upload successful:', result);
+        return result;
+    }
+    
+    async function postJson(path, payload) {
+        const response = await fetch(`${API_BASE_URL}${path}`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify(payload)
+        });
+        
+        if (!response.ok) {
+            const errorData = await response.json().catch(() => ({}));
+            throw httpError(errorData.error || `HTTP error! status: ${response.status}`, response.status);
+        }
+        
+        return response.json();
+    }
+    
+    async function uploadMultipartPicture(file, onProgress = () => {}) {
+        // Remember the upload so picking the same file again after a reload resumes it
+        const sessionKey = `multipart:${file.name}:${file.size}:${file.lastModified}`;
+        let session = JSON.parse(localStorage.getItem(sessionKey) || 'null');
+        const completedParts = new Map();
+        
+        if (session) {
+            const query = `key=${encodeURIComponent(session.key)}&uploadId=${encodeURIComponent(session.uploadId)}`;
+            const response = await fetch(`${API_BASE_URL}/api/uploads/multipart/parts?${query}`);
+            if (response.ok) {
+                const data = await response.json();
+                data.parts.forEach(part => completedParts.set(part.PartNumber, part.ETag));
+                console.log(`Resuming upload of ${file.name}: ${completedParts.size} parts already uploaded`);
+            } else {
+                // The upload expired or was finished elsewhere - start over
+                session = null;
+            }
+        }
+        
+        if (!session) {
+            session = await postJson('/api/uploads/multipart', {
+                name: file.name,
+                contentType: file.type,
+                size: file.size
+            });
+            localStorage.setItem(sessionKey, JSON.stringify(session));
+        }
+        
+        const partCount = Math.max(1, Math.ceil(file.size / session.partSize));
+        const pendingParts = [];
+        for (let partNumber = 1; partNumber <= partCount; partNumber++) {
+            if (!completedParts.has(partNumber)) {
+                pendingParts.push(partNumber);
+            }
+        }
+        
+        async function uploadParts() {
+            while (pendingParts.length > 0) {
+                const partNumber = pendingParts.shift();
+                const { url } = await postJson('/api/uploads/multipart/part-url', {
+                    key: session.key,
+                    uploadId: session.uploadId,
+                    partNumber: partNumber
+                });
+                
+                const start = (partNumber - 1) * session.partSize;
+                const response = await fetch(url, {
+                    method: 'PUT',
+                    body: file.slice(start, start + session.partSize)
+                });
+                
+                if (!response.ok) {
+                    throw httpError(`Part ${partNumber} upload failed! status: ${response.status}`, response.status);
+                }
+                completedParts.set(partNumber, response.headers.get('ETag'));
+                onProgress(completedParts.size / partCount);
+            }
+        }
+        
+        // Several parts in flight at once keeps high-latency links busy
+        const workers = Math.min(MULTIPART_CONCURRENCY, pendingParts.length);
+        await Promise.all(Array.from({ length: workers }, uploadParts));
+        
+        const parts = Array.from(completedParts, ([PartNumber, ETag]) => ({ PartNumber, ETag }));
+        try {
+            const result = await postJson('/api/uploads/multipart/complete', {
+                key: session.key,
+                uploadId: session.uploadId,
+                parts: parts
+            });
+            localStorage.removeItem(sessionKey);
+            return result;
+        } catch (error) {
+            // The parts cannot be assembled, so resuming would only repeat the failure
+            localStorage.removeItem(sessionKey);
+            await postJson('/api/uploads/multipart/abort', {
+                key: session.key,
+                uploadId: session.uploadId
+            }).catch(abortError => console.error('Error aborting upload:', abortError));
+            throw error;
+        }
+    }
+    
+    async function computeSha256(file) {
+        // WebCrypto is only available in secure contexts
+        if (!window.crypto || !window.crypto.subtle) {
+            return null;
+        }
+        const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        return Array.from(new Uint8Array(digest), byte => byte.toString(16).padStart(2, '0')).join('');
+    }
+    
+    async function uploadSinglePicture(file, onProgress = () => {}) {
+        if (file.size >= MULTIPART_THRESHOLD) {
+            return uploadMultipartPicture(file, onProgress);
+        }
+        
+        try {
+            // Get a presigned POST so the file goes straight to S3 as raw bytes
+            const target = await postJson('/api/pictures/upload-url', {
+                name: file.name,
+                contentType: file.type,
+                size: file.size,
+                sha256: await computeSha256(file)
+            });
+            
+            if (target.deduplicated) {
+                // Identical content is already stored - nothing to upload
+                console.log('Upload deduplicated:', target);
+                return target;
+            }
+            
+            const formData = new FormData();
+            Object.entries(target.fields).forEach(([name, value]) => formData.append(name, value));
+            formData.append('file', file);  // S3 requires the file to be the last field
+            
+            const s3Response = await fetch(target.url, {
+                method: 'POST',
+                body: formData
+            });
+            
+            if (!s3Response.ok) {
+                throw httpError(`Storage upload failed! status: ${s3Response.status}`, s3Response.status);
+            }
+            
+            const result = await postJson('/api/pictures/upload-complete', { key: target.key });
+            console.log('Upload successful:', result);
+            return result;
+            
+        } catch (error) {
+            console.error('Error uploading file:', error);
+            throw error;
+        }
     }
     
     async function showStats() {
@@ -971,7 +1686,7 @@ def serve_js():
         statsContent.innerHTML = '<div class="loading">Loading statistics...</div>';
         
         try {
-            const response = await fetch(`${API_BASE_URL}/api/stats`);
+            const response = await fetch(`${API_BASE_URL}/api/stats?detail=full`);
             
             if (!response.ok) {
                 throw new Error(`HTTP error! status: ${response.status}`);
@@ -998,12 +1713,47 @@ def serve_js():
                     <span class="stats-label">💾 Total Storage</span>
                     <span class="stats-value">${formatBytes(stats.totalStorage)}</span>
                 </div>
+                <div class="stats-item">
+                    <span class="stats-label">⭐ Average Rating</span>
+                    <span class="stats-value">${stats.ratedPictures ? `${stats.averageRating.toFixed(1)}/5 (${stats.ratedPictures} rated)` : 'Not rated'}</span>
+                </div>
+                <div class="stats-item">
+                    <span class="stats-label">💬 Comments</span>
+                    <span class="stats-value">${stats.totalComments}</span>
+                </div>
+                <div class="stats-item">
+                    <span class="stats-label">📤 Last Upload</span>
+                    <span class="stats-value">${stats.lastUpload ? new Date(stats.lastUpload).toLocaleString() : 'Never'}</span>
+                </div>
                 <div class="stats-item">
                     <span class="stats-label">📅 Last Updated</span>
-                    <span class="stats-value">${new Date().toLocaleString()}</span>
+                    <span class="stats-value">${new Date(stats.updated || Date.now()).toLocaleString()}</span>
                 </div>
             `;
             
+            const detail = stats.detail;
+            if (detail) {
+                const histogram = [5, 4, 3, 2, 1]
+                    .map(stars => `${'⭐'.repeat(stars)} ${detail.ratingHistogram[stars]}`)
+                    .join('<br>');
+                statsContent.innerHTML += `
+                    <div class="stats-item">
+                        <span class="stats-label">📏 Median / 95th Percentile Size</span>
+                        <span class="stats-value">${formatBytes(detail.sizePercentiles.p50)} / ${formatBytes(detail.sizePercentiles.p95)}</span>
+                    </div>
+                    <div class="stats-item">
+                        <span class="stats-label">📊 Ratings</span>
+                        <span class="stats-value">${histogram}</span>
+                    </div>
+                    <div class="stats-item">
+                        <span class="stats-label">🕒 Breakdown As Of</span>
+                        <span class="stats-value">${new Date(stats.detailGenerated).toLocaleString()}</span>
+                    </div>
+                `;
+            }
+            
+            await showUploadTimeline(statsContent);
+            
         } catch (error) {
             console.error('Error loading stats:', error);
             statsContent.innerHTML = `
@@ -1014,6 +1764,30 @@ def serve_js():
         }
     }
     
+    async function showUploadTimeline(container) {
+        // The chart is an extra; the counters above are shown even if it fails
+        try {
+            const response = await fetch(`${API_BASE_URL}/api/stats/timeline?granularity=day`);
+            if (!response.ok) return;
+            
+            const { timeline } = await response.json();
+            const peak = Math.max(1, ...timeline.map(entry => entry.uploads));
+            const bars = timeline.map(entry => `
+                <div class="timeline-bar" style="height: ${(entry.uploads / peak) * 100}%"
+                     title="${entry.period}: ${entry.uploads} upload(s), ${entry.ratings} rating(s), ${entry.comments} comment(s)"></div>
+            `).join('');
+            
+            container.innerHTML += `
+                <div class="stats-item" style="display: block;">
+                    <span class="stats-label">📈 Uploads, Last 30 Days</span>
+                    <div class="timeline-chart">${bars}</div>
+                </div>
+            `;
+        } catch (error) {
+            console.error('Error loading upload timeline:', error);
+        }
+    }
+    
     function closeStats() {
         const modal = document.getElementById('statsModal');
         modal.style.display = 'none';
@@ -1297,6 +2071,7 @@ def serve_js():
         }
         
         const downloadBtn = document.getElementById('downloadSelectedBtn');
+        const archiveFormat = document.getElementById('downloadFormat').value;
         downloadBtn.disabled = true;
         downloadBtn.textContent = 'Preparing Download...';
         
@@ -1308,7 +2083,10 @@ def serve_js():
                     'Content-Type': 'application/json',
                 },
                 body: JSON.stringify({
-                    pictures: pictureNames
+                    pictures: pictureNames,
+                    format: archiveFormat,
+                    // Large selections are built by a background job instead of one long request
+                    async: pictureNames.length >= ASYNC_DOWNLOAD_THRESHOLD
                 })
             });
             
@@ -1317,21 +2095,35 @@ def serve_js():
                 throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
             }
             
-            // Get the ZIP file as blob
-            const blob = await response.blob();
-            
-            // Create download link
-            const url = window.URL.createObjectURL(blob);
             const a = document.createElement('a');
             a.style.display = 'none';
-            a.href = url;
-            a.download = `photos_${new Date().toISOString().split('T')[0]}.zip`;
-            
+            a.download = `photos_${new Date().toISOString().split('T')[0]}.${archiveFormat}`;
+
+            const contentType = response.headers.get('Content-Type') || '';
+            let url = null;
+            if (response.status === 202) {
+                // Download job started - wait for the archive to be built
+                const job = await response.json();
+                const result = await waitForDownloadJob(job.jobId, downloadBtn);
+                a.href = result.url;
+            } else if (contentType.includes('application/json')) {
+                // Cached or streamed archive - download it straight from storage
+                const result = await response.json();
+                a.href = result.url;
+            } else {
+                // Get the ZIP file as blob
+                const blob = await response.blob();
+                url = window.URL.createObjectURL(blob);
+                a.href = url;
+            }
+
             document.body.appendChild(a);
             a.click();
-            
+
             // Cleanup
-            window.URL.revokeObjectURL(url);
+            if (url) {
+                window.URL.revokeObjectURL(url);
+            }
             document.body.removeChild(a);
             
             // Show success message
@@ -1354,10 +2146,33 @@ def serve_js():
         }
     }
     
-    async function ratePicture(pictureName, rating) {
-        try {
-            const response = await fetch(`${API_BASE_URL}/api/pictures/rate`, {
-                method: 'POST',
+    async function waitForDownloadJob(jobId, downloadBtn) {
+        while (true) {
+            await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+            
+            const response = await fetch(`${API_BASE_URL}/api/jobs/${jobId}`);
+            if (!response.ok) {
+                const errorData = await response.json();
+                throw new Error(errorData.error || `HTTP error! status: ${response.status}`);
+            }
+            
+            const job = await response.json();
+            if (job.status === 'complete') {
+                return job;
+            }
+            if (job.status === 'failed') {
+                throw new Error(job.error || 'Download job failed');
+            }
+            
+            const megabytes = (job.bytesWritten / (1024 * 1024)).toFixed(1);
+            downloadBtn.textContent = `Preparing ${job.picturesDone}/${job.pictureCount} (${megabytes} MB)...`;
+        }
+    }
+    
+    async function ratePicture(pictureName, rating) {
+        try {
+            const response = await fetch(`${API_BASE_URL}/api/pictures/rate`, {
+                method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
                 },
@@ -1502,12 +2317,18 @@ def serve_js():
             'Content-Type': 'application/javascript',
             'Access-Control-Allow-Origin': '*'
         },
-        'body': js_content
+        'body': js_content.replace('__UPLOAD_CONCURRENCY__', str(UPLOAD_CONCURRENCY))
     }
 
-def get_pictures():
+def get_pictures(event):
     """Get list of pictures from S3"""
+    if PICTURES_LISTING_BACKEND == 'iceberg':
+        return get_pictures_from_iceberg(event)
+
     try:
+        params = event.get('queryStringParameters') or {}
+        sort = params.get('sort', 'date')
+        
         print(f"Getting pictures from bucket: {PICTURES_BUCKET}")
         
         response = s3_client.list_objects_v2(
@@ -1522,14 +2343,7 @@ def get_pictures():
             print(f"Found {len(response['Contents'])} objects")
             for obj in response['Contents']:
                 print(f"Processing object: {obj['Key']}")
-                if obj['Key'].lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
-                    # Generate presigned URL for the image
-                    url = s3_client.generate_presigned_url(
-                        'get_object',
-                        Params={'Bucket': PICTURES_BUCKET, 'Key': obj['Key']},
-                        ExpiresIn=3600  # 1 hour
-                    )
-                    
+                if is_picture_key(obj['Key']):
                     # Get object metadata to retrieve rating
                     try:
                         head_response = s3_client.head_object(
@@ -1537,38 +2351,21 @@ def get_pictures():
                             Key=obj['Key']
                         )
                         metadata = head_response.get('Metadata', {})
-                        rating = int(metadata.get('rating', 0)) if metadata.get('rating') else 0
-                        original_name = metadata.get('original-name', obj['Key'].split('/')[-1])
-                        
-                        # Parse comments from metadata
-                        comments = []
-                        comments_json = metadata.get('comments', '')
-                        if comments_json:
-                            try:
-                                comments = json.loads(comments_json)
-                            except json.JSONDecodeError as json_error:
-                                print(f"Error parsing comments JSON for {obj['Key']}: {json_error}")
-                                comments = []
                     except Exception as meta_error:
                         print(f"Error getting metadata for {obj['Key']}: {meta_error}")
-                        rating = 0
-                        original_name = obj['Key'].split('/')[-1]
-                        comments = []
+                        metadata = {}
                     
-                    picture_info = {
-                        'name': original_name,
-                        'date': obj['LastModified'].isoformat(),
-                        'url': url,
-                        'rating': rating,
-                        'comments': comments
-                    }
+                    picture_info = get_picture_info(obj['Key'], obj['LastModified'], metadata)
                     pictures.append(picture_info)
-                    print(f"Added picture: {picture_info['name']} (rating: {rating})")
+                    print(f"Added picture: {picture_info['name']} (rating: {picture_info['rating']})")
         else:
             print("No 'Contents' key in S3 response - bucket may be empty or prefix not found")
         
-        # Sort by date (newest first)
-        pictures.sort(key=lambda x: x['date'], reverse=True)
+        # Sort by upload date, or by capture date falling back to upload date (newest first)
+        if sort == 'captured':
+            pictures.sort(key=lambda x: x.get('capturedAt', x['date'][:19]), reverse=True)
+        else:
+            pictures.sort(key=lambda x: x['date'], reverse=True)
         
         print(f"Returning {len(pictures)} pictures")
         
@@ -1591,35 +2388,217 @@ def get_pictures():
             'body': json.dumps({'error': f'Failed to get pictures: {str(e)}'})
         }
 
-def get_stats():
-    """Get gallery statistics from S3"""
+def get_pictures_from_iceberg(event):
+    """
+    Get a page of pictures from the Iceberg table.
+
+    Query parameters: sort (date, captured, rating or name), limit and offset,
+    from and to (inclusive picture dates), name (substring), minRating, and
+    minSize (bytes), minWidth and minHeight (pixels).
+    Without a limit every matching picture is returned, as from S3.
+    Reads also start a flush of a full or aged ingestion spool, and changes
+    still in the spool are laid over the table, so the listing never lags them.
+    """
+    overlay = {}
+    if ICEBERG_INGEST_ENABLED:
+        try:
+            check_ingest_spool()
+            overlay = get_pending_picture_records()
+        except Exception as e:
+            # The listing is served from the table as it stands
+            print(f"Error checking the ingestion spool: {e}")
+
     try:
-        print(f"Getting stats from bucket: {PICTURES_BUCKET}")
-        
-        # List all objects in the pictures folder
-        response = s3_client.list_objects_v2(
-            Bucket=PICTURES_BUCKET,
-            Prefix='pictures/'
+        from iceberg_setup import build_picture_filter, query_picture_page
+
+        params = event.get('queryStringParameters') or {}
+        sort = params.get('sort', 'date')
+        if sort not in LISTING_SORT_KEYS:
+            raise ValueError(f"sort must be one of: {', '.join(LISTING_SORT_KEYS)}")
+        limit = int(params['limit']) if params.get('limit') else None
+        offset = int(params.get('offset') or 0)
+        if limit is not None and not 1 <= limit <= LISTING_MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {LISTING_MAX_PAGE_SIZE}")
+        if offset < 0:
+            raise ValueError("offset must not be negative")
+
+        row_filter = build_picture_filter(
+            date_from=date.fromisoformat(params['from']) if params.get('from') else None,
+            date_to=date.fromisoformat(params['to']) if params.get('to') else None,
+            min_rating=int(params['minRating']) if params.get('minRating') else None,
+            min_file_size=int(params['minSize']) if params.get('minSize') else None,
+            min_width=int(params['minWidth']) if params.get('minWidth') else None,
+            min_height=int(params['minHeight']) if params.get('minHeight') else None
+        )
+        rows, total = query_picture_page(
+            LISTING_SORT_KEYS[sort], offset, limit, row_filter, name_contains=params.get('name') or None, overlay=overlay
+        )
+
+        pictures = []
+        for row in rows:
+            metadata = json.loads(row['metadata'] or '{}')
+            metadata.setdefault('original-name', row['picture_name'])
+            metadata['rating'] = str(row['rating'] or 0)
+            uploaded_at = row['upload_timestamp'].replace(tzinfo=timezone.utc)
+            pictures.append(get_picture_info(row['picture_jpg'], uploaded_at, metadata))
+
+        next_offset = offset + len(rows)
+        return {
+            'statusCode': 200,
+            'headers': get_cors_headers(),
+            'body': json.dumps({
+                'pictures': pictures,
+                'count': len(pictures),
+                'total': total,
+                'offset': offset,
+                'nextOffset': next_offset if next_offset < total else None
+            })
+        }
+
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'error': str(e)})
+        }
+    except Exception as e:
+        print(f"Error getting pictures from Iceberg: {str(e)}")
+        return {
+            'statusCode': 500,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'error': f'Failed to get pictures: {str(e)}'})
+        }
+
+def get_picture_info(s3_key, last_modified, metadata):
+    """Build the listing entry for a picture from its object metadata"""
+    # Generate presigned URL for the image
+    url = s3_client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': PICTURES_BUCKET, 'Key': s3_key},
+        ExpiresIn=3600  # 1 hour
+    )
+    
+    rating = int(metadata.get('rating', 0)) if metadata.get('rating') else 0
+    original_name = metadata.get('original-name', s3_key.split('/')[-1])
+    
+    # Parse comments from metadata
+    comments = []
+    comments_json = metadata.get('comments', '')
+    if comments_json:
+        try:
+            comments = json.loads(comments_json)
+        except json.JSONDecodeError as json_error:
+            print(f"Error parsing comments JSON for {s3_key}: {json_error}")
+    
+    picture_info = {
+        'name': original_name,
+        'date': last_modified.isoformat(),
+        'url': url,
+        'rating': rating,
+        'comments': comments
+    }
+    
+    # Header details recorded at upload, so the client can lay out and sort without fetching images
+    if metadata.get('width') and metadata.get('height'):
+        picture_info['width'] = int(metadata['width'])
+        picture_info['height'] = int(metadata['height'])
+    if metadata.get('captured-at'):
+        picture_info['capturedAt'] = metadata['captured-at']
+    if metadata.get('camera-model'):
+        picture_info['cameraModel'] = metadata['camera-model']
+    if metadata.get('blurhash'):
+        picture_info['blurhash'] = metadata['blurhash']
+    if metadata.get('display'):
+        picture_info['displayUrl'] = s3_client.generate_presigned_url(
+            'get_object',
+            Params={'Bucket': PICTURES_BUCKET, 'Key': get_display_key(s3_key)},
+            ExpiresIn=3600  # 1 hour
         )
+    
+    picture_info.update(get_thumbnail_urls(s3_key, metadata))
+    return picture_info
+
+def get_thumbnail_urls(s3_key, metadata):
+    """Get presigned thumbnail URLs and srcset variants for a picture listing entry"""
+    widths, formats = get_thumbnail_variants(metadata)
+    if not widths:
+        return {}
+    
+    variants = {
+        image_format: [
+            {
+                'width': width,
+                'url': s3_client.generate_presigned_url(
+                    'get_object',
+                    Params={'Bucket': PICTURES_BUCKET, 'Key': get_thumbnail_key(s3_key, width, image_format)},
+                    ExpiresIn=3600  # 1 hour
+                )
+            }
+            for width in widths
+        ]
+        for image_format in formats
+    }
+    thumbnails = {str(variant['width']): variant['url'] for variant in variants['jpeg']}
+    
+    # The grid uses the grid width, or the largest thumbnail of a smaller picture
+    grid_width = max((width for width in widths if width <= GRID_THUMBNAIL_WIDTH), default=min(widths))
+    return {
+        'thumbnails': thumbnails,
+        'thumbnailUrl': thumbnails[str(grid_width)],
+        'variants': variants
+    }
+
+def get_stats(event):
+    """Get gallery statistics from the maintained stats object"""
+    try:
+        params = event.get('queryStringParameters') or {}
+        period = params.get('period', 'day')
+        if period not in STATS_PERIODS:
+            return {
+                'statusCode': 400,
+                'headers': get_cors_headers(),
+                'body': json.dumps({'error': f"period must be one of: {', '.join(STATS_PERIODS)}"})
+            }
         
-        total_pictures = 0
-        total_storage = 0
+        try:
+            response = s3_client.get_object(Bucket=PICTURES_BUCKET, Key=STATS_KEY)
+            stats = json.loads(response['Body'].read())
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'NoSuchKey':
+                raise
+            # First use - count the gallery once to start the counters
+            stats = reconcile_stats()
         
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                if obj['Key'].lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
-                    total_pictures += 1
-                    total_storage += obj['Size']
+        print(f"Stats: {stats['totalPictures']} pictures, {stats['totalStorage']} bytes")
+        
+        result = {
+            'totalPictures': stats['totalPictures'],
+            'totalStorage': stats['totalStorage'],
+            'ratedPictures': stats['ratedPictures'],
+            'averageRating': stats['ratingSum'] / stats['ratedPictures'] if stats['ratedPictures'] else 0,
+            'totalComments': stats['totalComments'],
+            'lastUpload': stats['lastUpload'],
+            'updated': stats.get('updated')
+        }
         
-        print(f"Stats: {total_pictures} pictures, {total_storage} bytes")
+        if params.get('detail') == 'full':
+            snapshot = load_stats_snapshot()
+            if snapshot is not None and check_stats_snapshot(snapshot[1]):
+                # Recounted inline (local testing)
+                snapshot = load_stats_snapshot()
+            if snapshot is None:
+                result['detail'] = None
+                result['detailError'] = 'Detailed statistics are not available yet'
+            else:
+                columns, generated = snapshot
+                result['detail'] = compute_detailed_stats(columns, period)
+                result['detailGenerated'] = generated.isoformat()
+                result['detailAgeSeconds'] = int((datetime.now(timezone.utc) - generated).total_seconds())
         
         return {
             'statusCode': 200,
             'headers': get_cors_headers(),
-            'body': json.dumps({
-                'totalPictures': total_pictures,
-                'totalStorage': total_storage
-            })
+            'body': json.dumps(result)
         }
         
     except Exception as e:
@@ -1632,6 +2611,563 @@ def get_stats():
             'body': json.dumps({'error': f'Failed to get stats: {str(e)}'})
         }
 
+def update_json_object(key, update, default=None):
+    """
+    Read-modify-write a JSON object in S3 with optimistic concurrency.
+    
+    The write is conditional on the ETag that was read, or on the object still not
+    existing, so concurrent writers never overwrite each other: the loser re-reads
+    and re-applies its update. A missing object is created from default, or left
+    alone (returning None) when there is no default.
+    """
+    for attempt in range(JSON_UPDATE_MAX_ATTEMPTS):
+        try:
+            response = s3_client.get_object(Bucket=PICTURES_BUCKET, Key=key)
+            value = json.loads(response['Body'].read())
+            condition = {'IfMatch': response['ETag']}
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'NoSuchKey':
+                raise
+            if default is None:
+                return None
+            value = json.loads(json.dumps(default))  # Fresh copy
+            condition = {'IfNoneMatch': '*'}
+        
+        value = update(value)
+        try:
+            s3_client.put_object(
+                Bucket=PICTURES_BUCKET,
+                Key=key,
+                Body=json.dumps(value).encode('utf-8'),
+                ContentType='application/json',
+                **condition
+            )
+            return value
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise
+            # Lost the race; back off with jitter and retry against the new version
+            time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+    
+    raise RuntimeError(f"Gave up updating {key} after {JSON_UPDATE_MAX_ATTEMPTS} conflicting writes")
+
+def record_stats_change(pictures=0, storage=0, rating_sum=0, rated_pictures=0, comments=0, last_upload=None):
+    """Apply deltas to the gallery stats counters"""
+    def apply(stats):
+        stats['totalPictures'] += pictures
+        stats['totalStorage'] += storage
+        stats['ratingSum'] += rating_sum
+        stats['ratedPictures'] += rated_pictures
+        stats['totalComments'] += comments
+        if last_upload and last_upload > (stats['lastUpload'] or ''):
+            stats['lastUpload'] = last_upload
+        stats['updated'] = datetime.now(timezone.utc).isoformat()
+        return stats
+    
+    try:
+        # Before the first reconciliation there is nothing to adjust
+        update_json_object(STATS_KEY, apply)
+    except Exception as e:
+        # The change itself succeeded; the next reconciliation corrects the counters
+        print(f"Error updating gallery stats: {e}")
+
+def get_rollup_key(granularity, period):
+    """Get the rollup object holding a period such as '2024-03-05', '2024-03' or '2024'"""
+    if granularity == 'day':
+        return f"{ROLLUP_PREFIX}day/{period[:7]}.json"
+    if granularity == 'month':
+        return f"{ROLLUP_PREFIX}month/{period[:4]}.json"
+    return f"{ROLLUP_PREFIX}year.json"
+
+def record_activity(uploads=0, ratings=0, comments=0, when=None):
+    """
+    Spool activity for the day, month and year rollups it falls in.
+    
+    Each event is one new object whose key carries the counts, so concurrent
+    writers never contend for the rollups; fold_activity adds them in later.
+    """
+    when = when or datetime.now(timezone.utc)
+    day = when.strftime(ROLLUP_PERIOD_FORMATS['day'])
+    
+    try:
+        s3_client.put_object(
+            Bucket=PICTURES_BUCKET,
+            Key=f"{ACTIVITY_PENDING_PREFIX}{day}/{uploads}_{ratings}_{comments}_{uuid.uuid4().hex}",
+            Body=b''
+        )
+        check_activity_spool()
+    except Exception as e:
+        # The activity itself succeeded; only its timeline entry is lost
+        print(f"Error recording activity: {e}")
+
+def parse_activity_delta(key):
+    """Get the day and counts of a spooled activity delta from its key"""
+    day, counts = key[len(ACTIVITY_PENDING_PREFIX):].split('/', 1)
+    return day, dict(zip(EMPTY_ROLLUP, (int(count) for count in counts.split('_')[:3])))
+
+def add_activity_delta(rollups, key):
+    """Add a spooled delta to the {rollup key: {period: counts}} changes of each granularity"""
+    day, counts = parse_activity_delta(key)
+    when = datetime.strptime(day, ROLLUP_PERIOD_FORMATS['day'])
+    for granularity, period_format in ROLLUP_PERIOD_FORMATS.items():
+        period = when.strftime(period_format)
+        totals = rollups.setdefault(get_rollup_key(granularity, period), {}).setdefault(period, dict(EMPTY_ROLLUP))
+        for name, delta in counts.items():
+            totals[name] += delta
+
+def list_pending_activity():
+    """List the spooled activity deltas"""
+    pending = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=PICTURES_BUCKET, Prefix=ACTIVITY_PENDING_PREFIX):
+        pending.extend(page.get('Contents', []))
+    return pending
+
+# When this process last looked at the activity spool (time.monotonic())
+activity_checked_at = 0.0
+
+def check_activity_spool():
+    """
+    Start a fold once ACTIVITY_FOLD_SIZE deltas are pending or the oldest has
+    waited ACTIVITY_FOLD_MAX_AGE_SECONDS; each process looks at most every
+    ACTIVITY_CHECK_INTERVAL_SECONDS.
+    """
+    global activity_checked_at
+    
+    now = time.monotonic()
+    if now - activity_checked_at < ACTIVITY_CHECK_INTERVAL_SECONDS:
+        return
+    activity_checked_at = now
+    
+    pending = list_pending_activity()
+    if pending and (
+        len(pending) >= ACTIVITY_FOLD_SIZE
+        or (datetime.now(timezone.utc) - min(obj['LastModified'] for obj in pending)).total_seconds() >= ACTIVITY_FOLD_MAX_AGE_SECONDS
+    ):
+        print(f"Activity spool holds {len(pending)} delta(s), starting a fold")
+        invoke_activity_worker()
+
+def invoke_activity_worker():
+    """Fold spooled activity in a separate asynchronous invocation of this function"""
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    if not function_name:
+        # Not running in Lambda (local testing) - do the work inline
+        return fold_activity()
+    
+    lambda_client = boto3.client('lambda')
+    lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=json.dumps({'fold_activity': True})
+    )
+
+def get_activity_batch():
+    """
+    Get the batch to fold next: an unfinished one left by an earlier fold, or a
+    new one of the oldest pending deltas, saved before any rollup is touched
+    """
+    try:
+        response = s3_client.get_object(Bucket=PICTURES_BUCKET, Key=ACTIVITY_BATCH_KEY)
+        return json.loads(response['Body'].read())
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'NoSuchKey':
+            raise
+    
+    pending = list_pending_activity()
+    if not pending:
+        return None
+    
+    pending.sort(key=lambda obj: obj['LastModified'])
+    batch = {'id': uuid.uuid4().hex, 'keys': [obj['Key'] for obj in pending[:ACTIVITY_MAX_BATCH_DELTAS]]}
+    s3_client.put_object(
+        Bucket=PICTURES_BUCKET,
+        Key=ACTIVITY_BATCH_KEY,
+        Body=json.dumps(batch).encode('utf-8'),
+        ContentType='application/json'
+    )
+    return batch
+
+def fold_activity():
+    """
+    Add spooled activity deltas into the rollups, with one write per rollup object
+    for a whole batch.
+    
+    Each rollup records the last batch folded into it, so a fold interrupted part
+    way finishes the same batch next time without counting it twice. Started by
+    check_activity_spool, or run by invoking the function with {"fold_activity": true}.
+    """
+    owner = uuid.uuid4().hex
+    
+    def take_lease(lease):
+        if lease.get('expires', 0) > time.time() and lease.get('owner') != owner:
+            return lease
+        return {'owner': owner, 'expires': time.time() + ACTIVITY_LEASE_SECONDS}
+    
+    if update_json_object(ACTIVITY_LEASE_KEY, take_lease, {}).get('owner') != owner:
+        print("Another activity fold is running")
+        return {'folded': 0, 'busy': True}
+    
+    folded = batches = 0
+    try:
+        while True:
+            batch = get_activity_batch()
+            if batch is None:
+                break
+            
+            rollups = {}
+            for key in batch['keys']:
+                add_activity_delta(rollups, key)
+            
+            for rollup_key, periods in rollups.items():
+                def apply(rollup, periods=periods):
+                    # 'batch' cannot clash with a period, which always starts with its year
+                    if rollup.get('batch') == batch['id']:
+                        return rollup
+                    for period, totals in periods.items():
+                        counts = rollup.setdefault(period, dict(EMPTY_ROLLUP))
+                        for name, delta in totals.items():
+                            counts[name] = counts.get(name, 0) + delta
+                    rollup['batch'] = batch['id']
+                    return rollup
+                
+                update_json_object(rollup_key, apply, {})
+            
+            for i in range(0, len(batch['keys']), 1000):
+                s3_client.delete_objects(
+                    Bucket=PICTURES_BUCKET,
+                    Delete={'Objects': [{'Key': key} for key in batch['keys'][i:i + 1000]], 'Quiet': True}
+                )
+            s3_client.delete_object(Bucket=PICTURES_BUCKET, Key=ACTIVITY_BATCH_KEY)
+            folded += len(batch['keys'])
+            batches += 1
+            # Keep the lease for the next batch
+            if update_json_object(ACTIVITY_LEASE_KEY, take_lease, {}).get('owner') != owner:
+                print("Activity fold lease was taken over")
+                break
+    finally:
+        update_json_object(ACTIVITY_LEASE_KEY, lambda lease: {} if lease.get('owner') == owner else lease, {})
+    
+    print(f"Folded {folded} activity delta(s) into the rollups in {batches} batch(es)")
+    return {'folded': folded, 'batches': batches}
+
+def parse_timeline_date(value):
+    """Parse a YYYY-MM-DD, YYYY-MM or YYYY timeline bound"""
+    for date_format in ('%Y-%m-%d', '%Y-%m', '%Y'):
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            continue
+    raise ValueError(f"Invalid date '{value}', expected YYYY-MM-DD, YYYY-MM or YYYY")
+
+def get_timeline_periods(granularity, start, end):
+    """Get the periods from start to end inclusive, formatted as the rollups key them"""
+    if granularity == 'day':
+        return [(start + timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+    if granularity == 'month':
+        first, last = start.year * 12 + start.month - 1, end.year * 12 + end.month - 1
+        return [f"{i // 12:04d}-{i % 12 + 1:02d}" for i in range(first, last + 1)]
+    return [f"{year:04d}" for year in range(start.year, end.year + 1)]
+
+def get_default_timeline_start(granularity, end):
+    """Get the start of the default range ending at end"""
+    periods = TIMELINE_DEFAULT_PERIODS[granularity]
+    if granularity == 'day':
+        return end - timedelta(days=periods - 1)
+    if granularity == 'month':
+        month = end.year * 12 + end.month - periods
+        return date(month // 12, month % 12 + 1, 1)
+    return date(end.year - periods + 1, 1, 1)
+
+def get_timeline(event):
+    """Get upload, rating and comment counts over time from the rollups"""
+    try:
+        params = event.get('queryStringParameters') or {}
+        granularity = params.get('granularity', 'day')
+        if granularity not in ROLLUP_PERIOD_FORMATS:
+            raise ValueError(f"granularity must be one of: {', '.join(ROLLUP_PERIOD_FORMATS)}")
+        
+        end = parse_timeline_date(params['to']) if params.get('to') else datetime.now(timezone.utc).date()
+        start = parse_timeline_date(params['from']) if params.get('from') else get_default_timeline_start(granularity, end)
+        if start > end:
+            raise ValueError("from must not be after to")
+        
+        periods = get_timeline_periods(granularity, start, end)
+        if len(periods) > TIMELINE_MAX_PERIODS[granularity]:
+            raise ValueError(f"At most {TIMELINE_MAX_PERIODS[granularity]} {granularity} periods can be requested at once")
+        
+        check_activity_spool()
+        # Activity not folded yet is counted from the spool listing, whose keys carry the counts
+        pending = {}
+        for obj in list_pending_activity():
+            add_activity_delta(pending, obj['Key'])
+        
+        # Read each rollup object covering the range once
+        rollups = {}
+        for period in periods:
+            key = get_rollup_key(granularity, period)
+            if key not in rollups:
+                try:
+                    response = s3_client.get_object(Bucket=PICTURES_BUCKET, Key=key)
+                    rollups[key] = json.loads(response['Body'].read())
+                except ClientError as e:
+                    if e.response.get('Error', {}).get('Code') != 'NoSuchKey':
+                        raise
+                    rollups[key] = {}
+        
+        timeline = []
+        for period in periods:
+            key = get_rollup_key(granularity, period)
+            counts = rollups[key].get(period, {})
+            spooled = pending.get(key, {}).get(period, {})
+            timeline.append({'period': period, **{name: counts.get(name, 0) + spooled.get(name, 0) for name in EMPTY_ROLLUP}})
+        
+        return {
+            'statusCode': 200,
+            'headers': get_cors_headers(),
+            'body': json.dumps({
+                'granularity': granularity,
+                'from': periods[0],
+                'to': periods[-1],
+                'timeline': timeline
+            })
+        }
+        
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'error': str(e)})
+        }
+    except Exception as e:
+        print(f"Error getting timeline: {str(e)}")
+        return {
+            'statusCode': 500,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'error': f'Failed to get timeline: {str(e)}'})
+        }
+
+def get_metadata_stats(metadata):
+    """Get the (rating, comment count) a picture contributes to the gallery stats"""
+    rating = int(metadata.get('rating') or 0)
+    try:
+        comments = len(json.loads(metadata.get('comments') or '[]'))
+    except json.JSONDecodeError:
+        comments = 0
+    return rating, comments
+
+def reconcile_stats():
+    """
+    Recount the gallery stats from the bucket, replacing the maintained counters.
+    
+    Run by invoking the function with {"reconcile_stats": true}, to correct counter
+    updates lost to errors; detailed stats requests start it once the snapshot is
+    stale. Changes recorded while the bucket is scanned are carried over onto the
+    recount rather than overwritten.
+    """
+    try:
+        response = s3_client.get_object(Bucket=PICTURES_BUCKET, Key=STATS_KEY)
+        scan_start = json.loads(response['Body'].read())
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'NoSuchKey':
+            raise
+        scan_start = None
+    
+    stats = dict(EMPTY_STATS)
+    columns = {'key': [], 'name': [], 'size': [], 'rating': [], 'comments': [], 'uploaded': []}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=PICTURES_BUCKET, Prefix='pictures/'):
+        for obj in page.get('Contents', []):
+            if not is_picture_key(obj['Key']):
+                continue
+            try:
+                metadata = s3_client.head_object(Bucket=PICTURES_BUCKET, Key=obj['Key']).get('Metadata', {})
+            except Exception as meta_error:
+                print(f"Error getting metadata for {obj['Key']}: {meta_error}")
+                metadata = {}
+            
+            rating, comments = get_metadata_stats(metadata)
+            # Ratings and comments copy the object, so LastModified is not the upload time
+            uploaded_at = get_upload_time(metadata, obj['LastModified'])
+            stats['totalPictures'] += 1
+            stats['totalStorage'] += obj['Size']
+            stats['ratingSum'] += rating
+            stats['ratedPictures'] += 1 if rating else 0
+            stats['totalComments'] += comments
+            if uploaded_at.isoformat() > (stats['lastUpload'] or ''):
+                stats['lastUpload'] = uploaded_at.isoformat()
+            
+            columns['key'].append(obj['Key'])
+            columns['name'].append(metadata.get('original-name', obj['Key'].split('/')[-1]))
+            columns['size'].append(obj['Size'])
+            columns['rating'].append(rating)
+            columns['comments'].append(comments)
+            columns['uploaded'].append(int(uploaded_at.timestamp()))
+    
+    stats['updated'] = stats['reconciled'] = datetime.now(timezone.utc).isoformat()
+    print(f"Reconciled stats: {stats}")
+    store_stats_snapshot(columns)
+    
+    def apply(current):
+        if scan_start is None or current.get('reconciled') != scan_start.get('reconciled'):
+            # No counters to carry over, or another reconciliation replaced them meanwhile
+            return stats
+        # Re-apply what record_stats_change added since the scan started; a change
+        # the scan also saw is counted twice until the next reconciliation
+        merged = dict(current)
+        for name in STATS_COUNTERS:
+            merged[name] = stats[name] + current[name] - scan_start[name]
+        merged['lastUpload'] = max(stats['lastUpload'] or '', current['lastUpload'] or '') or None
+        merged['updated'], merged['reconciled'] = stats['updated'], stats['reconciled']
+        return merged
+    
+    return update_json_object(STATS_KEY, apply, EMPTY_STATS)
+
+# Detailed stats snapshot, kept across warm invocations until its ETag changes
+stats_snapshot = None
+stats_snapshot_etag = None
+stats_refresh_started_at = None  # When this process last started a reconciliation for a stale snapshot
+
+def store_stats_snapshot(columns):
+    """Write the per-picture columns gathered by reconciliation as a NumPy snapshot"""
+    try:
+        import numpy as np
+    except ImportError:
+        print("NumPy not available - skipping stats snapshot")
+        return
+    
+    buffer = io.BytesIO()
+    np.savez_compressed(
+        buffer,
+        key=np.array(columns['key'], dtype=str),
+        name=np.array(columns['name'], dtype=str),
+        size=np.array(columns['size'], dtype=np.int64),
+        rating=np.array(columns['rating'], dtype=np.int8),
+        comments=np.array(columns['comments'], dtype=np.int32),
+        uploaded=np.array(columns['uploaded'], dtype='datetime64[s]')
+    )
+    s3_client.put_object(
+        Bucket=PICTURES_BUCKET,
+        Key=STATS_SNAPSHOT_KEY,
+        Body=buffer.getvalue(),
+        ContentType='application/octet-stream'
+    )
+
+def load_stats_snapshot():
+    """
+    Get the snapshot columns as NumPy arrays and when the snapshot was written, or
+    None when NumPy or the snapshot is missing
+    """
+    global stats_snapshot, stats_snapshot_etag
+    
+    try:
+        import numpy as np
+    except ImportError:
+        return None
+    
+    try:
+        head_response = s3_client.head_object(Bucket=PICTURES_BUCKET, Key=STATS_SNAPSHOT_KEY)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+        return None
+    
+    if head_response['ETag'] != stats_snapshot_etag:
+        response = s3_client.get_object(Bucket=PICTURES_BUCKET, Key=STATS_SNAPSHOT_KEY)
+        with np.load(io.BytesIO(response['Body'].read()), allow_pickle=False) as snapshot:
+            stats_snapshot = {name: snapshot[name] for name in snapshot.files}
+        stats_snapshot_etag = head_response['ETag']
+    
+    return stats_snapshot, head_response['LastModified']
+
+def check_stats_snapshot(generated):
+    """
+    Start a reconciliation, which rewrites the snapshot, once the snapshot is older
+    than STATS_SNAPSHOT_MAX_AGE_SECONDS. Each process starts at most one per that
+    interval. Returns whether the reconciliation ran inline.
+    """
+    global stats_refresh_started_at
+    
+    if (datetime.now(timezone.utc) - generated).total_seconds() <= STATS_SNAPSHOT_MAX_AGE_SECONDS:
+        return False
+    now = time.monotonic()
+    if stats_refresh_started_at is not None and now - stats_refresh_started_at < STATS_SNAPSHOT_MAX_AGE_SECONDS:
+        return False
+    stats_refresh_started_at = now
+    
+    print(f"Stats snapshot from {generated.isoformat()} is stale, starting a reconciliation")
+    return invoke_stats_worker() is not None
+
+def invoke_stats_worker():
+    """Run a stats reconciliation in a separate asynchronous invocation of this function"""
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    if not function_name:
+        # Not running in Lambda (local testing) - do the work inline
+        return reconcile_stats()
+    
+    lambda_client = boto3.client('lambda')
+    lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=json.dumps({'reconcile_stats': True})
+    )
+
+def get_top_pictures(columns, values, k):
+    """Get the k pictures with the largest values, largest first, ignoring zeros"""
+    import numpy as np
+    
+    candidates = np.flatnonzero(values > 0)
+    if len(candidates) > k:
+        # Partial selection is linear; only the k winners get sorted
+        candidates = np.sort(candidates[np.argpartition(values[candidates], -k)[-k:]])
+    # Ties keep gallery order
+    candidates = candidates[np.argsort(-values[candidates], kind='stable')]
+    return [
+        {'key': str(columns['key'][i]), 'name': str(columns['name'][i]), 'value': int(values[i])}
+        for i in candidates
+    ]
+
+def compute_detailed_stats(columns, period='day'):
+    """Compute distributions, percentiles and top lists from snapshot columns, vectorized"""
+    import numpy as np
+    
+    sizes = columns['size']
+    ratings = columns['rating']
+    comments = columns['comments']
+    
+    # Upload counts per period, counted by offset from the earliest period rather
+    # than sorted; weeks start on Monday (the epoch fell on a Thursday)
+    unit = f"datetime64[{STATS_PERIODS[period]}]"
+    buckets = columns['uploaded'].astype(unit).astype(np.int64)
+    if period == 'week':
+        buckets -= (buckets + 3) % 7
+    periods = period_counts = np.array([], dtype=np.int64)
+    if len(buckets):
+        first = buckets.min()
+        counts = np.bincount(buckets - first)
+        offsets = np.flatnonzero(counts)
+        periods = (offsets + first).astype(unit)
+        period_counts = counts[offsets]
+    
+    percentiles = [50, 75, 90, 95, 99]
+    size_percentiles = np.percentile(sizes, percentiles) if len(sizes) else np.zeros(len(percentiles))
+    
+    return {
+        'pictures': int(len(sizes)),
+        'ratingHistogram': {str(stars): int(count) for stars, count in enumerate(np.bincount(ratings, minlength=6)[:6])},
+        'sizePercentiles': {f"p{p}": int(value) for p, value in zip(percentiles, size_percentiles)},
+        'sizeMean': int(sizes.mean()) if len(sizes) else 0,
+        'commentHistogram': {str(count): int(pictures) for count, pictures in enumerate(np.bincount(comments)) if pictures},
+        'uploadsPerPeriod': {
+            'period': period,
+            'counts': {str(start): int(count) for start, count in zip(periods, period_counts)}
+        },
+        'top': {
+            'rated': get_top_pictures(columns, ratings.astype(np.int64), STATS_TOP_K),
+            'commented': get_top_pictures(columns, comments.astype(np.int64), STATS_TOP_K),
+            'largest': get_top_pictures(columns, sizes, STATS_TOP_K)
+        }
+    }
+
 def delete_pictures(event):
     """Delete multiple pictures from S3"""
     try:
@@ -1671,6 +3207,10 @@ def delete_pictures(event):
         # Create a mapping of picture names to S3 keys using metadata
         name_to_key = {}
         keys_to_delete = []
+        digests_to_delete = []
+        derived_keys_to_delete = []
+        perceptual_hashes_to_delete = []
+        stats_to_delete = {}
         not_found = []
         
         if 'Contents' in response:
@@ -1695,6 +3235,12 @@ def delete_pictures(event):
                             original_name.lower() in picture_name.lower()):
                             keys_to_delete.append({'Key': key})
                             name_to_key[picture_name] = key
+                            stats_to_delete[key] = (obj['Size'], get_metadata_stats(metadata))
+                            if metadata.get('sha256'):
+                                digests_to_delete.append(metadata['sha256'])
+                            derived_keys_to_delete.extend(get_derived_keys(key, metadata))
+                            if metadata.get('dhash'):
+                                perceptual_hashes_to_delete.append((key, metadata['dhash']))
                             print(f"Found match: {picture_name} -> {key} (original: {original_name})")
                             break
                             
@@ -1707,6 +3253,7 @@ def delete_pictures(event):
                             filename.lower().startswith(picture_name.lower())):
                             keys_to_delete.append({'Key': key})
                             name_to_key[picture_name] = key
+                            stats_to_delete[key] = (obj['Size'], (0, 0))
                             print(f"Found fallback match: {picture_name} -> {key}")
                             break
         
@@ -1738,6 +3285,36 @@ def delete_pictures(event):
         deleted_count = len(delete_response.get('Deleted', []))
         errors = delete_response.get('Errors', [])
         
+        deleted_stats = [
+            stats_to_delete[deleted['Key']] for deleted in delete_response.get('Deleted', [])
+            if deleted['Key'] in stats_to_delete and is_picture_key(deleted['Key'])
+        ]
+        if deleted_stats:
+            record_stats_change(
+                pictures=-len(deleted_stats),
+                storage=-sum(size for size, _ in deleted_stats),
+                rating_sum=-sum(rating for _, (rating, _) in deleted_stats),
+                rated_pictures=-sum(1 for _, (rating, _) in deleted_stats if rating),
+                comments=-sum(comments for _, (_, comments) in deleted_stats)
+            )
+        
+        # Drop the hash index entries so the same content can be uploaded again,
+        # and the thumbnails and perceptual index markers of the deleted pictures
+        cleanup_keys = [f"{HASH_INDEX_PREFIX}{digest}.json" for digest in digests_to_delete] + derived_keys_to_delete
+        for i in range(0, len(cleanup_keys), 1000):
+            s3_client.delete_objects(
+                Bucket=PICTURES_BUCKET,
+                Delete={
+                    'Objects': [{'Key': cleanup_key} for cleanup_key in cleanup_keys[i:i + 1000]],
+                    'Quiet': True
+                }
+            )
+        if perceptual_index is not None:
+            for key, dhash in perceptual_hashes_to_delete:
+                perceptual_index.discard(int(dhash, 16), key)
+        for deleted in delete_response.get('Deleted', []):
+            spool_ingest_record({'picture_id': get_picture_id(deleted['Key']), 'deleted': True, 'change': 'delete'})
+        
         print(f"Successfully deleted {deleted_count} pictures")
         if errors:
             print(f"Errors during deletion: {errors}")
@@ -1857,19 +3434,15 @@ def rate_picture(event):
         
         # Update metadata with rating
         current_metadata = head_response.get('Metadata', {})
+        previous_rating = int(current_metadata.get('rating') or 0)
         current_metadata['rating'] = str(rating)
         current_metadata['original-name'] = picture_name
         
-        # Copy object with new metadata (S3 doesn't allow direct metadata updates)
-        copy_source = {'Bucket': PICTURES_BUCKET, 'Key': s3_key}
-        s3_client.copy_object(
-            CopySource=copy_source,
-            Bucket=PICTURES_BUCKET,
-            Key=s3_key,
-            Metadata=current_metadata,
-            MetadataDirective='REPLACE',
-            ContentType=head_response.get('ContentType', 'image/jpeg')
-        )
+        replace_picture_metadata(s3_key, head_response, current_metadata)
+        
+        record_stats_change(rating_sum=rating - previous_rating, rated_pictures=0 if previous_rating else 1)
+        record_activity(ratings=1)
+        spool_picture_update(s3_key, head_response, current_metadata)
         
         print(f"Successfully rated picture {picture_name} with {rating} stars")
         
@@ -1925,7 +3498,7 @@ def add_comment(event):
         target_key = None
         if 'Contents' in response:
             for obj in response['Contents']:
-                if obj['Key'].lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
+                if is_picture_key(obj['Key']):
                     # Get metadata to check original name
                     try:
                         head_response = s3_client.head_object(
@@ -1978,14 +3551,11 @@ def add_comment(event):
         updated_metadata = current_metadata.copy()
         updated_metadata['comments'] = json.dumps(existing_comments)
         
-        # Copy object with updated metadata
-        s3_client.copy_object(
-            Bucket=PICTURES_BUCKET,
-            CopySource={'Bucket': PICTURES_BUCKET, 'Key': target_key},
-            Key=target_key,
-            Metadata=updated_metadata,
-            MetadataDirective='REPLACE'
-        )
+        replace_picture_metadata(target_key, head_response, updated_metadata)
+        
+        record_stats_change(comments=1)
+        record_activity(comments=1)
+        spool_picture_update(target_key, head_response, updated_metadata)
         
         print(f"Comment added successfully to {picture_name}")
         
@@ -2008,87 +3578,358 @@ def add_comment(event):
             'body': json.dumps({'error': f'Failed to add comment: {str(e)}'})
         }
 
-def download_pictures(event):
-    """Create and return a ZIP file containing selected pictures"""
-    import zipfile
-    import io
+def get_archive_cache_key(members, archive_format='zip'):
+    """Derive the archive cache key from the format and sorted (key, ETag) pairs of a selection"""
+    digest = hashlib.sha256(f"{archive_format}\n".encode('utf-8'))
+    for picture_name, s3_key, etag in sorted(members, key=lambda m: (m[1], m[0])):
+        digest.update(f"{s3_key}\0{etag}\0{picture_name}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+def get_cached_archive(cache_key, archive_format='zip'):
+    """Return a download URL for a cached archive, or None if missing or expired"""
+    archive_key = get_archive_key(cache_key, archive_format)
+    try:
+        head_response = s3_client.head_object(
+            Bucket=PICTURES_BUCKET,
+            Key=archive_key
+        )
+    except Exception:
+        return None
+    
+    # Only trust objects that were written by the cache for this selection
+    metadata = head_response.get('Metadata', {})
+    if metadata.get('selection-hash') != cache_key:
+        return None
     
+    last_modified = head_response.get('LastModified')
+    if not isinstance(last_modified, datetime):
+        return None
+    age = (datetime.now(timezone.utc) - last_modified).total_seconds()
+    if age > ARCHIVE_CACHE_TTL_SECONDS:
+        print(f"Cached archive {archive_key} expired ({int(age)}s old)")
+        return None
+    
+    return s3_client.generate_presigned_url(
+        'get_object',
+        Params={
+            'Bucket': PICTURES_BUCKET,
+            'Key': archive_key,
+            'ResponseContentDisposition': f'attachment; filename="{get_archive_filename(archive_format)}"'
+        },
+        ExpiresIn=3600  # 1 hour
+    )
+
+def store_cached_archive(cache_key, archive_format, archive_data, picture_count):
+    """Store a finished archive in the cache and evict entries over the TTL or size cap"""
+    archive_key = get_archive_key(cache_key, archive_format)
     try:
-        # Parse the request body
-        body = event.get('body', '')
-        if event.get('isBase64Encoded', False):
-            body = base64.b64decode(body).decode('utf-8')
-        
-        data = json.loads(body)
-        picture_names = data.get('pictures', [])
-        
-        if not picture_names:
-            return {
-                'statusCode': 400,
-                'headers': get_cors_headers(),
-                'body': json.dumps({'error': 'No pictures specified for download'})
+        s3_client.put_object(
+            Bucket=PICTURES_BUCKET,
+            Key=archive_key,
+            Body=archive_data,
+            ContentType=ARCHIVE_FORMATS[archive_format][1],
+            Metadata={
+                'selection-hash': cache_key,
+                'picture-count': str(picture_count)
             }
-        
-        print(f"Creating ZIP for {len(picture_names)} pictures: {picture_names}")
-        
-        # Create ZIP file in memory
-        zip_buffer = io.BytesIO()
-        
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            # Get list of all objects in S3
-            response = s3_client.list_objects_v2(
-                Bucket=PICTURES_BUCKET,
-                Prefix='pictures/'
-            )
-            
-            if 'Contents' not in response:
-                return {
-                    'statusCode': 404,
-                    'headers': get_cors_headers(),
-                    'body': json.dumps({'error': 'No pictures found'})
-                }
-            
-            found_pictures = 0
-            for picture_name in picture_names:
-                # Find the S3 key for this picture name
-                target_key = None
-                for obj in response['Contents']:
-                    if obj['Key'].lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
-                        try:
-                            # Get metadata to check original name
-                            head_response = s3_client.head_object(
-                                Bucket=PICTURES_BUCKET,
-                                Key=obj['Key']
-                            )
-                            metadata = head_response.get('Metadata', {})
-                            original_name = metadata.get('original-name', obj['Key'].split('/')[-1])
-                            
-                            if original_name == picture_name:
-                                target_key = obj['Key']
-                                break
-                        except Exception as e:
-                            print(f"Error checking metadata for {obj['Key']}: {e}")
-                            continue
-                
-                if target_key:
+        )
+        print(f"Cached archive {archive_key} ({len(archive_data)} bytes)")
+        prune_archive_cache()
+    except Exception as e:
+        # A cache failure must never fail the download itself
+        print(f"Error caching archive {archive_key}: {e}")
+
+def prune_archive_cache():
+    """Delete expired cached archives, then the oldest ones until under the byte cap"""
+    entries = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=PICTURES_BUCKET, Prefix=ARCHIVE_CACHE_PREFIX):
+        for obj in page.get('Contents', []):
+            if obj['Key'].startswith(ARCHIVE_CACHE_PREFIX) and isinstance(obj.get('LastModified'), datetime):
+                entries.append(obj)
+    
+    now = datetime.now(timezone.utc)
+    entries.sort(key=lambda obj: obj['LastModified'])
+    total_bytes = sum(obj.get('Size', 0) for obj in entries)
+    
+    keys_to_delete = []
+    for obj in entries:
+        expired = (now - obj['LastModified']).total_seconds() > ARCHIVE_CACHE_TTL_SECONDS
+        if expired or total_bytes > ARCHIVE_CACHE_MAX_BYTES:
+            keys_to_delete.append({'Key': obj['Key']})
+            total_bytes -= obj.get('Size', 0)
+    
+    # delete_objects accepts at most 1000 keys per call
+    for i in range(0, len(keys_to_delete), 1000):
+        s3_client.delete_objects(
+            Bucket=PICTURES_BUCKET,
+            Delete={'Objects': keys_to_delete[i:i + 1000], 'Quiet': True}
+        )
+    
+    if keys_to_delete:
+        print(f"Evicted {len(keys_to_delete)} cached archives")
+
+def get_archive_key(cache_key, archive_format):
+    """Get the S3 key of a cached archive"""
+    return f"{ARCHIVE_CACHE_PREFIX}{cache_key}{ARCHIVE_FORMATS[archive_format][0]}"
+
+def get_archive_filename(archive_format='zip'):
+    """Get the download filename for an archive"""
+    return f'photos_{datetime.now().strftime("%Y%m%d")}{ARCHIVE_FORMATS[archive_format][0]}'
+
+class ZstdFrameStream:
+    """Write-only stream that zstd-compresses into another stream, one frame per checkpoint"""
+    
+    def __init__(self, stream, offset=0):
+        import zstandard
+        
+        self.stream = stream
+        self.zstd_compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        # Uncompressed position, which is what tarfile sees
+        self.offset = offset
+        self.compressor = None
+    
+    def write(self, data):
+        if self.compressor is None:
+            self.compressor = self.zstd_compressor.compressobj()
+        self.stream.write(self.compressor.compress(data))
+        self.offset += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self.offset
+    
+    def flush(self):
+        pass
+    
+    def flush_block(self):
+        """Emit everything compressed so far so the part buffer reflects real progress"""
+        import zstandard
+        
+        if self.compressor is not None:
+            self.stream.write(self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK))
+    
+    def end_frame(self):
+        """Finish the current frame; concatenated frames decompress as one stream"""
+        if self.compressor is not None:
+            self.stream.write(self.compressor.flush())
+            self.compressor = None
+
+class ArchiveWriter:
+    """
+    Writes pictures into a zip, tar or tar.zst archive on a forward-only stream.
+    
+    All formats are written in a single pass without seeking. state() captures what
+    is needed to continue the archive later on a stream positioned at the same offset.
+    """
+    
+    def __init__(self, archive_format, stream, state=None):
+        import tarfile
+        import zipfile
+        
+        self.archive_format = archive_format
+        state = state or {}
+        
+        self.zstd_stream = None
+        
+        if archive_format == 'zip':
+            self.archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+            restore_zip_entries(self.archive, state.get('entries', []))
+        else:
+            if archive_format == 'tar.zst':
+                self.zstd_stream = ZstdFrameStream(stream, state.get('tarOffset', 0))
+                stream = self.zstd_stream
+            # tarfile takes its starting offset from the stream position
+            self.archive = tarfile.open(fileobj=stream, mode='w', format=tarfile.PAX_FORMAT)
+    
+    def add(self, name, data):
+        """Add one picture to the archive"""
+        import tarfile
+        import zipfile
+        
+        if self.archive_format == 'zip':
+            # Deflating already-compressed images costs CPU and saves almost nothing
+            if name.lower().endswith(COMPRESSED_IMAGE_EXTENSIONS):
+                compress_type = zipfile.ZIP_STORED
+            else:
+                compress_type = zipfile.ZIP_DEFLATED
+            self.archive.writestr(name, data, compress_type=compress_type)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(datetime.now().timestamp())
+            info.mode = 0o644
+            self.archive.addfile(info, io.BytesIO(data))
+            if self.zstd_stream:
+                self.zstd_stream.flush_block()
+    
+    def state(self):
+        """Flush buffered output and return the state needed to resume"""
+        if self.archive_format == 'zip':
+            return {'entries': serialize_zip_entries(self.archive)}
+        if self.zstd_stream:
+            self.zstd_stream.end_frame()
+        return {'tarOffset': self.archive.offset}
+    
+    def close(self):
+        """Write the archive trailer"""
+        self.archive.close()
+        if self.zstd_stream:
+            self.zstd_stream.end_frame()
+
+def get_archive_format(data):
+    """Validate the requested archive format, returning (format, error message)"""
+    archive_format = data.get('format', 'zip')
+    if archive_format not in ARCHIVE_FORMATS:
+        return None, f"Unsupported archive format: {archive_format}. Use one of: {', '.join(ARCHIVE_FORMATS)}"
+    
+    if archive_format == 'tar.zst':
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            return None, 'The tar.zst format requires the zstandard package'
+    
+    return archive_format, None
+
+def download_pictures(event):
+    """Create and return a ZIP, tar or tar.zst archive containing selected pictures"""
+    try:
+        # Parse the request body
+        body = event.get('body', '')
+        if event.get('isBase64Encoded', False):
+            body = base64.b64decode(body).decode('utf-8')
+        
+        data = json.loads(body)
+        picture_names = data.get('pictures', [])
+        
+        if not picture_names:
+            return {
+                'statusCode': 400,
+                'headers': get_cors_headers(),
+                'body': json.dumps({'error': 'No pictures specified for download'})
+            }
+        
+        archive_format, format_error = get_archive_format(data)
+        if format_error:
+            return {
+                'statusCode': 400,
+                'headers': get_cors_headers(),
+                'body': json.dumps({'error': format_error})
+            }
+        
+        print(f"Creating {archive_format} archive for {len(picture_names)} pictures: {picture_names}")
+        
+        # Get list of all objects in S3
+        response = s3_client.list_objects_v2(
+            Bucket=PICTURES_BUCKET,
+            Prefix='pictures/'
+        )
+        
+        if 'Contents' not in response:
+            return {
+                'statusCode': 404,
+                'headers': get_cors_headers(),
+                'body': json.dumps({'error': 'No pictures found'})
+            }
+        
+        # Resolve each picture name to its S3 key and ETag
+        members = []
+        for picture_name in picture_names:
+            # Find the S3 key for this picture name
+            target = None
+            for obj in response['Contents']:
+                if is_picture_key(obj['Key']):
                     try:
-                        # Download the picture from S3
-                        print(f"Downloading {target_key} for {picture_name}")
-                        obj_response = s3_client.get_object(
+                        # Get metadata to check original name
+                        head_response = s3_client.head_object(
                             Bucket=PICTURES_BUCKET,
-                            Key=target_key
+                            Key=obj['Key']
                         )
+                        metadata = head_response.get('Metadata', {})
+                        original_name = metadata.get('original-name', obj['Key'].split('/')[-1])
                         
-                        # Add to ZIP file with original name
-                        zip_file.writestr(picture_name, obj_response['Body'].read())
-                        found_pictures += 1
-                        print(f"Added {picture_name} to ZIP")
-                        
+                        if original_name == picture_name:
+                            target = obj
+                            break
                     except Exception as e:
-                        print(f"Error downloading {target_key}: {e}")
+                        print(f"Error checking metadata for {obj['Key']}: {e}")
                         continue
-                else:
-                    print(f"Picture not found: {picture_name}")
+            
+            if target:
+                members.append((picture_name, target['Key'], target.get('ETag', '')))
+            else:
+                print(f"Picture not found: {picture_name}")
+        
+        if not members:
+            return {
+                'statusCode': 404,
+                'headers': get_cors_headers(),
+                'body': json.dumps({'error': 'None of the requested pictures were found'})
+            }
+        
+        # Reuse a previously built archive for the same selection
+        cache_key = get_archive_cache_key(members, archive_format)
+        cached_url = get_cached_archive(cache_key, archive_format)
+        if cached_url:
+            print(f"Serving cached archive for selection {cache_key}")
+            return {
+                'statusCode': 200,
+                'headers': get_cors_headers(),
+                'body': json.dumps({
+                    'cached': True,
+                    'url': cached_url,
+                    'filename': get_archive_filename(archive_format),
+                    'count': len(members)
+                })
+            }
+        
+        # Large selections are built by a worker invocation instead of this request
+        if data.get('async'):
+            return start_download_job(members, cache_key, archive_format)
+        
+        # Tar formats go straight to the archive cache part by part rather than into memory
+        if archive_format != 'zip':
+            archive_url, found_pictures = stream_archive(members, cache_key, archive_format)
+            if found_pictures == 0:
+                return {
+                    'statusCode': 404,
+                    'headers': get_cors_headers(),
+                    'body': json.dumps({'error': 'None of the requested pictures were found'})
+                }
+            return {
+                'statusCode': 200,
+                'headers': get_cors_headers(),
+                'body': json.dumps({
+                    'cached': False,
+                    'url': archive_url,
+                    'filename': get_archive_filename(archive_format),
+                    'count': found_pictures
+                })
+            }
+        
+        # Create the ZIP in memory
+        archive_buffer = io.BytesIO()
+        archive = ArchiveWriter(archive_format, archive_buffer)
+        
+        found_pictures = 0
+        for picture_name, target_key, _ in members:
+            try:
+                # Download the picture from S3
+                print(f"Downloading {target_key} for {picture_name}")
+                obj_response = s3_client.get_object(
+                    Bucket=PICTURES_BUCKET,
+                    Key=target_key
+                )
+                
+                # Add to the archive with original name
+                archive.add(picture_name, obj_response['Body'].read())
+                found_pictures += 1
+                print(f"Added {picture_name} to archive")
+                
+            except Exception as e:
+                print(f"Error downloading {target_key}: {e}")
+                continue
+        archive.close()
         
         if found_pictures == 0:
             return {
@@ -2097,28 +3938,31 @@ def download_pictures(event):
                 'body': json.dumps({'error': 'None of the requested pictures were found'})
             }
         
-        # Get ZIP data
-        zip_buffer.seek(0)
-        zip_data = zip_buffer.getvalue()
+        # Get archive data
+        archive_data = archive_buffer.getvalue()
+        
+        print(f"Created {archive_format} archive with {found_pictures} pictures, size: {len(archive_data)} bytes")
         
-        print(f"Created ZIP file with {found_pictures} pictures, size: {len(zip_data)} bytes")
+        # Only complete archives are cached, so a partial one is rebuilt next time
+        if found_pictures == len(members):
+            store_cached_archive(cache_key, archive_format, archive_data, found_pictures)
         
-        # Return ZIP file as binary response
+        # Return the archive as binary response
         return {
             'statusCode': 200,
             'headers': {
-                'Content-Type': 'application/zip',
-                'Content-Disposition': f'attachment; filename="photos_{datetime.now().strftime("%Y%m%d")}.zip"',
+                'Content-Type': ARCHIVE_FORMATS[archive_format][1],
+                'Content-Disposition': f'attachment; filename="{get_archive_filename(archive_format)}"',
                 'Access-Control-Allow-Origin': '*',
                 'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
                 'Access-Control-Allow-Headers': 'Content-Type, Authorization'
             },
-            'body': base64.b64encode(zip_data).decode('utf-8'),
+            'body': base64.b64encode(archive_data).decode('utf-8'),
             'isBase64Encoded': True
         }
         
     except Exception as e:
-        print(f"Error creating download ZIP: {str(e)}")
+        print(f"Error creating download archive: {str(e)}")
         import traceback
         print(f"Traceback: {traceback.format_exc()}")
         return {
@@ -2127,69 +3971,2171 @@ def download_pictures(event):
             'body': json.dumps({'error': f'Failed to create download: {str(e)}'})
         }
 
-def upload_picture(event):
-    """Upload a picture to S3"""
+def stream_archive(members, cache_key, archive_format):
+    """
+    Write an archive of the selection into the archive cache as a multipart
+    upload, holding at most one part in memory.
+    
+    Returns a download URL and the number of pictures archived; nothing is
+    stored when none of them could be read.
+    """
+    archive_key = get_archive_key(cache_key, archive_format)
+    upload_id = s3_client.create_multipart_upload(
+        Bucket=PICTURES_BUCKET,
+        Key=archive_key,
+        ContentType=ARCHIVE_FORMATS[archive_format][1],
+        Metadata={
+            'selection-hash': cache_key,
+            'picture-count': str(len(members))
+        }
+    )['UploadId']
+    
+    stream = ArchivePartStream()
+    archive = ArchiveWriter(archive_format, stream)
+    parts = []
+    
+    def upload_part(data):
+        part_number = len(parts) + 1
+        part_response = s3_client.upload_part(
+            Bucket=PICTURES_BUCKET,
+            Key=archive_key,
+            UploadId=upload_id,
+            PartNumber=part_number,
+            Body=data
+        )
+        parts.append({'PartNumber': part_number, 'ETag': part_response['ETag']})
+    
+    found_pictures = 0
     try:
-        # Parse the request body
-        body = event.get('body', '')
-        if event.get('isBase64Encoded', False):
-            body = base64.b64decode(body).decode('utf-8')
-        
-        data = json.loads(body)
+        for picture_name, target_key, _ in members:
+            try:
+                obj_response = s3_client.get_object(
+                    Bucket=PICTURES_BUCKET,
+                    Key=target_key
+                )
+            except s3_client.exceptions.NoSuchKey:
+                # Deleted since it was listed; the selection no longer hashes to this archive
+                print(f"Picture deleted during download: {target_key}")
+                continue
+            archive.add(picture_name, obj_response['Body'].read())
+            found_pictures += 1
+            
+            # S3 parts must be at least 5 MB, except the last
+            if len(stream.buffer) >= ARCHIVE_PART_SIZE:
+                upload_part(stream.take())
         
-        # Extract picture data
-        picture_name = data.get('name', f'picture_{uuid.uuid4().hex[:8]}.jpg')
-        picture_data = data.get('data', '')
-        content_type = data.get('contentType', 'image/jpeg')
+        if found_pictures == 0:
+            s3_client.abort_multipart_upload(Bucket=PICTURES_BUCKET, Key=archive_key, UploadId=upload_id)
+            return None, 0
         
-        if not picture_data:
-            return {
-                'statusCode': 400,
-                'headers': get_cors_headers(),
-                'body': json.dumps({'error': 'No picture data provided'})
-            }
+        archive.close()
+        upload_part(stream.take())
+        s3_client.complete_multipart_upload(
+            Bucket=PICTURES_BUCKET,
+            Key=archive_key,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': parts}
+        )
+    except Exception:
+        s3_client.abort_multipart_upload(Bucket=PICTURES_BUCKET, Key=archive_key, UploadId=upload_id)
+        raise
+    
+    print(f"Streamed {archive_format} archive with {found_pictures} pictures, size: {stream.offset} bytes in {len(parts)} parts")
+    prune_archive_cache()
+    
+    archive_url = s3_client.generate_presigned_url(
+        'get_object',
+        Params={
+            'Bucket': PICTURES_BUCKET,
+            'Key': archive_key,
+            'ResponseContentDisposition': f'attachment; filename="{get_archive_filename(archive_format)}"'
+        },
+        ExpiresIn=3600  # 1 hour
+    )
+    return archive_url, found_pictures
+
+class ArchivePartStream:
+    """Write-only stream that buffers archive bytes until they are uploaded as a part"""
+    
+    def __init__(self, offset=0):
+        # Offset of the first buffered byte within the whole archive
+        self.offset = offset
+        self.buffer = bytearray()
+    
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+    
+    def tell(self):
+        return self.offset + len(self.buffer)
+    
+    def flush(self):
+        pass
+    
+    def take(self):
+        """Return the buffered bytes and start a new part"""
+        data = bytes(self.buffer)
+        self.offset += len(data)
+        self.buffer = bytearray()
+        return data
+
+def serialize_zip_entries(zip_file):
+    """Capture the central directory state of a ZIP being written"""
+    return [
+        {
+            'name': info.filename,
+            'dateTime': list(info.date_time),
+            'compressType': info.compress_type,
+            'crc': info.CRC,
+            'compressSize': info.compress_size,
+            'fileSize': info.file_size,
+            'headerOffset': info.header_offset,
+            'flagBits': info.flag_bits,
+            'externalAttr': info.external_attr,
+            'createVersion': info.create_version,
+            'extractVersion': info.extract_version
+        }
+        for info in zip_file.infolist()
+    ]
+
+def restore_zip_entries(zip_file, entries):
+    """Restore central directory state captured by serialize_zip_entries"""
+    import zipfile
+    
+    for entry in entries:
+        info = zipfile.ZipInfo(entry['name'], tuple(entry['dateTime']))
+        info.compress_type = entry['compressType']
+        info.CRC = entry['crc']
+        info.compress_size = entry['compressSize']
+        info.file_size = entry['fileSize']
+        info.header_offset = entry['headerOffset']
+        info.flag_bits = entry['flagBits']
+        info.external_attr = entry['externalAttr']
+        info.create_version = entry['createVersion']
+        info.extract_version = entry['extractVersion']
+        zip_file.filelist.append(info)
+        zip_file.NameToInfo[info.filename] = info
+
+def load_job(job_id):
+    """Load a download job record from S3"""
+    obj_response = s3_client.get_object(
+        Bucket=PICTURES_BUCKET,
+        Key=f"{JOBS_PREFIX}{job_id}.json"
+    )
+    return json.loads(obj_response['Body'].read())
+
+def save_job(job):
+    """Save a download job record to S3"""
+    job['updated'] = datetime.now().isoformat()
+    s3_client.put_object(
+        Bucket=PICTURES_BUCKET,
+        Key=f"{JOBS_PREFIX}{job['id']}.json",
+        Body=json.dumps(job),
+        ContentType='application/json'
+    )
+
+def invoke_download_worker(job_id):
+    """Run a download job in a separate asynchronous invocation of this function"""
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    if not function_name:
+        # Not running in Lambda (local testing) - do the work inline
+        return run_download_job(job_id, None)
+    
+    lambda_client = boto3.client('lambda')
+    lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=json.dumps({'download_job': job_id})
+    )
+
+def start_download_job(members, cache_key, archive_format='zip'):
+    """Create a download job for the resolved selection and start its worker"""
+    job_id = uuid.uuid4().hex
+    job = {
+        'id': job_id,
+        'status': 'pending',
+        'created': datetime.now().isoformat(),
+        'members': [list(member) for member in members],
+        'cacheKey': cache_key,
+        'format': archive_format,
+        'archiveKey': get_archive_key(cache_key, archive_format),
+        'picturesDone': 0,
+        'bytesWritten': 0,
+        'uploadId': None,
+        'parts': [],
+        'archiveState': {},
+        'skipped': [],
+        'errors': 0
+    }
+    save_job(job)
+    print(f"Created download job {job_id} for {len(members)} pictures")
+    
+    invoke_download_worker(job_id)
+    
+    return {
+        'statusCode': 202,
+        'headers': get_cors_headers(),
+        'body': json.dumps({
+            'jobId': job_id,
+            'status': job['status'],
+            'pictureCount': len(members)
+        })
+    }
+
+def get_job_checkpoint(job):
+    """Copy the progress fields of a download job that must be saved together"""
+    return json.loads(json.dumps({field: job[field] for field in JOB_CHECKPOINT_FIELDS}))
+
+def run_download_job(job_id, context):
+    """
+    Build a job's archive as an S3 multipart upload.
+    
+    State is checkpointed after every uploaded part, so the worker hands off to a
+    fresh invocation before it runs out of time and resumes from the last part.
+    """
+    job = load_job(job_id)
+    if job['status'] in ('complete', 'failed'):
+        return {'jobId': job_id, 'status': job['status']}
+    
+    # Uploaded parts are only ever saved together with the archive state they end at
+    checkpoint = get_job_checkpoint(job)
+    try:
+        if not job['uploadId']:
+            upload_response = s3_client.create_multipart_upload(
+                Bucket=PICTURES_BUCKET,
+                Key=job['archiveKey'],
+                ContentType=ARCHIVE_FORMATS[job['format']][1],
+                Metadata={
+                    'selection-hash': job['cacheKey'],
+                    'picture-count': str(len(job['members']))
+                }
+            )
+            job['uploadId'] = upload_response['UploadId']
+        job['status'] = 'running'
+        save_job(job)
+        
+        # Pick up the archive exactly where the last checkpoint left it
+        stream = ArchivePartStream(offset=job['bytesWritten'])
+        archive = ArchiveWriter(job['format'], stream, job['archiveState'])
+        skipped = list(job['skipped'])
+        
+        def upload_part(data):
+            part_number = len(job['parts']) + 1
+            part_response = s3_client.upload_part(
+                Bucket=PICTURES_BUCKET,
+                Key=job['archiveKey'],
+                UploadId=job['uploadId'],
+                PartNumber=part_number,
+                Body=data
+            )
+            job['parts'].append({'PartNumber': part_number, 'ETag': part_response['ETag']})
+        
+        index = job['picturesDone']
+        while index < len(job['members']):
+            remaining_ms = context.get_remaining_time_in_millis() if hasattr(context, 'get_remaining_time_in_millis') else None
+            if remaining_ms is not None and remaining_ms < JOB_TIME_RESERVE_MS:
+                # Anything after the last checkpoint is rebuilt by the next worker
+                print(f"Job {job_id} handing off at picture {job['picturesDone']}")
+                invoke_download_worker(job_id)
+                return {'jobId': job_id, 'status': job['status']}
+            
+            picture_name, target_key, _ = job['members'][index]
+            try:
+                obj_response = s3_client.get_object(
+                    Bucket=PICTURES_BUCKET,
+                    Key=target_key
+                )
+                archive.add(picture_name, obj_response['Body'].read())
+            except s3_client.exceptions.NoSuchKey:
+                # Deleted since the job started; the selection no longer hashes to this archive
+                print(f"Picture deleted during job {job_id}: {target_key}")
+                skipped.append(picture_name)
+            index += 1
+            
+            # Checkpoint once a full part is buffered (S3 parts must be at least 5 MB)
+            if len(stream.buffer) >= ARCHIVE_PART_SIZE:
+                job['archiveState'] = archive.state()
+                upload_part(stream.take())
+                job['bytesWritten'] = stream.offset
+                job['picturesDone'] = index
+                job['skipped'] = list(skipped)
+                job['errors'] = 0
+                save_job(job)
+                checkpoint = get_job_checkpoint(job)
+        
+        # Write the archive trailer and upload it with the last part
+        archive.close()
+        upload_part(stream.take())
+        s3_client.complete_multipart_upload(
+            Bucket=PICTURES_BUCKET,
+            Key=job['archiveKey'],
+            UploadId=job['uploadId'],
+            MultipartUpload={'Parts': job['parts']}
+        )
         
-        # Decode base64 image data
-        image_bytes = base64.b64decode(picture_data)
+        job['status'] = 'complete'
+        job['bytesWritten'] = stream.offset
+        job['picturesDone'] = len(job['members'])
+        job['skipped'] = skipped
+        job['archiveState'] = {}
+        save_job(job)
+        print(f"Job {job_id} complete: {job['bytesWritten']} bytes in {len(job['parts'])} parts")
         
-        # Use original image data (no processing to avoid PIL dependency)
-        processed_image_bytes = image_bytes
+        prune_archive_cache()
+        return {'jobId': job_id, 'status': job['status']}
         
-        # Generate unique filename
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        file_extension = picture_name.split('.')[-1] if '.' in picture_name else 'jpg'
-        s3_key = f"pictures/{timestamp}_{uuid.uuid4().hex[:8]}.{file_extension}"
+    except Exception as e:
+        print(f"Error running download job {job_id}: {str(e)}")
+        import traceback
+        print(f"Traceback: {traceback.format_exc()}")
         
-        # Upload to S3
-        s3_client.put_object(
-            Bucket=PICTURES_BUCKET,
-            Key=s3_key,
-            Body=processed_image_bytes,
-            ContentType=content_type,
-            Metadata={
-                'original-name': picture_name,
-                'upload_date': datetime.now().isoformat(),
-                'rating': '0'
+        # Drop parts uploaded since the last checkpoint; the retry uploads them again
+        job.update(checkpoint)
+        job['errors'] = job.get('errors', 0) + 1
+        if job['errors'] > JOB_MAX_RETRIES:
+            job['status'] = 'failed'
+            job['error'] = str(e)
+            if job['uploadId']:
+                s3_client.abort_multipart_upload(
+                    Bucket=PICTURES_BUCKET,
+                    Key=job['archiveKey'],
+                    UploadId=job['uploadId']
+                )
+            save_job(job)
+            return {'jobId': job_id, 'status': job['status']}
+        
+        # Retry from the last checkpoint; progress since then was not saved
+        save_job(job)
+        invoke_download_worker(job_id)
+        return {'jobId': job_id, 'status': job['status']}
+
+def get_download_job(job_id):
+    """Report the progress of a download job"""
+    try:
+        try:
+            job = load_job(job_id)
+        except s3_client.exceptions.NoSuchKey:
+            return {
+                'statusCode': 404,
+                'headers': get_cors_headers(),
+                'body': json.dumps({'error': f'Job not found: {job_id}'})
             }
-        )
         
-        # Store metadata in Iceberg table (simplified - just log for now)
-        print(f"Picture uploaded: {s3_key}, original: {picture_name}")
+        result = {
+            'jobId': job['id'],
+            'status': job['status'],
+            'picturesDone': job['picturesDone'],
+            'pictureCount': len(job['members']),
+            'bytesWritten': job['bytesWritten']
+        }
+        
+        if job['status'] == 'complete':
+            result['url'] = s3_client.generate_presigned_url(
+                'get_object',
+                Params={
+                    'Bucket': PICTURES_BUCKET,
+                    'Key': job['archiveKey'],
+                    'ResponseContentDisposition': f'attachment; filename="{get_archive_filename(job["format"])}"'
+                },
+                ExpiresIn=3600  # 1 hour
+            )
+            if job['skipped']:
+                result['skipped'] = job['skipped']
+        elif job['status'] == 'failed':
+            result['error'] = job.get('error', 'Unknown error')
         
         return {
             'statusCode': 200,
             'headers': get_cors_headers(),
-            'body': json.dumps({
-                'message': 'Picture uploaded successfully',
-                'key': s3_key,
-                'original_name': picture_name
-            })
+            'body': json.dumps(result)
         }
         
     except Exception as e:
-        print(f"Error uploading picture: {str(e)}")
+        print(f"Error getting job {job_id}: {str(e)}")
         return {
             'statusCode': 500,
             'headers': get_cors_headers(),
-            'body': json.dumps({'error': f'Failed to upload picture: {str(e)}'})
+            'body': json.dumps({'error': f'Failed to get job: {str(e)}'})
+        }
+
+# Records this process has spooled since it last triggered a flush, and when it last checked the spool
+ingest_spooled = 0
+ingest_checked_at = 0.0
+
+def is_picture_key(s3_key):
+    """Check whether a stored key is a picture, as opposed to an object the gallery ignores"""
+    return s3_key.lower().endswith(PICTURE_EXTENSIONS)
+
+def get_picture_id(s3_key):
+    """Get the Iceberg pictures table id of a stored picture"""
+    return s3_key.split('/')[-1].rsplit('.', 1)[0]
+
+def get_upload_time(metadata, fallback):
+    """Get when a picture was uploaded from its metadata, which object copies do not change"""
+    try:
+        uploaded_at = datetime.fromisoformat(metadata['upload_date'])
+    except (KeyError, ValueError):
+        return fallback
+    return uploaded_at if uploaded_at.tzinfo else uploaded_at.replace(tzinfo=timezone.utc)
+
+def get_picture_record(s3_key, picture_name, metadata, size, uploaded_at):
+    """Get the Iceberg pictures table record for a stored picture"""
+    return {
+        'picture_id': get_picture_id(s3_key),
+        'picture_name': picture_name,
+        'picture_date': (metadata.get('captured-at') or uploaded_at.isoformat())[:10],
+        'picture_jpg': s3_key,
+        'upload_timestamp': uploaded_at.isoformat(),
+        'file_size': size,
+        'image_width': metadata.get('width'),
+        'image_height': metadata.get('height'),
+        'rating': int(metadata.get('rating') or 0),
+        'metadata': json.dumps(metadata)
+    }
+
+def spool_ingest_record(record):
+    """
+    Spool a change to a picture's row for the next Iceberg ingestion flush.
+    
+    Every change is its own small object under the picture's prefix, named so
+    later changes sort after earlier ones; a flush keeps the latest per picture.
+    Enough records spooled by this process start a flush straight away;
+    otherwise the spool is checked for a full or aged batch.
+    """
+    global ingest_spooled
+    
+    if not ICEBERG_INGEST_ENABLED:
+        return
+    
+    try:
+        s3_client.put_object(
+            Bucket=PICTURES_BUCKET,
+            Key=f"{INGEST_PENDING_PREFIX}{record['picture_id']}/{time.time_ns():020d}-{uuid.uuid4().hex[:8]}.json",
+            Body=json.dumps(record).encode('utf-8'),
+            ContentType='application/json'
+        )
+        
+        ingest_spooled += 1
+        if ingest_spooled >= INGEST_BATCH_SIZE:
+            ingest_spooled = 0
+            invoke_ingest_worker()
+        else:
+            check_ingest_spool()
+    except Exception as e:
+        # The picture is stored; the table catches up at the next backfill
+        print(f"Error spooling Iceberg record for {record['picture_id']}: {e}")
+
+def check_ingest_spool():
+    """
+    Start a flush once INGEST_BATCH_SIZE records are pending or the oldest has
+    waited INGEST_MAX_AGE_SECONDS.
+    
+    Nothing flushes on a timer, so spooling a record and reading the Iceberg
+    listing call this; each process looks at most every INGEST_CHECK_INTERVAL_SECONDS.
+    """
+    global ingest_checked_at
+    
+    now = time.monotonic()
+    if now - ingest_checked_at < INGEST_CHECK_INTERVAL_SECONDS:
+        return
+    ingest_checked_at = now
+    
+    pending = 0
+    oldest = None
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=PICTURES_BUCKET, Prefix=INGEST_PENDING_PREFIX):
+        for obj in page.get('Contents', []):
+            pending += 1
+            oldest = obj['LastModified'] if oldest is None else min(oldest, obj['LastModified'])
+    
+    if pending and (
+        pending >= INGEST_BATCH_SIZE
+        or (datetime.now(timezone.utc) - oldest).total_seconds() >= INGEST_MAX_AGE_SECONDS
+    ):
+        print(f"Ingestion spool holds {pending} record(s), starting a flush")
+        invoke_ingest_worker()
+
+def get_pending_picture_records():
+    """
+    Get the latest spooled record of each picture with changes not yet flushed,
+    by picture id; deleted pictures map to None
+    """
+    latest = {}
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=PICTURES_BUCKET, Prefix=INGEST_PENDING_PREFIX):
+        for obj in page.get('Contents', []):
+            # Keys sort by picture, then by when the change was spooled
+            picture_id = obj['Key'][len(INGEST_PENDING_PREFIX):].split('/', 1)[0]
+            latest[picture_id] = max(latest.get(picture_id, ''), obj['Key'])
+    
+    records = {}
+    for picture_id, key in latest.items():
+        try:
+            response = s3_client.get_object(Bucket=PICTURES_BUCKET, Key=key)
+        except ClientError as e:
+            # Flushed since it was listed, so the table has it
+            if e.response.get('Error', {}).get('Code') != 'NoSuchKey':
+                raise
+            continue
+        record = json.loads(response['Body'].read())
+        records[picture_id] = None if record.get('deleted') else record
+    return records
+
+def spool_picture_record(s3_key, picture_name, metadata, size, uploaded_at, change='insert'):
+    """Spool the row of a new ('insert') or changed ('update') picture"""
+    spool_ingest_record({
+        **get_picture_record(s3_key, picture_name, metadata, size, uploaded_at),
+        'change': change
+    })
+
+def spool_picture_update(s3_key, head_response, metadata):
+    """Spool the row of a stored picture whose metadata changed"""
+    spool_picture_record(
+        s3_key,
+        metadata.get('original-name', s3_key.split('/')[-1]),
+        metadata,
+        head_response.get('ContentLength'),
+        get_upload_time(metadata, head_response.get('LastModified', datetime.now(timezone.utc))),
+        change='update'
+    )
+
+def backfill_ingest(context=None, continuation_token=None):
+    """
+    Spool the rows of every stored picture and flush them, to fill or repair the
+    Iceberg table. Rows are replaced by picture, so running it again is harmless.
+    
+    The bucket is listed a page at a time; when the invocation runs low on time
+    the listing's continuation token is handed to a fresh one, and the last page
+    starts a forced flush. Run by invoking the function with {"backfill_ingest": true}.
+    """
+    spooled = 0
+    while True:
+        page = s3_client.list_objects_v2(
+            Bucket=PICTURES_BUCKET,
+            Prefix='pictures/',
+            MaxKeys=INGEST_BACKFILL_PAGE_SIZE,
+            **({'ContinuationToken': continuation_token} if continuation_token else {})
+        )
+        for obj in page.get('Contents', []):
+            if not is_picture_key(obj['Key']):
+                continue
+            head_response = s3_client.head_object(Bucket=PICTURES_BUCKET, Key=obj['Key'])
+            spool_picture_update(obj['Key'], head_response, head_response.get('Metadata', {}))
+            spooled += 1
+        
+        if not page.get('IsTruncated'):
+            break
+        continuation_token = page['NextContinuationToken']
+        
+        remaining_ms = context.get_remaining_time_in_millis() if hasattr(context, 'get_remaining_time_in_millis') else None
+        if remaining_ms is not None and remaining_ms < INGEST_BACKFILL_TIME_RESERVE_MS:
+            print(f"Spooled {spooled} picture record(s) for backfill, handing off")
+            invoke_backfill_worker(continuation_token)
+            return {'spooled': spooled, 'continued': True}
+    
+    print(f"Spooled {spooled} picture record(s) for backfill")
+    return {'spooled': spooled, **(invoke_ingest_worker(force=True) or {'flushStarted': True})}
+
+def invoke_backfill_worker(continuation_token):
+    """Continue a backfill from a listing continuation token in a separate asynchronous invocation"""
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    if not function_name:
+        # Not running in Lambda (local testing) - do the work inline
+        return backfill_ingest(None, continuation_token)
+    
+    lambda_client = boto3.client('lambda')
+    lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=json.dumps({'backfill_ingest': True, 'continuationToken': continuation_token})
+    )
+
+def invoke_ingest_worker(force=False):
+    """Run an ingestion flush in a separate asynchronous invocation of this function"""
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    if not function_name:
+        # Not running in Lambda (local testing) - do the work inline
+        return flush_ingest(force=force)
+    
+    lambda_client = boto3.client('lambda')
+    lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=json.dumps({'flush_ingest': True, 'force': force})
+    )
+
+def get_ingest_batch():
+    """
+    Get the batch to commit next: an unfinished one left by an earlier flush, or
+    a new one of the oldest pending records
+    """
+    try:
+        response = s3_client.get_object(Bucket=PICTURES_BUCKET, Key=INGEST_BATCH_KEY)
+        return json.loads(response['Body'].read())
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') != 'NoSuchKey':
+            raise
+    
+    pending = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=PICTURES_BUCKET, Prefix=INGEST_PENDING_PREFIX):
+        pending.extend(page.get('Contents', []))
+    if not pending:
+        return None
+    
+    pending.sort(key=lambda obj: obj['LastModified'])
+    batch = {
+        'id': uuid.uuid4().hex,
+        'keys': [obj['Key'] for obj in pending[:INGEST_MAX_BATCH_RECORDS]],
+        'pending': len(pending),
+        'oldest': pending[0]['LastModified'].isoformat()
+    }
+    return batch
+
+def flush_ingest(force=False):
+    """
+    Write spooled picture records to the Iceberg table in as few commits as possible.
+    
+    Does nothing until INGEST_BATCH_SIZE records are pending or the oldest has
+    waited INGEST_MAX_AGE_SECONDS, unless forced. Each batch is saved before it
+    is committed and carries its id into the snapshot, so a flush interrupted
+    after committing finishes the same batch next time instead of appending it
+    again. Started by check_ingest_spool, or run by invoking the function with
+    {"flush_ingest": true}.
+    """
+    try:
+        from iceberg_setup import write_picture_records
+    except ImportError as e:
+        print(f"PyIceberg not available - cannot flush ingestion spool: {e}")
+        return {'flushed': 0, 'error': 'Iceberg support is not installed'}
+    
+    owner = uuid.uuid4().hex
+    
+    def take_lease(lease):
+        if lease.get('expires', 0) > time.time() and lease.get('owner') != owner:
+            return lease
+        return {'owner': owner, 'expires': time.time() + INGEST_LEASE_SECONDS}
+    
+    if update_json_object(INGEST_LEASE_KEY, take_lease, {}).get('owner') != owner:
+        print("Another ingestion flush is running")
+        return {'flushed': 0, 'busy': True}
+    
+    flushed = batches = 0
+    try:
+        while True:
+            batch = get_ingest_batch()
+            if batch is None:
+                break
+            
+            if 'pending' in batch:
+                oldest_age = (datetime.now(timezone.utc) - datetime.fromisoformat(batch['oldest'])).total_seconds()
+                if not force and not batches and batch['pending'] < INGEST_BATCH_SIZE and oldest_age < INGEST_MAX_AGE_SECONDS:
+                    print(f"Ingestion spool holds {batch['pending']} record(s), waiting for more")
+                    break
+                s3_client.put_object(
+                    Bucket=PICTURES_BUCKET,
+                    Key=INGEST_BATCH_KEY,
+                    Body=json.dumps({'id': batch['id'], 'keys': batch['keys']}).encode('utf-8'),
+                    ContentType='application/json'
+                )
+            
+            # Keys sort by picture, then by when the change was spooled; keep each picture's latest.
+            # Every picture's old row is replaced, as an insert may already be in the table from a backfill
+            latest = {}
+            for key in sorted(batch['keys']):
+                try:
+                    response = s3_client.get_object(Bucket=PICTURES_BUCKET, Key=key)
+                    record = json.loads(response['Body'].read())
+                    latest[record['picture_id']] = record
+                except ClientError as e:
+                    # Cleared by an interrupted flush after its commit
+                    if e.response.get('Error', {}).get('Code') != 'NoSuchKey':
+                        raise
+            
+            if latest:
+                flushed += write_picture_records(
+                    list(latest.values()),
+                    batch['id'],
+                    replace_ids=list(latest)
+                )
+            
+            for i in range(0, len(batch['keys']), 1000):
+                s3_client.delete_objects(
+                    Bucket=PICTURES_BUCKET,
+                    Delete={'Objects': [{'Key': key} for key in batch['keys'][i:i + 1000]], 'Quiet': True}
+                )
+            s3_client.delete_object(Bucket=PICTURES_BUCKET, Key=INGEST_BATCH_KEY)
+            batches += 1
+            # Keep the lease for the next batch
+            if update_json_object(INGEST_LEASE_KEY, take_lease, {}).get('owner') != owner:
+                print("Ingestion flush lease was taken over")
+                break
+    finally:
+        update_json_object(INGEST_LEASE_KEY, lambda lease: {} if lease.get('owner') == owner else lease, {})
+    
+    print(f"Flushed {flushed} picture record(s) to Iceberg in {batches} batch(es)")
+    return {'flushed': flushed, 'batches': batches}
+
+def generate_picture_key(picture_name):
+    """Generate a unique S3 key for a new picture"""
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    file_extension = picture_name.split('.')[-1] if '.' in picture_name else 'jpg'
+    return f"pictures/{timestamp}_{uuid.uuid4().hex[:8]}.{file_extension}"
+
+def create_upload_url(event):
+    """Create a presigned POST so the browser can upload a picture straight to S3"""
+    try:
+        # Parse the request body
+        body = event.get('body', '')
+        if event.get('isBase64Encoded', False):
+            body = base64.b64decode(body).decode('utf-8')
+        
+        data = json.loads(body)
+        picture_name = data.get('name', f'picture_{uuid.uuid4().hex[:8]}.jpg')
+        content_type = data.get('contentType') or 'image/jpeg'
+        
+        if not content_type.startswith('image/'):
+            return {
+                'statusCode': 400,
+                'headers': get_cors_headers(),
+                'body': json.dumps({'error': f'Unsupported content type: {content_type}'})
+            }
+        
+        # With the client's SHA-256 a duplicate needs no upload at all
+        digest = (data.get('sha256') or '').lower()
+        if not re.fullmatch(r'[0-9a-f]{64}', digest):
+            digest = ''
+        duplicate = find_duplicate_picture(digest)
+        if duplicate:
+            return {
+                'statusCode': 200,
+                'headers': get_cors_headers(),
+                'body': json.dumps(record_duplicate_upload(digest, duplicate, picture_name))
+            }
+        
+        s3_key = generate_picture_key(picture_name)
+        
+        # The metadata is recorded by S3 itself from these signed form fields
+        fields = {
+            'Content-Type': content_type,
+            'x-amz-meta-original-name': picture_name,
+            'x-amz-meta-upload_date': datetime.now().isoformat(),
+            'x-amz-meta-rating': '0'
+        }
+        if digest:
+            # S3 rejects the upload unless its bytes hash to the declared digest
+            fields['x-amz-checksum-algorithm'] = 'SHA256'
+            fields['x-amz-checksum-sha256'] = get_checksum_value(digest)
+            fields['x-amz-meta-sha256'] = digest
+        conditions = [{name: value} for name, value in fields.items()]
+        conditions.append(['content-length-range', 1, MAX_UPLOAD_BYTES])
+        
+        presigned_post = s3_client.generate_presigned_post(
+            Bucket=PICTURES_BUCKET,
+            Key=s3_key,
+            Fields=fields,
+            Conditions=conditions,
+            ExpiresIn=UPLOAD_URL_EXPIRES_SECONDS
+        )
+        
+        print(f"Created upload URL for {picture_name}: {s3_key}")
+        
+        return {
+            'statusCode': 200,
+            'headers': get_cors_headers(),
+            'body': json.dumps({
+                'url': presigned_post['url'],
+                'fields': presigned_post['fields'],
+                'key': s3_key
+            })
+        }
+        
+    except Exception as e:
+        print(f"Error creating upload URL: {str(e)}")
+        return {
+            'statusCode': 500,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'error': f'Failed to create upload URL: {str(e)}'})
+        }
+
+def complete_upload(event):
+    """Finalize a picture uploaded directly to S3 through a presigned POST"""
+    try:
+        # Parse the request body
+        body = event.get('body', '')
+        if event.get('isBase64Encoded', False):
+            body = base64.b64decode(body).decode('utf-8')
+        
+        data = json.loads(body)
+        s3_key = data.get('key', '')
+        
+        if not s3_key.startswith('pictures/'):
+            return {
+                'statusCode': 400,
+                'headers': get_cors_headers(),
+                'body': json.dumps({'error': 'A picture key is required'})
+            }
+        
+        return finalize_upload(s3_key, first_completion=None)
+        
+    except Exception as e:
+        print(f"Error completing upload: {str(e)}")
+        return {
+            'statusCode': 500,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'error': f'Failed to complete upload: {str(e)}'})
+        }
+
+def finalize_upload(s3_key, first_completion=True):
+    """
+    Record a picture whose bytes were uploaded directly to S3. A repeated
+    completion (first_completion False) returns the picture without counting it again;
+    None leaves that to the finalized flag the first completion stores on the picture.
+    """
+    try:
+        try:
+            head_response = s3_client.head_object(
+                Bucket=PICTURES_BUCKET,
+                Key=s3_key,
+                ChecksumMode='ENABLED'
+            )
+        except Exception as head_error:
+            print(f"Uploaded object not found {s3_key}: {head_error}")
+            return {
+                'statusCode': 404,
+                'headers': get_cors_headers(),
+                'body': json.dumps({'error': f'Upload not found: {s3_key}'})
+            }
+        
+        metadata = head_response.get('Metadata', {})
+        picture_name = metadata.get('original-name', s3_key.split('/')[-1])
+        finalized = bool(metadata.get('finalized'))
+        if first_completion is None:
+            # Presigned POSTs stop at the single-upload limit, so larger pictures came
+            # through a multipart completion, which already decided this
+            first_completion = not finalized and head_response.get('ContentLength', 0) <= COPY_OBJECT_MAX_BYTES
+        
+        # The client's digest is only indexed once S3 has verified it against the bytes
+        digest = metadata.get('sha256')
+        if digest and head_response.get('ChecksumSHA256') != get_checksum_value(digest):
+            print(f"Ignoring unverified SHA-256 for {s3_key}")
+            digest = None
+        duplicate = None
+        if digest:
+            # Another upload of the same content may have finished first
+            duplicate = find_duplicate_picture(digest) or claim_hash_index_entry(digest, {
+                'key': s3_key,
+                'name': picture_name,
+                'size': head_response.get('ContentLength'),
+                'created': datetime.now().isoformat()
+            })
+            if duplicate and duplicate['key'] != s3_key:
+                s3_client.delete_object(Bucket=PICTURES_BUCKET, Key=s3_key)
+                return {
+                    'statusCode': 200,
+                    'headers': get_cors_headers(),
+                    'body': json.dumps(record_duplicate_upload(digest, duplicate, picture_name))
+                }
+        
+        if finalized:
+            # Processed and indexed by the completion that set the flag
+            similar = []
+        else:
+            metadata = process_uploaded_image(s3_key, head_response)
+            similar = index_perceptual_hash(s3_key, metadata)
+        
+        last_modified = head_response.get('LastModified', datetime.now(timezone.utc))
+        if not duplicate and first_completion and is_picture_key(s3_key):
+            record_stats_change(pictures=1, storage=head_response.get('ContentLength', 0), last_upload=last_modified.isoformat())
+            record_activity(uploads=1, when=last_modified)
+            spool_picture_record(s3_key, picture_name, metadata, head_response.get('ContentLength'), last_modified)
+        
+        print(f"Picture uploaded: {s3_key}, original: {picture_name}, size: {head_response.get('ContentLength')}")
+        
+        return {
+            'statusCode': 200,
+            'headers': get_cors_headers(),
+            'body': json.dumps({
+                'message': 'Picture uploaded successfully',
+                'key': s3_key,
+                'original_name': picture_name,
+                'deduplicated': False,
+                'similar': similar,
+                'picture': get_picture_info(s3_key, last_modified, metadata)
+            })
+        }
+        
+    except Exception as e:
+        print(f"Error finalizing upload {s3_key}: {str(e)}")
+        return {
+            'statusCode': 500,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'error': f'Failed to complete upload: {str(e)}'})
+        }
+
+def get_multipart_request(event):
+    """Parse a multipart upload request, returning (data, error response)"""
+    if event.get('requestContext', {}).get('http', {}).get('method') == 'GET':
+        data = event.get('queryStringParameters') or {}
+    else:
+        body = event.get('body', '')
+        if event.get('isBase64Encoded', False):
+            body = base64.b64decode(body).decode('utf-8')
+        data = json.loads(body) if body else {}
+    
+    if not data.get('key', '').startswith('pictures/') or not data.get('uploadId'):
+        return data, {
+            'statusCode': 400,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'error': 'Picture key and uploadId are required'})
+        }
+    
+    return data, None
+
+def initiate_multipart_upload(event):
+    """Start a resumable multipart upload for a large picture"""
+    try:
+        # Parse the request body
+        body = event.get('body', '')
+        if event.get('isBase64Encoded', False):
+            body = base64.b64decode(body).decode('utf-8')
+        
+        data = json.loads(body)
+        picture_name = data.get('name', f'picture_{uuid.uuid4().hex[:8]}.jpg')
+        content_type = data.get('contentType') or 'image/jpeg'
+        
+        if not content_type.startswith('image/'):
+            return {
+                'statusCode': 400,
+                'headers': get_cors_headers(),
+                'body': json.dumps({'error': f'Unsupported content type: {content_type}'})
+            }
+        
+        s3_key = generate_picture_key(picture_name)
+        upload_response = s3_client.create_multipart_upload(
+            Bucket=PICTURES_BUCKET,
+            Key=s3_key,
+            ContentType=content_type,
+            Metadata={
+                'original-name': picture_name,
+                'upload_date': datetime.now().isoformat(),
+                'rating': '0'
+            }
+        )
+        
+        print(f"Started multipart upload for {picture_name}: {s3_key}")
+        
+        return {
+            'statusCode': 200,
+            'headers': get_cors_headers(),
+            'body': json.dumps({
+                'key': s3_key,
+                'uploadId': upload_response['UploadId'],
+                'partSize': MULTIPART_PART_SIZE
+            })
+        }
+        
+    except Exception as e:
+        print(f"Error starting multipart upload: {str(e)}")
+        return {
+            'statusCode': 500,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'error': f'Failed to start multipart upload: {str(e)}'})
+        }
+
+def create_part_upload_url(event):
+    """Presign the upload of one part of a multipart upload"""
+    try:
+        data, error_response = get_multipart_request(event)
+        if error_response:
+            return error_response
+        
+        part_number = data.get('partNumber')
+        if not isinstance(part_number, int) or part_number < 1 or part_number > 10000:
+            return {
+                'statusCode': 400,
+                'headers': get_cors_headers(),
+                'body': json.dumps({'error': 'partNumber must be an integer between 1 and 10000'})
+            }
+        
+        url = s3_client.generate_presigned_url(
+            'upload_part',
+            Params={
+                'Bucket': PICTURES_BUCKET,
+                'Key': data['key'],
+                'UploadId': data['uploadId'],
+                'PartNumber': part_number
+            },
+            ExpiresIn=UPLOAD_URL_EXPIRES_SECONDS
+        )
+        
+        return {
+            'statusCode': 200,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'url': url, 'partNumber': part_number})
+        }
+        
+    except Exception as e:
+        print(f"Error presigning upload part: {str(e)}")
+        return {
+            'statusCode': 500,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'error': f'Failed to presign upload part: {str(e)}'})
+        }
+
+def get_uploaded_parts(s3_key, upload_id):
+    """Get the number, ETag and size of every part S3 holds for a multipart upload"""
+    parts = []
+    paginator = s3_client.get_paginator('list_parts')
+    for page in paginator.paginate(Bucket=PICTURES_BUCKET, Key=s3_key, UploadId=upload_id):
+        for part in page.get('Parts', []):
+            parts.append({
+                'PartNumber': part['PartNumber'],
+                'ETag': part['ETag'],
+                'Size': part['Size']
+            })
+    return parts
+
+def list_uploaded_parts(event):
+    """List the parts of a multipart upload that S3 already has, for resuming"""
+    try:
+        data, error_response = get_multipart_request(event)
+        if error_response:
+            return error_response
+        
+        try:
+            parts = get_uploaded_parts(data['key'], data['uploadId'])
+        except s3_client.exceptions.NoSuchUpload:
+            return {
+                'statusCode': 404,
+                'headers': get_cors_headers(),
+                'body': json.dumps({'error': 'Upload not found or already finished'})
+            }
+        
+        return {
+            'statusCode': 200,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'parts': parts})
+        }
+        
+    except Exception as e:
+        print(f"Error listing upload parts: {str(e)}")
+        return {
+            'statusCode': 500,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'error': f'Failed to list upload parts: {str(e)}'})
+        }
+
+def complete_multipart_upload(event):
+    """Assemble the uploaded parts into the picture and record it"""
+    try:
+        data, error_response = get_multipart_request(event)
+        if error_response:
+            return error_response
+        
+        parts = sorted(
+            ({'PartNumber': int(part['PartNumber']), 'ETag': part['ETag']} for part in data.get('parts', [])),
+            key=lambda part: part['PartNumber']
+        )
+        if not parts:
+            return {
+                'statusCode': 400,
+                'headers': get_cors_headers(),
+                'body': json.dumps({'error': 'No parts specified'})
+            }
+        
+        # Parts have no total cap, so the assembled size is checked before the picture exists
+        try:
+            part_sizes = {part['PartNumber']: part['Size'] for part in get_uploaded_parts(data['key'], data['uploadId'])}
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+                raise
+            part_sizes = {}  # Already completed; the completion below finds that out
+        if sum(part_sizes.get(part['PartNumber'], 0) for part in parts) > MAX_UPLOAD_BYTES:
+            s3_client.abort_multipart_upload(
+                Bucket=PICTURES_BUCKET,
+                Key=data['key'],
+                UploadId=data['uploadId']
+            )
+            return {
+                'statusCode': 413,
+                'headers': get_cors_headers(),
+                'body': json.dumps({'error': f'Pictures are limited to {MAX_UPLOAD_BYTES} bytes'})
+            }
+        
+        try:
+            # Picture keys are unique, so only the first completion can create the object
+            s3_client.complete_multipart_upload(
+                Bucket=PICTURES_BUCKET,
+                Key=data['key'],
+                UploadId=data['uploadId'],
+                MultipartUpload={'Parts': parts},
+                IfNoneMatch='*'
+            )
+            print(f"Completed multipart upload {data['key']} with {len(parts)} parts")
+            first_completion = True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('NoSuchUpload', 'PreconditionFailed'):
+                raise
+            print(f"Multipart upload {data['key']} was already completed")
+            first_completion = False
+        
+        return finalize_upload(data['key'], first_completion)
+        
+    except Exception as e:
+        print(f"Error completing multipart upload: {str(e)}")
+        return {
+            'statusCode': 500,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'error': f'Failed to complete multipart upload: {str(e)}'})
+        }
+
+def abort_multipart_upload(event):
+    """Abort a multipart upload and discard its parts"""
+    try:
+        data, error_response = get_multipart_request(event)
+        if error_response:
+            return error_response
+        
+        s3_client.abort_multipart_upload(
+            Bucket=PICTURES_BUCKET,
+            Key=data['key'],
+            UploadId=data['uploadId']
+        )
+        print(f"Aborted multipart upload {data['key']}")
+        
+        return {
+            'statusCode': 200,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'aborted': True, 'key': data['key']})
+        }
+        
+    except Exception as e:
+        print(f"Error aborting multipart upload: {str(e)}")
+        return {
+            'statusCode': 500,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'error': f'Failed to abort multipart upload: {str(e)}'})
+        }
+
+def get_thumbnail_key(s3_key, width, image_format='jpeg'):
+    """Get the S3 key of a picture's thumbnail at the given width and format"""
+    stem = s3_key[len('pictures/'):].rsplit('.', 1)[0]
+    return f"{THUMBNAIL_PREFIX}{width}/{stem}.{VARIANT_FORMATS[image_format]['extension']}"
+
+def get_thumbnail_variants(metadata):
+    """Get the (widths, formats) of the thumbnails recorded in picture metadata"""
+    widths = [int(width) for width in metadata.get('thumbnails', '').split(',') if width]
+    # Pictures processed before variants existed only have JPEG thumbnails
+    formats = [image_format for image_format in metadata.get('variant-formats', 'jpeg').split(',') if image_format in VARIANT_FORMATS]
+    return widths, formats
+
+def get_derived_keys(s3_key, metadata):
+    """Get the keys of all objects generated from a picture"""
+    widths, formats = get_thumbnail_variants(metadata)
+    derived_keys = [get_thumbnail_key(s3_key, width, image_format) for width in widths for image_format in formats]
+    if metadata.get('dhash'):
+        derived_keys.append(get_perceptual_index_key(s3_key, metadata['dhash']))
+    if metadata.get('display'):
+        derived_keys.append(get_display_key(s3_key))
+    return derived_keys
+
+def get_supported_variant_formats():
+    """Get the thumbnail formats the local Pillow build can encode, JPEG always first"""
+    from PIL import Image, features
+    
+    formats = ['jpeg']
+    if features.check('webp'):
+        formats.append('webp')
+    # AVIF is built in from Pillow 11.3, or registered by pillow-avif-plugin
+    if features.check('avif') or 'AVIF' in Image.SAVE:
+        formats.append('avif')
+    return formats
+
+def process_image(s3_key, image_file, original_size=None):
+    """
+    Run the image processing stage for a new picture.
+    
+    Writes the derived images and returns the metadata entries describing them.
+    Processing is skipped when Pillow is unavailable or the image cannot be decoded.
+    """
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        print("Pillow not available - skipping image processing")
+        return {}
+    
+    try:
+        with Image.open(image_file) as image:
+            # Dimensions and EXIF come from the header, before any pixels are decoded
+            image_info = get_image_info(image)
+            
+            # Only decode at the resolution the largest derived image needs (JPEG DCT scaling).
+            # For thumbnails the short side is what counts, since EXIF orientation may turn it
+            # into the width; the display original caps the long side.
+            scale = max(THUMBNAIL_WIDTHS) / min(image.size)
+            if DISPLAY_ORIGINALS_ENABLED:
+                scale = max(scale, DISPLAY_MAX_DIMENSION / max(image.size))
+            scale = min(1.0, scale)
+            image.draft('RGB', (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+            
+            # Re-encoding as JPEG would drop transparency and animation
+            keep_original = getattr(image, 'is_animated', False) or image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info
+            icc_profile = image.info.get('icc_profile')
+            
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            
+            metadata = dict(image_info, dhash=compute_dhash(image), blurhash=compute_blurhash(image))
+            if DISPLAY_ORIGINALS_ENABLED and not keep_original:
+                if write_display_original(s3_key, image, icc_profile, original_size):
+                    metadata['display'] = 'jpeg'
+
+            formats = get_supported_variant_formats()
+            widths = write_thumbnails(s3_key, image, formats)
+            if widths:
+                metadata['thumbnails'] = ','.join(str(width) for width in widths)
+                metadata['variant-formats'] = ','.join(formats)
+            return metadata
+    
+    except Exception as e:
+        print(f"Error processing image {s3_key}: {e}")
+        return {}
+
+def get_image_info(image):
+    """
+    Get the dimensions and EXIF details of an opened image as metadata entries.
+    
+    Only the header is read. Width and height are as displayed, after EXIF orientation.
+    """
+    from PIL import ExifTags
+    
+    exif = image.getexif()
+    orientation = exif.get(ExifTags.Base.Orientation, 1)
+    width, height = image.size
+    if orientation in (5, 6, 7, 8):
+        width, height = height, width  # Rotated a quarter turn
+    
+    info = {
+        'width': str(width),
+        'height': str(height),
+        'orientation': str(orientation)
+    }
+    
+    captured_at = exif.get_ifd(ExifTags.IFD.Exif).get(ExifTags.Base.DateTimeOriginal) or exif.get(ExifTags.Base.DateTime)
+    if captured_at:
+        try:
+            info['captured-at'] = datetime.strptime(str(captured_at).strip('\x00 '), '%Y:%m:%d %H:%M:%S').isoformat()
+        except ValueError:
+            print(f"Ignoring unparseable EXIF date: {captured_at!r}")
+    
+    camera_model = str(exif.get(ExifTags.Base.Model, '')).strip('\x00 ')
+    if camera_model:
+        # S3 user metadata is limited to ASCII
+        info['camera-model'] = camera_model.encode('ascii', 'ignore').decode('ascii')
+    
+    return info
+
+def read_image_info(s3_key):
+    """Get dimensions and EXIF details of a stored picture from a ranged read of its header"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return {}
+    
+    try:
+        obj_response = s3_client.get_object(
+            Bucket=PICTURES_BUCKET,
+            Key=s3_key,
+            Range=f"bytes=0-{IMAGE_HEADER_BYTES - 1}"
+        )
+        with Image.open(io.BytesIO(obj_response['Body'].read())) as image:
+            return get_image_info(image)
+    except Exception as e:
+        print(f"Error reading image header {s3_key}: {e}")
+        return {}
+
+def get_display_key(s3_key):
+    """Get the S3 key of a picture's display original"""
+    stem = s3_key[len('pictures/'):].rsplit('.', 1)[0]
+    return f"{DISPLAY_PREFIX}{stem}.jpg"
+
+def write_display_original(s3_key, image, icc_profile=None, original_size=None):
+    """
+    Write the copy of a picture served for full-size views.
+    
+    The copy is capped at DISPLAY_MAX_DIMENSION and re-encoded as progressive JPEG.
+    EXIF, maker notes and embedded previews are dropped, keeping only the color profile.
+    Returns False without writing when the copy would not be smaller than the original.
+    """
+    from PIL import Image
+    
+    display = image.copy()
+    display.thumbnail((DISPLAY_MAX_DIMENSION, DISPLAY_MAX_DIMENSION), Image.LANCZOS)
+    
+    buffer = io.BytesIO()
+    display.save(buffer, 'JPEG', quality=DISPLAY_QUALITY, optimize=True, progressive=True, icc_profile=icc_profile)
+    if original_size is not None and buffer.tell() >= original_size:
+        return False
+    
+    s3_client.put_object(
+        Bucket=PICTURES_BUCKET,
+        Key=get_display_key(s3_key),
+        Body=buffer.getvalue(),
+        ContentType='image/jpeg',
+        CacheControl='public, max-age=31536000, immutable'
+    )
+    return True
+
+def write_thumbnails(s3_key, image, formats):
+    """Write fixed-width thumbnails in each format, no wider than the picture, returning the widths"""
+    from PIL import Image
+    
+    widths = sorted((width for width in THUMBNAIL_WIDTHS if width <= image.width), reverse=True)
+    
+    # Each thumbnail is scaled down from the previous, larger one
+    source = image
+    for width in widths:
+        height = max(1, round(source.height * width / source.width))
+        source = source.resize((width, height), Image.LANCZOS)
+        
+        for image_format in formats:
+            variant = VARIANT_FORMATS[image_format]
+            buffer = io.BytesIO()
+            source.save(buffer, variant['pillow_format'], **variant['options'])
+            s3_client.put_object(
+                Bucket=PICTURES_BUCKET,
+                Key=get_thumbnail_key(s3_key, width, image_format),
+                Body=buffer.getvalue(),
+                ContentType=variant['content_type'],
+                CacheControl='public, max-age=31536000, immutable'
+            )
+    
+    return sorted(widths)
+
+def process_uploaded_image(s3_key, head_response):
+    """Run image processing for a picture uploaded directly to S3 and record the results"""
+    if head_response.get('ContentLength', 0) > COPY_OBJECT_MAX_BYTES:
+        # Results are recorded by copying the object onto itself, which CopyObject cannot do past 5 GB
+        print(f"Skipping image processing for {s3_key}: too large to copy")
+        return head_response.get('Metadata', {})
+    if head_response.get('ContentLength', 0) > IMAGE_PROCESSING_MAX_BYTES:
+        # Too large to decode here, but the header still gives dimensions and EXIF
+        print(f"Skipping image processing for large picture {s3_key}")
+        processed_metadata = read_image_info(s3_key)
+    else:
+        obj_response = s3_client.get_object(
+            Bucket=PICTURES_BUCKET,
+            Key=s3_key
+        )
+        processed_metadata = process_image(s3_key, obj_response['Body'], head_response.get('ContentLength'))
+    
+    # The copy is made even without results so the flag stops a re-posted key being finalized twice
+    updated_metadata = head_response.get('Metadata', {}).copy()
+    updated_metadata.update(processed_metadata or {})
+    updated_metadata['finalized'] = 'true'
+    replace_picture_metadata(
+        s3_key, head_response, updated_metadata,
+        tagging=ARCHIVABLE_ORIGINAL_TAG if is_archivable(updated_metadata) else None
+    )
+    return updated_metadata
+
+def is_archivable(metadata):
+    """Check whether a picture's views are all served from derived images, leaving the original to downloads"""
+    return bool(metadata.get('display') and metadata.get('thumbnails'))
+
+def replace_picture_metadata(s3_key, head_response, metadata, tagging=None):
+    """
+    Replace a stored picture's user metadata by copying the object onto itself
+    (S3 doesn't allow direct metadata updates).
+    
+    The content type and storage class are carried over, so an archived original
+    stays archived; its tags are kept unless new tagging is given.
+    """
+    tag_args = {'TaggingDirective': 'REPLACE', 'Tagging': tagging} if tagging is not None else {}
+    s3_client.copy_object(
+        CopySource={'Bucket': PICTURES_BUCKET, 'Key': s3_key},
+        Bucket=PICTURES_BUCKET,
+        Key=s3_key,
+        Metadata=metadata,
+        MetadataDirective='REPLACE',
+        ContentType=head_response.get('ContentType', 'image/jpeg'),
+        StorageClass=head_response.get('StorageClass', 'STANDARD'),
+        **tag_args
+    )
+
+def get_hash_index_entry(digest):
+    """Get the hash index entry for a SHA-256 digest, or None"""
+    try:
+        obj_response = s3_client.get_object(
+            Bucket=PICTURES_BUCKET,
+            Key=f"{HASH_INDEX_PREFIX}{digest}.json"
+        )
+        return json.loads(obj_response['Body'].read())
+    except Exception:
+        return None
+
+def get_checksum_value(digest):
+    """Get a hex SHA-256 digest in the base64 form S3 checksums use"""
+    return base64.b64encode(bytes.fromhex(digest)).decode('ascii')
+
+def save_hash_index_entry(digest, entry):
+    """
+    Create the hash index entry for a SHA-256 digest, returning False without
+    writing when the digest already has one
+    """
+    try:
+        s3_client.put_object(
+            Bucket=PICTURES_BUCKET,
+            Key=f"{HASH_INDEX_PREFIX}{digest}.json",
+            Body=json.dumps(entry),
+            ContentType='application/json',
+            IfNoneMatch='*'
+        )
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('PreconditionFailed', 'ConditionalRequestConflict'):
+            raise
+        return False
+
+def claim_hash_index_entry(digest, entry):
+    """
+    Index a new picture under its digest, returning None once it is indexed, or
+    the entry of the picture that claimed the digest first
+    """
+    while not save_hash_index_entry(digest, entry):
+        duplicate = find_duplicate_picture(digest)
+        if duplicate:
+            return duplicate
+        # The entry pointed at a deleted picture and was removed; claim it again
+    return None
+
+def find_duplicate_picture(digest):
+    """Find the stored picture with this content, dropping index entries whose picture is gone"""
+    if not digest:
+        return None
+    
+    entry = get_hash_index_entry(digest)
+    if not entry:
+        return None
+    
+    try:
+        s3_client.head_object(
+            Bucket=PICTURES_BUCKET,
+            Key=entry['key']
+        )
+    except Exception:
+        print(f"Removing stale hash index entry {digest} -> {entry['key']}")
+        s3_client.delete_object(Bucket=PICTURES_BUCKET, Key=f"{HASH_INDEX_PREFIX}{digest}.json")
+        return None
+    
+    return entry
+
+def record_duplicate_upload(digest, entry, picture_name):
+    """Record a duplicate upload as a reference to the stored picture"""
+    def add_reference(current):
+        current.setdefault('references', []).append({
+            'name': picture_name,
+            'date': datetime.now().isoformat()
+        })
+        return current
+    
+    update_json_object(f"{HASH_INDEX_PREFIX}{digest}.json", add_reference)
+    print(f"Duplicate upload of {picture_name} deduplicated to {entry['key']}")
+    
+    return {
+        'message': 'Picture already uploaded',
+        'key': entry['key'],
+        'original_name': entry['name'],
+        'deduplicated': True
+    }
+
+def compute_dhash(image):
+    """Compute the 64-bit difference hash of an image as 16 hex digits"""
+    from PIL import Image
+    
+    # One bit per horizontally adjacent pair of a 9x8 grayscale thumbnail
+    pixels = image.convert('L').resize((9, 8), Image.LANCZOS).tobytes()
+    value = 0
+    for row in range(8):
+        for column in range(8):
+            value = (value << 1) | (pixels[row * 9 + column] < pixels[row * 9 + column + 1])
+    return f"{value:016x}"
+
+def encode_base83(value, length):
+    """Encode an integer as fixed-length BlurHash base 83"""
+    return ''.join(BLURHASH_CHARACTERS[value // 83 ** (length - 1 - i) % 83] for i in range(length))
+
+def srgb_to_linear(value):
+    """Convert an 8-bit sRGB channel value to linear light from 0 to 1"""
+    value = value / 255
+    return value / 12.92 if value <= 0.04045 else ((value + 0.055) / 1.055) ** 2.4
+
+def linear_to_srgb(value):
+    """Convert a linear light value to an 8-bit sRGB channel value"""
+    value = max(0.0, min(1.0, value))
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+    return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+def compute_blurhash(image):
+    """Compute the BlurHash placeholder string of an image"""
+    from PIL import Image
+    
+    # The hash only keeps a few cosine components, so a tiny copy is plenty;
+    # grayscale and palette pictures are expanded to three channels
+    small = image.copy()
+    small.thumbnail((32, 32), Image.BILINEAR)
+    small = small.convert('RGB')
+    width, height = small.size
+    pixels = [tuple(srgb_to_linear(channel) for channel in pixel) for pixel in zip(*[iter(small.tobytes())] * 3)]
+    
+    components_x, components_y = BLURHASH_COMPONENTS
+    cos_x = [[math.cos(math.pi * i * x / width) for x in range(width)] for i in range(components_x)]
+    cos_y = [[math.cos(math.pi * j * y / height) for y in range(height)] for j in range(components_y)]
+    
+    factors = []
+    for j in range(components_y):
+        for i in range(components_x):
+            scale = (1 if i == j == 0 else 2) / (width * height)
+            r = g = b = 0.0
+            for y in range(height):
+                for x in range(width):
+                    basis = cos_x[i][x] * cos_y[j][y]
+                    pixel = pixels[y * width + x]
+                    r += basis * pixel[0]
+                    g += basis * pixel[1]
+                    b += basis * pixel[2]
+            factors.append((r * scale, g * scale, b * scale))
+    
+    dc, ac = factors[0], factors[1:]
+    blurhash = encode_base83((components_x - 1) + (components_y - 1) * 9, 1)
+    
+    maximum_value = 1.0
+    if ac:
+        quantised_max = max(0, min(82, int(max(abs(channel) for factor in ac for channel in factor) * 166 - 0.5)))
+        maximum_value = (quantised_max + 1) / 166
+        blurhash += encode_base83(quantised_max, 1)
+    else:
+        blurhash += encode_base83(0, 1)
+    
+    blurhash += encode_base83((linear_to_srgb(dc[0]) << 16) + (linear_to_srgb(dc[1]) << 8) + linear_to_srgb(dc[2]), 4)
+    for factor in ac:
+        quantised = [
+            max(0, min(18, int(math.copysign(abs(channel / maximum_value) ** 0.5, channel) * 9 + 9.5)))
+            for channel in factor
+        ]
+        blurhash += encode_base83(quantised[0] * 19 * 19 + quantised[1] * 19 + quantised[2], 2)
+    
+    return blurhash
+
+def hamming_distance(first, second):
+    """Count the differing bits of two integer hashes"""
+    return bin(first ^ second).count('1')
+
+class BKTree:
+    """
+    BK-tree of perceptual hashes under Hamming distance.
+    
+    Each node holds one hash and the picture keys sharing it. The triangle
+    inequality lets a radius search skip every subtree whose edge distance
+    is out of range, so queries touch a small part of the tree.
+    """
+    
+    def __init__(self):
+        self.root = None
+    
+    def add(self, phash, key):
+        if self.root is None:
+            self.root = (phash, {key}, {})
+            return
+        
+        node = self.root
+        while True:
+            distance = hamming_distance(phash, node[0])
+            if distance == 0:
+                node[1].add(key)
+                return
+            if distance not in node[2]:
+                node[2][distance] = (phash, {key}, {})
+                return
+            node = node[2][distance]
+    
+    def discard(self, phash, key):
+        """Remove a key, leaving its node in place to keep the tree valid"""
+        for _, _, keys in self.search(phash, 0):
+            keys.discard(key)
+    
+    def search(self, phash, max_distance):
+        """Get (distance, hash, keys) for every stored hash within max_distance"""
+        matches = []
+        nodes = [self.root] if self.root else []
+        while nodes:
+            node = nodes.pop()
+            distance = hamming_distance(phash, node[0])
+            if distance <= max_distance and node[1]:
+                matches.append((distance, node[0], node[1]))
+            nodes.extend(
+                child for edge, child in node[2].items()
+                if distance - max_distance <= edge <= distance + max_distance
+            )
+        return matches
+    
+    def hashes(self):
+        """Iterate over the stored hashes that still have pictures"""
+        nodes = [self.root] if self.root else []
+        while nodes:
+            node = nodes.pop()
+            if node[1]:
+                yield node[0]
+            nodes.extend(node[2].values())
+
+# BK-tree of the perceptual index, kept across warm invocations and reloaded after the TTL
+perceptual_index = None
+perceptual_index_loaded_at = 0
+perceptual_index_etag = None
+
+def get_perceptual_index_key(s3_key, dhash):
+    """Get the key of the marker object indexing a picture's perceptual hash"""
+    return f"{PERCEPTUAL_INDEX_PREFIX}{dhash}/{s3_key[len('pictures/'):]}"
+
+def rebuild_perceptual_index():
+    """
+    Rebuild the perceptual index from its marker objects and save it as one object.
+    
+    Listing the markers takes time linear in the gallery size, so uploads leave
+    this to a worker invocation ({"rebuild_perceptual_index": true}).
+    """
+    global perceptual_index, perceptual_index_loaded_at, perceptual_index_etag
+    
+    entries = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=PICTURES_BUCKET, Prefix=PERCEPTUAL_INDEX_PREFIX):
+        for obj in page.get('Contents', []):
+            dhash, name = obj['Key'][len(PERCEPTUAL_INDEX_PREFIX):].split('/', 1)
+            entries.append([dhash, f"pictures/{name}"])
+    
+    put_response = s3_client.put_object(
+        Bucket=PICTURES_BUCKET,
+        Key=PERCEPTUAL_INDEX_SNAPSHOT_KEY,
+        Body=json.dumps({'built': datetime.now(timezone.utc).isoformat(), 'entries': entries}).encode('utf-8'),
+        ContentType='application/json'
+    )
+    
+    tree = BKTree()
+    for dhash, key in entries:
+        tree.add(int(dhash, 16), key)
+    perceptual_index = tree
+    perceptual_index_loaded_at = time.monotonic()
+    perceptual_index_etag = put_response.get('ETag')
+    
+    print(f"Rebuilt perceptual index of {len(entries)} picture(s)")
+    return tree
+
+def invoke_perceptual_index_worker():
+    """Rebuild the perceptual index in a separate asynchronous invocation of this function"""
+    function_name = os.environ.get('AWS_LAMBDA_FUNCTION_NAME')
+    if not function_name:
+        # Not running in Lambda (local testing) - do the work inline
+        return rebuild_perceptual_index()
+    
+    lambda_client = boto3.client('lambda')
+    lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=json.dumps({'rebuild_perceptual_index': True})
+    )
+
+def get_perceptual_index():
+    """
+    Get the BK-tree of indexed pictures from the saved index, reloading it after
+    the TTL when it has changed. A missing or outdated saved index is rebuilt by a
+    worker while this invocation carries on with what it has.
+    """
+    global perceptual_index, perceptual_index_loaded_at, perceptual_index_etag
+    
+    if perceptual_index is not None and time.monotonic() - perceptual_index_loaded_at <= PERCEPTUAL_INDEX_TTL_SECONDS:
+        return perceptual_index
+    
+    try:
+        head_response = s3_client.head_object(Bucket=PICTURES_BUCKET, Key=PERCEPTUAL_INDEX_SNAPSHOT_KEY)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+        head_response = None
+    
+    if head_response is None or (
+        datetime.now(timezone.utc) - head_response['LastModified']
+    ).total_seconds() > PERCEPTUAL_INDEX_TTL_SECONDS:
+        rebuilt = invoke_perceptual_index_worker()
+        if rebuilt is not None:
+            return rebuilt
+    
+    if head_response is not None and head_response['ETag'] != perceptual_index_etag:
+        response = s3_client.get_object(Bucket=PICTURES_BUCKET, Key=PERCEPTUAL_INDEX_SNAPSHOT_KEY)
+        tree = BKTree()
+        for dhash, key in json.loads(response['Body'].read())['entries']:
+            tree.add(int(dhash, 16), key)
+        perceptual_index = tree
+        perceptual_index_etag = head_response['ETag']
+    elif perceptual_index is None:
+        perceptual_index = BKTree()
+    perceptual_index_loaded_at = time.monotonic()
+    
+    return perceptual_index
+
+def picture_exists(s3_key):
+    """Check whether a picture is still stored"""
+    try:
+        s3_client.head_object(Bucket=PICTURES_BUCKET, Key=s3_key)
+        return True
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+            raise
+        return False
+
+def index_perceptual_hash(s3_key, metadata):
+    """Add a picture to the perceptual index and return the keys of similar pictures already in it"""
+    dhash = metadata.get('dhash')
+    if not dhash:
+        return []
+    
+    try:
+        tree = get_perceptual_index()
+        similar = []
+        for distance, phash, key in sorted(
+            (distance, phash, key)
+            for distance, phash, keys in tree.search(int(dhash, 16), PERCEPTUAL_DUPLICATE_DISTANCE)
+            for key in keys if key != s3_key
+        ):
+            if picture_exists(key):
+                similar.append((distance, key))
+                continue
+            # Deleted by another process since the index was built
+            print(f"Removing stale perceptual index entry {key}")
+            tree.discard(phash, key)
+            s3_client.delete_object(Bucket=PICTURES_BUCKET, Key=get_perceptual_index_key(key, f"{phash:016x}"))
+        
+        s3_client.put_object(
+            Bucket=PICTURES_BUCKET,
+            Key=get_perceptual_index_key(s3_key, dhash),
+            Body=b''
+        )
+        tree.add(int(dhash, 16), s3_key)
+        
+        return [key for _, key in similar]
+    
+    except Exception as e:
+        # The picture itself is stored; only the near-duplicate warning is lost
+        print(f"Error indexing perceptual hash for {s3_key}: {e}")
+        return []
+
+def get_duplicate_clusters(max_distance):
+    """Group indexed pictures into clusters of near-duplicates, largest first"""
+    # The report is read rarely, so it lists the markers for an exact index
+    tree = rebuild_perceptual_index()
+    
+    # Union-find over hashes, joining every pair within max_distance
+    parents = {}
+    def find(phash):
+        while parents.setdefault(phash, phash) != phash:
+            parents[phash] = parents[parents[phash]]
+            phash = parents[phash]
+        return phash
+    
+    keys_by_hash = {}
+    for phash in tree.hashes():
+        for _, other, keys in tree.search(phash, max_distance):
+            keys_by_hash[other] = keys
+            parents[find(other)] = find(phash)
+    
+    clusters = {}
+    for phash, keys in keys_by_hash.items():
+        clusters.setdefault(find(phash), []).extend(keys)
+    
+    return sorted(
+        (sorted(keys) for keys in clusters.values() if len(keys) > 1),
+        key=len,
+        reverse=True
+    )
+
+def get_duplicates(event):
+    """List clusters of near-duplicate pictures"""
+    try:
+        params = event.get('queryStringParameters') or {}
+        try:
+            max_distance = int(params.get('distance', PERCEPTUAL_DUPLICATE_DISTANCE))
+        except ValueError:
+            max_distance = -1
+        if not 0 <= max_distance <= 64:
+            return {
+                'statusCode': 400,
+                'headers': get_cors_headers(),
+                'body': json.dumps({'error': 'distance must be an integer from 0 to 64'})
+            }
+        
+        clusters = [
+            {
+                'pictures': [
+                    {
+                        'key': key,
+                        'url': s3_client.generate_presigned_url(
+                            'get_object',
+                            Params={'Bucket': PICTURES_BUCKET, 'Key': key},
+                            ExpiresIn=3600  # 1 hour
+                        )
+                    }
+                    for key in keys
+                ]
+            }
+            for keys in get_duplicate_clusters(max_distance)
+        ]
+        
+        return {
+            'statusCode': 200,
+            'headers': get_cors_headers(),
+            'body': json.dumps({
+                'clusters': clusters,
+                'count': len(clusters),
+                'distance': max_distance
+            })
+        }
+        
+    except Exception as e:
+        print(f"Error finding duplicates: {str(e)}")
+        return {
+            'statusCode': 500,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'error': f'Failed to find duplicates: {str(e)}'})
+        }
+
+class SpooledPicture:
+    """
+    Write-only buffer for an incoming picture.
+    
+    Bytes are spooled to memory, or to /tmp past UPLOAD_SPOOL_MAX_MEMORY, while
+    the size, SHA-256 and content type are worked out as they arrive.
+    """
+    
+    def __init__(self):
+        self.file = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_MEMORY)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.header = b''
+    
+    def write(self, data):
+        self.file.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        if len(self.header) < 16:
+            self.header += data[:16 - len(self.header)]
+        return len(data)
+    
+    def sniff_content_type(self):
+        """Get the content type from the leading bytes, or None if unrecognized"""
+        for signature, content_type in IMAGE_SIGNATURES:
+            if self.header.startswith(signature):
+                return content_type
+        if self.header[:4] == b'RIFF' and self.header[8:12] == b'WEBP':
+            return 'image/webp'
+        if self.header[4:8] == b'ftyp':
+            brand = self.header[8:12]
+            if brand in (b'avif', b'avis'):
+                return 'image/avif'
+            if brand in (b'heic', b'heix', b'mif1'):
+                return 'image/heic'
+        return None
+    
+    def open(self):
+        """Rewind and get the spooled bytes as a readable file"""
+        self.file.seek(0)
+        return self.file
+    
+    def close(self):
+        self.file.close()
+
+def strip_base64_whitespace(encoded):
+    """Drop the line breaks of wrapped base64, which would misalign fixed-size chunks"""
+    if re.search(r'\s', encoded):
+        return re.sub(r'\s+', '', encoded)
+    return encoded
+
+def spool_base64(encoded):
+    """Decode a base64 string into a SpooledPicture a chunk at a time"""
+    picture = SpooledPicture()
+    encoded = strip_base64_whitespace(encoded)
+    for start in range(0, len(encoded), BASE64_DECODE_CHUNK_SIZE):
+        picture.write(base64.b64decode(encoded[start:start + BASE64_DECODE_CHUNK_SIZE]))
+    return picture
+
+def store_picture(picture_name, content_type, picture):
+    """Store a SpooledPicture under a new key unless identical content is already stored"""
+    digest = picture.sha256.hexdigest()
+    
+    duplicate = find_duplicate_picture(digest)
+    if duplicate:
+        return record_duplicate_upload(digest, duplicate, picture_name)
+    
+    # Generate unique filename
+    s3_key = generate_picture_key(picture_name)
+    
+    metadata = {
+        'original-name': picture_name,
+        'upload_date': datetime.now().isoformat(),
+        'rating': '0',
+        'sha256': digest
+    }
+    metadata.update(process_image(s3_key, picture.open(), picture.size))
+    
+    # Upload to S3, trusting the bytes over the client's declared type
+    s3_client.put_object(
+        Bucket=PICTURES_BUCKET,
+        Key=s3_key,
+        Body=picture.open(),
+        ContentLength=picture.size,
+        ContentType=picture.sniff_content_type() or content_type,
+        Metadata=metadata,
+        **({'Tagging': ARCHIVABLE_ORIGINAL_TAG} if is_archivable(metadata) else {})
+    )
+    duplicate = claim_hash_index_entry(digest, {
+        'key': s3_key,
+        'name': picture_name,
+        'size': picture.size,
+        'created': datetime.now().isoformat()
+    })
+    if duplicate:
+        # A concurrent upload of the same content was indexed first
+        s3_client.delete_object(Bucket=PICTURES_BUCKET, Key=s3_key)
+        return record_duplicate_upload(digest, duplicate, picture_name)
+    
+    similar = index_perceptual_hash(s3_key, metadata)
+    uploaded_at = datetime.now(timezone.utc)
+    if is_picture_key(s3_key):
+        record_stats_change(pictures=1, storage=picture.size, last_upload=uploaded_at.isoformat())
+        record_activity(uploads=1, when=uploaded_at)
+        spool_picture_record(s3_key, picture_name, metadata, picture.size, uploaded_at)
+    
+    print(f"Picture uploaded: {s3_key}, original: {picture_name}")
+    
+    return {
+        'message': 'Picture uploaded successfully',
+        'key': s3_key,
+        'original_name': picture_name,
+        'deduplicated': False,
+        'similar': similar,
+        'picture': get_picture_info(s3_key, datetime.now(timezone.utc), metadata)
+    }
+
+def upload_picture(event):
+    """Upload a picture to S3"""
+    try:
+        # Parse the request body, releasing each copy of the picture as soon as
+        # the next one exists so only the spooled bytes outlive decoding
+        body = event.pop('body', '')
+        if event.get('isBase64Encoded', False):
+            body = base64.b64decode(body).decode('utf-8')
+        
+        data = json.loads(body)
+        del body
+        
+        # Extract picture data
+        picture_name = data.get('name', f'picture_{uuid.uuid4().hex[:8]}.jpg')
+        picture_data = data.pop('data', '')
+        content_type = data.get('contentType', 'image/jpeg')
+        
+        if not picture_data:
+            return {
+                'statusCode': 400,
+                'headers': get_cors_headers(),
+                'body': json.dumps({'error': 'No picture data provided'})
+            }
+        
+        # Decode base64 image data
+        picture = spool_base64(picture_data)
+        del picture_data
+        
+        try:
+            result = store_picture(picture_name, content_type, picture)
+        finally:
+            picture.close()
+        
+        return {
+            'statusCode': 200,
+            'headers': get_cors_headers(),
+            'body': json.dumps(result)
+        }
+        
+    except Exception as e:
+        print(f"Error uploading picture: {str(e)}")
+        return {
+            'statusCode': 500,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'error': f'Failed to upload picture: {str(e)}'})
+        }
+
+class Base64Reader:
+    """Readable binary stream that decodes a base64 string as it is read"""
+    
+    def __init__(self, encoded):
+        self.encoded = strip_base64_whitespace(encoded)
+        self.position = 0
+    
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.encoded)
+        # Whole base64 quanta of four characters per three bytes
+        end = self.position + -(-size // 3) * 4
+        data = base64.b64decode(self.encoded[self.position:end])
+        self.position = end
+        return data
+
+def get_request_stream(event):
+    """Get the request body as a readable binary stream"""
+    body = event.get('body') or ''
+    if event.get('isBase64Encoded', False):
+        return Base64Reader(body)
+    return io.BytesIO(body.encode('utf-8'))
+
+def copy_stream(stream, sink):
+    """Copy the rest of a stream into sink in chunks"""
+    while True:
+        data = stream.read(BATCH_READ_SIZE)
+        if not data:
+            return
+        sink.write(data)
+
+def read_until(stream, buffer, marker, sink):
+    """Read the stream up to marker, writing the bytes before it to sink and returning the bytes after it"""
+    while True:
+        index = buffer.find(marker)
+        if index >= 0:
+            sink.write(buffer[:index])
+            return buffer[index + len(marker):]
+        
+        # Hold back a possible partial marker at the end of the buffer
+        keep = len(marker) - 1
+        if len(buffer) > keep:
+            sink.write(buffer[:-keep])
+            buffer = buffer[-keep:]
+        
+        data = stream.read(BATCH_READ_SIZE)
+        if not data:
+            raise ValueError('Malformed multipart body')
+        buffer += data
+
+def iter_multipart_parts(stream, boundary, open_part):
+    """
+    Yield (headers, part) for each part of a multipart/form-data body, one part at a time.
+    
+    open_part(headers) returns the writable sink the part's bytes are streamed into.
+    """
+    delimiter = b'\r\n--' + boundary.encode('latin-1')
+    
+    # The first delimiter has no preceding line break; anything before it is preamble
+    buffer = read_until(stream, b'\r\n', delimiter, io.BytesIO())
+    while True:
+        while len(buffer) < 2:
+            data = stream.read(BATCH_READ_SIZE)
+            if not data:
+                raise ValueError('Malformed multipart body')
+            buffer += data
+        if buffer.startswith(b'--'):
+            return  # Closing delimiter
+        
+        header_block = io.BytesIO()
+        buffer = read_until(stream, buffer, b'\r\n\r\n', header_block)
+        headers = {}
+        for line in header_block.getvalue().decode('utf-8').split('\r\n'):
+            if ':' in line:
+                name, value = line.split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+        
+        part = open_part(headers)
+        buffer = read_until(stream, buffer, delimiter, part)
+        yield headers, part
+
+def open_multipart_part(headers):
+    """Spool file parts of a batch upload; plain form fields stay in memory"""
+    if 'filename=' in headers.get('content-disposition', ''):
+        return SpooledPicture()
+    return io.BytesIO()
+
+def iter_uploaded_files(event):
+    """Yield (name, content_type, picture) for each file in a batch upload request"""
+    headers = {name.lower(): value for name, value in (event.get('headers') or {}).items()}
+    content_type = headers.get('content-type', '')
+    stream = get_request_stream(event)
+    
+    if content_type.startswith('multipart/form-data'):
+        match = re.search(r'boundary="?([^";]+)"?', content_type)
+        if not match:
+            raise ValueError('Missing multipart boundary')
+        
+        for part_headers, part in iter_multipart_parts(stream, match.group(1), open_multipart_part):
+            filename = re.search(r'filename="([^"]*)"', part_headers.get('content-disposition', ''))
+            if not filename:
+                continue  # Plain form fields carry no picture
+            yield filename.group(1), part_headers.get('content-type', 'image/jpeg'), part
+    else:
+        # A raw binary body is a single picture named in the query string
+        params = event.get('queryStringParameters') or {}
+        name = params.get('name', f'picture_{uuid.uuid4().hex[:8]}.jpg')
+        picture = SpooledPicture()
+        copy_stream(stream, picture)
+        yield name, content_type or 'image/jpeg', picture
+
+def upload_picture_batch(event):
+    """Upload every picture in a multipart/form-data or raw binary request body"""
+    try:
+        uploaded = []
+        failed = []
+        
+        # Each file is stored before the next one is parsed
+        for picture_name, content_type, picture in iter_uploaded_files(event):
+            try:
+                if not picture.size:
+                    failed.append({'name': picture_name, 'error': 'No picture data provided'})
+                    continue
+                # Part and body content types are the client's word; only image bytes are stored
+                content_type = picture.sniff_content_type()
+                if not content_type:
+                    failed.append({'name': picture_name, 'error': 'Not a supported image format'})
+                    continue
+                uploaded.append(store_picture(picture_name, content_type, picture))
+            except Exception as e:
+                print(f"Error uploading {picture_name}: {str(e)}")
+                failed.append({'name': picture_name, 'error': str(e)})
+            finally:
+                picture.close()
+        
+        if not uploaded and not failed:
+            return {
+                'statusCode': 400,
+                'headers': get_cors_headers(),
+                'body': json.dumps({'error': 'No pictures provided'})
+            }
+        
+        return {
+            'statusCode': 200,
+            'headers': get_cors_headers(),
+            'body': json.dumps({
+                'message': f'Uploaded {len(uploaded)} picture(s)',
+                'uploaded': uploaded,
+                'failed': failed
+            })
+        }
+        
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'error': str(e)})
+        }
+    except Exception as e:
+        print(f"Error uploading picture batch: {str(e)}")
+        return {
+            'statusCode': 500,
+            'headers': get_cors_headers(),
+            'body': json.dumps({'error': f'Failed to upload pictures: {str(e)}'})
         }